@@ -0,0 +1,2 @@
+"""Benchmarks over synthetic catalogs, run from the repository root with
+python -m benchmarks.<module>"""
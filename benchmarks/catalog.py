@@ -0,0 +1,216 @@
+"""Synthetic OMDb-shaped catalogs for benchmarks
+
+    python -m benchmarks.catalog 100000 --jsonl catalog_100k.jsonl.gz
+    python -m benchmarks.catalog 100000 --db catalog_100k.sqlite
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+
+from classes.DB import DB
+from classes.Movie import Movie
+
+SIZES = (10000, 100000, 1000000)
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+ADJECTIVES = (
+    'Silent', 'Last', 'Dark', 'Broken', 'Golden', 'Hidden', 'Endless',
+    'Crimson', 'Lost', 'Wild', 'Frozen', 'Burning', 'Secret', 'Little',
+    'Distant', 'Final', 'Forgotten', 'Midnight', 'Electric', 'Savage',
+)
+NOUNS = (
+    'River', 'Harbor', 'Empire', 'Garden', 'Machine', 'Promise', 'Kingdom',
+    'Highway', 'Witness', 'Frontier', 'Mirror', 'Storm', 'Island', 'Heart',
+    'Station', 'Shadow', 'Summer', 'Voyage', 'Legacy', 'Circus',
+)
+FIRST_NAMES = (
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael',
+    'Linda', 'David', 'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan',
+    'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Akira', 'Ingrid', 'Federico',
+    'Agnes', 'Pedro', 'Sofia', 'Jean-Luc', 'Maren', 'Wong', 'Bong',
+)
+LAST_NAMES = (
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller',
+    'Davis', 'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Wilson',
+    'Anderson', 'Taylor', 'Moore', 'Jackson', 'Martin', 'Lee', "O'Brien",
+    'Kurosawa', 'Bergman', 'Fellini', 'Varda', 'Almodovar', 'Godard',
+)
+GENRES = (
+    'Drama', 'Comedy', 'Action', 'Thriller', 'Crime', 'Romance', 'Horror',
+    'Sci-Fi', 'Adventure', 'Animation', 'Biography', 'Family', 'Fantasy',
+    'Mystery', 'War', 'Western', 'Music', 'History', 'Documentary',
+)
+LANGUAGES = (
+    'English', 'French', 'Spanish', 'German', 'Italian', 'Japanese',
+    'Korean', 'Mandarin', 'Hindi', 'Russian', 'Swedish', 'Portuguese',
+)
+COUNTRIES = (
+    'United States', 'United Kingdom', 'France', 'Germany', 'Italy',
+    'Japan', 'South Korea', 'China', 'India', 'Spain', 'Canada', 'Sweden',
+)
+WRITER_NOTES = ('', ' (screenplay)', ' (story)', ' (novel)', ' (written by)')
+TITLES = ('The {0} {1}', '{0} {1}', '{1} of the {0} {2}', 'A {0} {1}')
+RATED = ('G', 'PG', 'PG-13', 'R', 'NC-17', 'Not Rated', 'N/A')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec')
+
+
+def plural(count, word):
+    return f"{count} {word}" if count == 1 else f"{count} {word}s"
+
+
+def get_awards(rng):
+    """ Gets awards string in one of the formats OMDb uses """
+    if rng.random() < 0.25:
+        return 'N/A'
+    wins = min(int(rng.paretovariate(1.2)) - 1, 300)
+    nominations = wins + min(int(rng.paretovariate(1.1)) - 1, 400)
+    oscars = min(wins, int(rng.paretovariate(2.5)) - 1) \
+        if rng.random() < 0.1 else 0
+    oscar_nominations = max(oscars, int(rng.paretovariate(2)) - 1) \
+        if rng.random() < 0.15 else oscars
+    if oscars:
+        prefix = f"Won {plural(oscars, 'Oscar')}. "
+    elif oscar_nominations:
+        prefix = f"Nominated for {plural(oscar_nominations, 'Oscar')}. "
+    else:
+        prefix = ''
+    if not wins and not nominations:
+        return prefix.strip() or 'N/A'
+    if not wins:
+        summary = plural(nominations, 'nomination')
+    elif not nominations:
+        summary = plural(wins, 'win')
+    else:
+        summary = f"{plural(wins, 'win')} & " \
+            f"{plural(nominations, 'nomination')}"
+    if prefix and rng.random() < 0.5:
+        return f"{prefix}Another {summary}."
+    return f"{prefix}{summary}" + (' total' if rng.random() < 0.5 else '')
+
+
+class Catalog():
+    """ Deterministic generator of OMDb-shaped movie responses """
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed
+        # a people pool growing with the catalog keeps filters selective
+        rng = random.Random(seed)
+        people = max(50, int(size ** 0.75))
+        self.people = [
+            f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {number}"
+            for number in range(people)
+        ]
+
+    def person(self, rng):
+        # popular people appear far more often than the long tail
+        index = min(int(rng.paretovariate(1.0)) - 1, len(self.people) - 1)
+        return self.people[index] if rng.random() < 0.3 \
+            else rng.choice(self.people)
+
+    def people_list(self, rng, count, notes=False):
+        names = [self.person(rng) for _ in range(count)]
+        if notes:
+            names = [name + rng.choice(WRITER_NOTES) for name in names]
+        return ', '.join(names)
+
+    def movie(self, number, rng, titles):
+        """ Gets OMDb response for movie number, titles counts the uses
+        of each title so repeated ones become numbered sequels """
+        title = rng.choice(TITLES).format(
+            rng.choice(ADJECTIVES), rng.choice(NOUNS), rng.choice(NOUNS))
+        titles[title] = titles.get(title, 0) + 1
+        if titles[title] > 1:
+            title = f"{title} {titles[title]}"
+        year = rng.randint(1920, 2023)
+        box_office = 'N/A' if rng.random() < 0.4 or year < 1975 \
+            else f"${int(rng.lognormvariate(16, 1.8)):,}"
+        votes = int(rng.lognormvariate(9, 2))
+        return {
+            'Title': title,
+            'Year': str(year),
+            'Rated': rng.choice(RATED),
+            'Released': f"{rng.randint(1, 28):02d} "
+                        f"{rng.choice(MONTHS)} {year}",
+            'Runtime': 'N/A' if rng.random() < 0.03
+            else f"{max(int(rng.gauss(108, 22)), 60)} min",
+            'Genre': ', '.join(rng.sample(GENRES, rng.randint(1, 3))),
+            'Director': self.people_list(rng, 1 + (rng.random() < 0.1)),
+            'Writer': self.people_list(rng, rng.randint(1, 3), notes=True),
+            'Actors': self.people_list(rng, rng.randint(3, 4)),
+            'Plot': 'N/A',
+            'Language': ', '.join(rng.sample(LANGUAGES, rng.randint(1, 3))),
+            'Country': ', '.join(rng.sample(COUNTRIES, rng.randint(1, 2))),
+            'Awards': get_awards(rng),
+            'imdbRating': 'N/A' if votes < 5
+            else f"{min(max(rng.gauss(6.4, 1.1), 1.0), 10.0):.1f}",
+            'imdbVotes': 'N/A' if votes < 5 else f"{votes:,}",
+            'imdbID': f"tt{number + 1000000:07d}",
+            'Type': 'movie',
+            'BoxOffice': box_office,
+            'Response': 'True',
+        }
+
+    def __iter__(self):
+        rng = random.Random(self.seed + 1)
+        titles = {}
+        for number in range(self.size):
+            yield self.movie(number, rng, titles)
+
+    def __len__(self):
+        return self.size
+
+
+def write_jsonl(catalog, path):
+    """ Writes catalog as OMDb JSON lines, gzipped if path ends .gz """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        for data in catalog:
+            f.write(json.dumps(data) + '\n')
+    return path
+
+
+def build_db(catalog, path, batch_size=5000):
+    """ Creates SQLite database holding catalog, returns open DB """
+    db = DB(path, journal_mode='wal', synchronous='normal')
+    with db.bulk_load():
+        db.upsert_many(map(Movie.json_to_movie, catalog), batch_size)
+    return db
+
+
+def get_db(size, seed=0, data_dir=DATA_DIR):
+    """ Opens cached catalog database of given size, building it once """
+    path = os.path.join(data_dir, f'catalog_{size}_{seed}.sqlite')
+    if os.path.exists(path):
+        return DB(path)
+    os.makedirs(data_dir, exist_ok=True)
+    partial = path + '.partial'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(partial + suffix):
+            os.remove(partial + suffix)
+    build_db(Catalog(size, seed), partial).close()
+    os.replace(partial, path)
+    return DB(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic OMDb-shaped movie catalogs")
+    parser.add_argument("size", type=int, help="Number of movies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jsonl", metavar='FILE',
+                        help="Write OMDb JSON lines (.jsonl or .jsonl.gz)")
+    parser.add_argument("--db", metavar='FILE',
+                        help="Write SQLite database usable by movies.py")
+    args = parser.parse_args(argv)
+    catalog = Catalog(args.size, args.seed)
+    if args.jsonl:
+        write_jsonl(catalog, args.jsonl)
+    if args.db:
+        build_db(catalog, args.db).close()
+
+
+if __name__ == '__main__':
+    main()
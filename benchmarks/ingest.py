@@ -0,0 +1,203 @@
+"""End-to-end populate and add throughput against a local fake OMDb
+
+    python -m benchmarks.ingest --sizes 1000 10000 --workers 1 4 16 \
+        --profiles fast flaky --output ingest.json
+
+Every run starts from a fresh database holding only catalog titles, so
+results are reproducible offline and comparable across commits with
+--baseline like benchmarks.queries.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.catalog import Catalog
+from benchmarks.omdb_server import FakeOMDb
+from benchmarks.queries import get_meta
+from classes.Client import AdaptiveLimit, OMDbClient
+from classes.DB import DB
+from classes.HelperClasses import percentile
+from classes.Repository import Repository, get_session
+
+# fake OMDb settings: latency and jitter in seconds, rates as fractions
+PROFILES = {
+    'fast': dict(latency=0.002),
+    'slow': dict(latency=0.05, jitter=0.05),
+    'flaky': dict(latency=0.01, jitter=0.01, error_rate=0.03,
+                  throttle_rate=0.03),
+    'throttled': dict(latency=0.01, rate_limit=200),
+}
+
+
+@contextlib.contextmanager
+def fake_omdb(movies, profile, seed=0):
+    server = FakeOMDb(movies, seed=seed, **PROFILES[profile]).start()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+@contextlib.contextmanager
+def fresh_db(titles):
+    """ Yields DB in a temporary file holding only given titles """
+    with tempfile.TemporaryDirectory() as directory:
+        db = DB(os.path.join(directory, 'ingest.sqlite'))
+        for title in titles:
+            db.insert(title)
+        db.conn.commit()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def get_client(workers, rate=None):
+    return OMDbClient(
+        get_session(workers), rate=rate, timeout=5, retries=3, backoff=0.05,
+        limit=AdaptiveLimit(workers) if workers > 1 else None)
+
+
+def latency_stats(latencies):
+    return dict(
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+    )
+
+
+def bench_populate(movies, workers, profile, batch_size=500, rate=None,
+                   seed=0):
+    """ Populates fresh database from fake OMDb, returns result row """
+    with fake_omdb(movies, profile, seed) as server, \
+            fresh_db(movie['Title'] for movie in movies) as db:
+        client = get_client(workers, rate)
+        repo = Repository(db, None, client=client, url=server.url,
+                          apikey='benchmark')
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            stats = repo.populate(workers=workers, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        (ok, ) = db.cursor.execute(
+            "select count(*) from movies where fetch_status='ok'"
+        ).fetchone()
+        return dict(
+            benchmark='populate', profile=profile, size=len(movies),
+            workers=workers, wall_s=elapsed, ok=ok,
+            failed=len(movies) - ok, titles_per_s=len(movies) / elapsed,
+            requests=server.counts['requests'],
+            throttled=server.counts[429], errors=server.counts[500],
+            retries=client.retried, circuit_opened=client.breaker.opened,
+            **latency_stats(stats.latencies))
+
+
+def bench_add(movies, profile, count=200, seed=0):
+    """ Adds count titles one by one from fake OMDb, returns result row """
+    movies = movies[:count]
+    with fake_omdb(movies, profile, seed) as server, fresh_db(()) as db:
+        client = get_client(1)
+        repo = Repository(db, None, client=client, url=server.url,
+                          apikey='benchmark')
+        latencies = []
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            for movie in movies:
+                added = time.perf_counter()
+                repo.add(movie['Title'])
+                latencies.append(time.perf_counter() - added)
+        elapsed = time.perf_counter() - start
+        (ok, ) = db.cursor.execute("select count(*) from movies").fetchone()
+        return dict(
+            benchmark='add', profile=profile, size=len(movies), workers=1,
+            wall_s=elapsed, ok=ok, failed=len(movies) - ok,
+            titles_per_s=len(movies) / elapsed,
+            requests=server.counts['requests'], retries=client.retried,
+            **latency_stats(latencies))
+
+
+def benchmark(sizes=(1000, ), workers=(1, 4, 16), profiles=('fast', ),
+              adds=200, batch_size=500, rate=None, seed=0, log=sys.stderr):
+    """ Runs populate for every size, concurrency and server profile and
+    add for every profile, returns result rows """
+    results = []
+    for size in sizes:
+        movies = list(Catalog(size, seed))
+        for profile in profiles:
+            for count in workers:
+                result = bench_populate(
+                    movies, count, profile, batch_size, rate, seed)
+                results.append(result)
+                print(f"populate {profile:10} {size:>8} x{count:<3} "
+                      f"{result['titles_per_s']:10.1f} titles/s "
+                      f"{result['failed']:>6} failed", file=log)
+    if adds:
+        movies = list(Catalog(adds, seed))
+        for profile in profiles:
+            result = bench_add(movies, profile, adds, seed)
+            results.append(result)
+            print(f"add      {profile:10} {adds:>8}     "
+                  f"{result['titles_per_s']:10.1f} titles/s "
+                  f"p99 {result['p99_ms']:.1f} ms", file=log)
+    return results
+
+
+def compare(results, baseline):
+    """ Gets (benchmark, profile, size, workers, baseline titles/s,
+    current titles/s, ratio) rows """
+    def key(row):
+        return (row['benchmark'], row['profile'], row['size'],
+                row['workers'])
+
+    previous = dict(
+        (key(row), row['titles_per_s']) for row in baseline['results'])
+    return [
+        key(row) + (previous[key(row)], row['titles_per_s'],
+                    row['titles_per_s'] / previous[key(row)])
+        for row in results if previous.get(key(row))
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark populate and add against a fake OMDb")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000])
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument("--profiles", nargs='+', choices=list(PROFILES),
+                        default=['fast'])
+    parser.add_argument("--adds", type=int, default=200,
+                        help="Number of titles added one by one, 0 to skip")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--rate", type=float,
+                        help="Client rate limit in requests per second")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", metavar='FILE',
+                        help="Write JSON results to FILE instead of stdout")
+    parser.add_argument("--baseline", metavar='FILE',
+                        help="Compare throughput with earlier JSON results")
+    args = parser.parse_args(argv)
+    results = benchmark(args.sizes, args.workers, args.profiles, args.adds,
+                        max(args.batch_size, 1), args.rate, args.seed)
+    report = dict(meta=get_meta(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for (name, profile, size, workers, before, after, ratio) in \
+                compare(results, baseline):
+            print(f"{name:8} {profile:10} {size:>8} x{workers:<3} "
+                  f"{before:10.1f} -> {after:10.1f} titles/s {ratio:6.2f}x",
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
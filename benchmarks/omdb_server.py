@@ -0,0 +1,186 @@
+"""Local OMDb stand-in with configurable latency, errors and throttling
+
+    python -m benchmarks.omdb_server --catalog 10000 --latency 0.05 \
+        --error-rate 0.01 --rate-limit 100
+    python movies.py --populate --omdb-url http://127.0.0.1:8800/
+"""
+import argparse
+import glob
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.catalog import Catalog
+
+FIXTURES = 'fixtures/*.json'
+NOT_FOUND = {"Response": "False", "Error": "Movie not found!"}
+ERRORS = {
+    429: {"Response": "False", "Error": "Request limit reached!"},
+    500: {"Response": "False", "Error": "Internal server error."},
+    503: {"Response": "False", "Error": "Service unavailable."},
+}
+
+
+def load_fixtures(pattern=FIXTURES):
+    """ Gets OMDb responses stored as JSON files """
+    movies = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            movies.append(json.load(f))
+    return movies
+
+
+class FakeOMDbHandler(BaseHTTPRequestHandler):
+    # keep-alive like OMDb; headers and body are separate writes, so
+    # Nagle would hold the body back until the client's delayed ACK
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        (status, delay) = server.decide()
+        if delay > 0:
+            time.sleep(delay)
+        if status == 200:
+            title = parse_qs(urlparse(self.path).query).get('t', [''])[0]
+            body = server.payloads.get(title.strip().lower(), server.missing)
+        else:
+            body = server.errors[status]
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeOMDb(ThreadingHTTPServer):
+    """ Threaded HTTP server answering OMDb ?t=<title> lookups
+
+    Every request waits latency seconds (plus uniform jitter), fails with
+    500 at error_rate and with 429 at throttle_rate; with rate_limit
+    requests above that many per second get 429 with Retry-After.
+    Unknown titles get OMDb's 'Movie not found!' response. Scripted
+    (status, delay) pairs appended to script answer the next requests
+    before any of that applies.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, movies, latency=0.0, jitter=0.0, error_rate=0.0,
+                 throttle_rate=0.0, rate_limit=None, seed=0,
+                 address=('127.0.0.1', 0)):
+        if ':' in address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(address, FakeOMDbHandler)
+        self.payloads = dict(
+            (movie['Title'].lower(), json.dumps(movie).encode('utf-8'))
+            for movie in movies)
+        self.missing = json.dumps(NOT_FOUND).encode('utf-8')
+        self.errors = dict(
+            (status, json.dumps(data).encode('utf-8'))
+            for (status, data) in ERRORS.items())
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = None
+        self.in_window = 0
+        self.counts = Counter()
+        self.script = []
+        host = f'[{address[0]}]' if ':' in address[0] else address[0]
+        self.url = f'http://{host}:{self.server_port}/'
+
+    def decide(self):
+        """ Gets (status, delay) for next request, counting both """
+        with self.lock:
+            self.counts['requests'] += 1
+            if self.script:
+                (status, delay) = self.script.pop(0)
+                self.counts[status] += 1
+                return status, delay
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            if self.rate_limit is not None:
+                window = int(time.monotonic())
+                if window != self.window:
+                    (self.window, self.in_window) = (window, 0)
+                self.in_window += 1
+                if self.in_window > self.rate_limit:
+                    self.counts[429] += 1
+                    return 429, 0.0
+            draw = self.rng.random()
+            if draw < self.error_rate:
+                status = 500
+            elif draw < self.error_rate + self.throttle_rate:
+                status = 429
+            else:
+                status = 200
+            self.counts[status] += 1
+            return status, delay
+
+    def handle_error(self, request, client_address):
+        # clients that timed out close the socket before the response
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        """ Serves requests from a daemon thread, returns self """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve OMDb-shaped responses locally")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--catalog", type=int, metavar='SIZE',
+                        help="Serve synthetic catalog instead of fixtures")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds every response waits")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Maximum extra random latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Fraction of requests failing with 429")
+    parser.add_argument("--rate-limit", type=int,
+                        help="Requests per second above which 429 is sent")
+    args = parser.parse_args(argv)
+    movies = Catalog(args.catalog, args.seed) if args.catalog \
+        else load_fixtures()
+    server = FakeOMDb(
+        movies, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        rate_limit=args.rate_limit, seed=args.seed,
+        address=(args.host, args.port))
+    print(f"Fake OMDb serving {len(server.payloads)} movies on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""Times every Repository query path over synthetic catalogs
+
+    python -m benchmarks.queries --sizes 10000 100000 --output head.json
+    python -m benchmarks.queries --sizes 10000 --baseline head.json
+
+Results are one JSON document with run metadata and a row per (engine,
+size, query): median and best wall time, rows returned, rows/sec and
+Python peak memory traced during one extra run.
+"""
+import argparse
+import json
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from benchmarks.catalog import DATA_DIR, SIZES, get_db
+from classes.Repository import Repository
+
+# cached: the sqlite engine answering repeats from a ResultCache
+ENGINES = ('sqlite', 'columnar', 'cached')
+
+
+def get_queries(db):
+    """ Gets (name, callable) of every Repository query path, using
+    values that exist in the catalog """
+    (director, actor, title, other) = db.cursor.execute(
+        "select director, \"cast\", title, \
+        (select title from movies order by id desc limit 1) \
+        from movies order by id limit 1"
+    ).fetchone()
+    titles = [row[0] for row in db.cursor.execute(
+        "select title from movies order by id limit 2000").fetchall()]
+    pairs = list(zip(titles[::2], titles[1::2]))
+    director = director.split(',')[0]
+    actor = actor.split(',')[0]
+    pair = (title, other)
+    return [
+        ('sort_title', lambda repo: repo.get_sorted_by('title')),
+        ('sort_year', lambda repo: repo.get_sorted_by('year')),
+        ('sort_runtime', lambda repo: repo.get_sorted_by_runtime()),
+        ('sort_box_office', lambda repo: repo.get_sorted_by('box_office')),
+        ('top_imdb_rating', lambda repo: repo.get_top('imdb_rating', 10)),
+        ('top_runtime_asc', lambda repo: repo.get_top(
+            'runtime', 10, descending=False)),
+        ('top_genre', lambda repo: repo.get_top('genre', 10)),
+        ('sort_year_page', lambda repo: repo.get_sorted_by(
+            'year', limit=50, offset=1000)),
+        ('filter_director', lambda repo: repo.get_filtered_by(
+            'director', director)),
+        ('filter_actor', lambda repo: repo.get_filtered_by('actor', actor)),
+        ('filter_actor_prefix', lambda repo: repo.get_filtered_by(
+            'actor', actor[:4], 'prefix')),
+        ('filter_actor_substring', lambda repo: repo.get_filtered_by(
+            'actor', actor[1:5], 'substring')),
+        ('filter_genre', lambda repo: repo.get_filtered_by(
+            'genre', 'Western')),
+        ('filter_language', lambda repo: repo.get_filtered_by(
+            'language', 'Swedish')),
+        ('find_combined', lambda repo: repo.find(
+            [('language', 'Swedish'), ('earned', None)],
+            ['imdb_rating', 'year'])[1]),
+        ('awarded', lambda repo: repo.get_awarded()),
+        ('nominated', lambda repo: repo.get_nominated()),
+        ('earned', lambda repo: repo.get_earned()),
+        ('highscores', lambda repo: repo.get_highscores()),
+        ('highscores_top10', lambda repo: repo.get_highscores(top=10)),
+        ('search', lambda repo: repo.search(actor, 100)),
+        ('compare_runtime', lambda repo: repo.get_runtime(pair)),
+        ('compare_box_office', lambda repo: repo.get_box_office(pair)),
+        ('compare_imdb_rating', lambda repo: repo.get_imdb_rating(pair)),
+        ('compare_awards', lambda repo: repo.get_awards(pair)),
+        ('compare_ranking', lambda repo: repo.get_compared(
+            'imdb_rating', titles)),
+        ('compare_pairs', lambda repo: repo.compare_pairs('runtime', pairs)),
+    ]
+
+
+def run(query, repo):
+    """ Runs query consuming all rows, returns (seconds, rows) """
+    start = time.perf_counter()
+    rows = sum(1 for _ in query(repo))
+    return time.perf_counter() - start, rows
+
+
+def measure(query, repo, repeat):
+    times = []
+    for _ in range(repeat):
+        (elapsed, rows) = run(query, repo)
+        times.append(elapsed)
+    tracemalloc.start()
+    run(query, repo)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    median = statistics.median(times)
+    return dict(
+        wall_s=median, min_s=min(times), rows=rows,
+        rows_per_s=rows / median if median > 0 else None,
+        peak_kib=peak // 1024,
+    )
+
+
+def get_repository(engine, db):
+    if engine == 'columnar':
+        from classes.Columnar import ColumnarRepository
+        return ColumnarRepository(db, None)
+    if engine == 'cached':
+        from classes.Cache import ResultCache
+        return Repository(db, None, results=ResultCache())
+    return Repository(db, None)
+
+
+def get_meta():
+    """ Gets run metadata identifying commit and environment """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        commit=commit, timestamp=time.time(), python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version, platform=platform.platform(),
+    )
+
+
+def benchmark(sizes=SIZES, engines=('sqlite', ), repeat=5, seed=0,
+              only=None, log=sys.stderr, data_dir=DATA_DIR):
+    """ Runs query benchmarks, returns result rows """
+    results = []
+    for size in sizes:
+        db = get_db(size, seed, data_dir)
+        queries = get_queries(db)
+        for engine in engines:
+            start = time.perf_counter()
+            repo = get_repository(engine, db)
+            load_s = time.perf_counter() - start
+            for (name, query) in queries:
+                if only and name not in only:
+                    continue
+                result = dict(engine=engine, size=size, query=name,
+                              load_s=load_s, **measure(query, repo, repeat))
+                results.append(result)
+                print(f"{engine:8} {size:>8} {name:24} "
+                      f"{result['wall_s'] * 1000:10.2f} ms "
+                      f"{result['rows']:>8} rows", file=log)
+        db.close()
+    return results
+
+
+def compare(results, baseline):
+    """ Gets (engine, size, query, baseline s, current s, ratio) rows """
+    previous = dict(
+        ((row['engine'], row['size'], row['query']), row['wall_s'])
+        for row in baseline['results'])
+    rows = []
+    for row in results:
+        key = (row['engine'], row['size'], row['query'])
+        if previous.get(key):
+            rows.append(key + (previous[key], row['wall_s'],
+                               row['wall_s'] / previous[key]))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark Repository queries on synthetic catalogs")
+    parser.add_argument("--sizes", type=int, nargs='+', default=SIZES)
+    parser.add_argument("--engines", nargs='+', choices=ENGINES,
+                        default=['sqlite'])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs='+', metavar='QUERY',
+                        help="Run only given queries")
+    parser.add_argument("--output", metavar='FILE',
+                        help="Write JSON results to FILE instead of stdout")
+    parser.add_argument("--baseline", metavar='FILE',
+                        help="Compare wall times with earlier JSON results")
+    args = parser.parse_args(argv)
+    results = benchmark(args.sizes, args.engines, max(args.repeat, 1),
+                        args.seed, args.only)
+    report = dict(meta=get_meta(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for (engine, size, query, before, after, ratio) in \
+                compare(results, baseline):
+            print(f"{engine:8} {size:>8} {query:24} {before * 1000:10.2f} ms"
+                  f" -> {after * 1000:10.2f} ms {ratio:6.2f}x",
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
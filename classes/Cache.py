@@ -0,0 +1,220 @@
+import json
+import sqlite3 as sql
+import threading
+import time
+from collections import OrderedDict
+
+DAY = 24 * 60 * 60
+
+
+def cache_key(params):
+    """ Builds cache key from request params, skipping the API key """
+    normalized = dict(
+        (str(key).lower(), str(value).strip().lower())
+        for (key, value) in (params or {}).items()
+        if key != 'apikey'
+    )
+    return json.dumps(normalized, sort_keys=True)
+
+
+class ResponseCache():
+    """ On-disk OMDb response cache with TTL and LRU eviction
+
+    Hits only queue their access time, written with one statement and
+    commit once touch_batch entries were hit or before the next put, so
+    readers do not wait for a commit per hit. The entry count is kept
+    in memory.
+    """
+    def __init__(self, path='omdb_cache.sqlite', ttl=30 * DAY,
+                 max_entries=100000, touch_batch=100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self.touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sql.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "create table if not exists responses \
+            (key text primary key, payload text, \
+            expires_at real, accessed_at real)"
+        )
+        self.conn.execute(
+            "create index if not exists idx_responses_accessed \
+            on responses (accessed_at)"
+        )
+        self.conn.commit()
+        (self.count, ) = self.conn.execute(
+            "select count(*) from responses").fetchone()
+
+    def get(self, params):
+        """ Gets cached response or None if missing or expired """
+        key = cache_key(params)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "select payload, expires_at from responses where key=?",
+                (key, )
+            ).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self.touched.pop(key, None)
+                    self.conn.execute(
+                        "delete from responses where key=?", (key, ))
+                    self.conn.commit()
+                    self.count -= 1
+                self.misses += 1
+                return None
+            self.touched[key] = now
+            if len(self.touched) >= self.touch_batch:
+                self.write_touched()
+                self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def write_touched(self):
+        """ Writes queued access times of hits """
+        if self.touched:
+            self.conn.executemany(
+                "update responses set accessed_at=? where key=?",
+                [(now, key) for (key, now) in self.touched.items()])
+            self.touched.clear()
+
+    def flush(self):
+        """ Commits queued access times, e.g. before exiting """
+        with self.lock:
+            self.write_touched()
+            self.conn.commit()
+
+    def put(self, params, payload, ttl=None):
+        """ Stores response, evicting least recently used entries """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        key = cache_key(params)
+        with self.lock:
+            self.touched.pop(key, None)
+            self.write_touched()
+            existing = self.conn.execute(
+                "select 1 from responses where key=?", (key, )).fetchone()
+            self.conn.execute(
+                "insert or replace into responses \
+                (key, payload, expires_at, accessed_at) values (?, ?, ?, ?)",
+                (key, json.dumps(payload), now + ttl, now)
+            )
+            if existing is None:
+                self.count += 1
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """ Drops least recently used entries above max_entries """
+        excess = self.count - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "delete from responses where key in \
+                (select key from responses order by accessed_at limit ?)",
+                (excess, )
+            )
+            self.count -= excess
+            self.evictions += excess
+
+    def __len__(self):
+        return self.count
+
+    def summary(self):
+        return f"Cache: {self.hits} hits, {self.misses} misses, " \
+            f"{self.evictions} evictions"
+
+
+class ResultCache():
+    """ In-memory LRU cache of query results for one database version
+
+    version is a token such as DB.data_version(); the first lookup under
+    a new version drops every result cached under the previous one, and
+    None means results must not be cached now. List results of up to
+    max_rows rows are kept. Iterator results still stream: their rows
+    are recorded as the caller reads them and kept once the iterator is
+    exhausted within max_rows rows, so partly read or larger results
+    are not cached.
+    """
+    def __init__(self, max_entries=256, max_rows=10000):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version, compute):
+        """ Gets result cached for key under version, or calls compute
+        and caches what it returns """
+        with self.lock:
+            if version is not None and version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                    self.entries.clear()
+                self.version = version
+            entry = self.entries.get(key) if version is not None else None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            (rows, iterator) = entry
+            return iter(rows) if iterator else list(rows)
+        result = compute()
+        if version is None:
+            return result
+        if isinstance(result, list):
+            if len(result) > self.max_rows:
+                return result
+            self.put(key, version, (tuple(result), False))
+            return result
+        if not hasattr(result, '__next__'):
+            return result
+        return self.record(key, version, result)
+
+    def record(self, key, version, result):
+        """ Yields rows of result, caching them once all were read """
+        rows = []
+        for row in result:
+            if rows is not None:
+                rows.append(row)
+                if len(rows) > self.max_rows:
+                    rows = None
+            yield row
+        if rows is not None:
+            self.put(key, version, (tuple(rows), True))
+
+    def put(self, key, version, entry):
+        with self.lock:
+            # a newer version may have been seen while computing
+            if version != self.version:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    invalidations=self.invalidations, size=len(self))
+
+    def summary(self):
+        return f"Result cache: {self.hits} hits, {self.misses} misses, " \
+            f"{self.evictions} evictions, {self.invalidations} invalidations"
@@ -0,0 +1,189 @@
+"""Rate limited, retrying HTTP client for OMDb calls"""
+import random
+import threading
+import time
+
+import requests
+
+# responses worth retrying: rate limited or transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(requests.RequestException):
+    """ Raised instead of calling OMDb while the circuit is open """
+
+
+class TokenBucket():
+    """ Thread-safe token bucket allowing rate requests per second with
+    bursts of up to burst requests """
+    def __init__(self, rate, burst=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Takes one token, sleeping until one is available """
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+
+
+class CircuitBreaker():
+    """ Opens after threshold consecutive failures and lets one trial
+    request through every reset_after seconds until one succeeds """
+    def __init__(self, threshold=5, reset_after=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ Checks whether a request may be sent now """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.reset_after:
+                self.opened_at = self.clock()
+                return True
+            return False
+
+    def record(self, ok):
+        """ Records outcome of a request """
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.opened += 1
+                self.opened_at = self.clock()
+
+
+class AdaptiveLimit():
+    """ Concurrency limit growing by one after limit fast successes and
+    halving on errors or latency above target_latency seconds """
+    def __init__(self, maximum, minimum=1, target_latency=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.target_latency = target_latency
+        self.limit = minimum
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """ Waits until fewer than limit requests are in flight """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        """ Frees a slot and adjusts limit to the observed outcome """
+        with self.condition:
+            self.in_flight -= 1
+            if ok and latency <= self.target_latency:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+            else:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.successes = 0
+            self.condition.notify_all()
+
+
+class OMDbClient():
+    """ Drop-in for requests.Session adding per-request timeouts, rate
+    limiting, retries with jittered exponential backoff, a circuit
+    breaker and adaptive concurrency """
+    def __init__(self, session=None, rate=None, timeout=10, retries=3,
+                 backoff=0.5, max_backoff=30, breaker=None, limit=None,
+                 sleep=time.sleep):
+        self.session = session if session is not None else requests.Session()
+        self.bucket = TokenBucket(rate) if rate else None
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limit = limit
+        self.sleep = sleep
+        self.retried = 0
+
+    def get(self, url, params=None):
+        """ Gets url, retrying timeouts, connection errors, 429 and 5xx
+        responses; raises once retries are exhausted """
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuit open, not calling {url}")
+            try:
+                response = self.request(url, params)
+            except (requests.Timeout, requests.ConnectionError):
+                if attempt == self.retries:
+                    raise
+                delay = self.delay(attempt)
+            else:
+                if response.status_code not in RETRY_STATUSES \
+                        or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                delay = self.retry_after(response) or self.delay(attempt)
+            self.retried += 1
+            self.sleep(delay)
+
+    def request(self, url, params):
+        """ Sends one rate limited request, recording its outcome """
+        if self.bucket is not None:
+            self.bucket.acquire()
+        if self.limit is not None:
+            self.limit.acquire()
+        ok = alive = False
+        start = time.perf_counter()
+        try:
+            response = self.session.get(
+                url, params=params, timeout=self.timeout)
+            ok = response.status_code < 400
+            # throttling means OMDb is up, backoff and the limit handle it
+            alive = ok or response.status_code == 429
+            return response
+        finally:
+            self.breaker.record(alive)
+            if self.limit is not None:
+                self.limit.release(time.perf_counter() - start, ok)
+
+    def delay(self, attempt):
+        """ Gets full-jitter exponential backoff for given attempt """
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def retry_after(self, response):
+        """ Gets Retry-After delay in seconds, None if not given """
+        try:
+            return min(self.max_backoff,
+                       float(response.headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            return None
+
+    def summary(self):
+        limit = f", concurrency {self.limit.limit}" if self.limit else ''
+        return f"Client: {self.retried} retries, circuit opened " \
+            f"{self.breaker.opened} times{limit}"
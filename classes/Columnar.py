@@ -0,0 +1,228 @@
+"""In-memory column store answering Repository queries with NumPy"""
+import threading
+
+import numpy as np
+
+from classes.DB import DERIVED_COLUMNS, MOVIE_COLUMNS, METRICS, SORT_KEYS
+from classes.DB import COMPARE_COLUMNS, HIGHSCORES
+from classes.Repository import Repository, memoized
+
+NUMERIC_COLUMNS = ('id', ) + tuple(column for (column, _) in DERIVED_COLUMNS)
+INTEGER_COLUMNS = ('id', ) + tuple(
+    column for (column, kind) in DERIVED_COLUMNS if kind == 'integer')
+
+
+def paginate(rows, limit=None, offset=None, after=None):
+    """ Applies keyset and offset/limit pagination to result rows """
+    if after is not None:
+        titles = [row[0] for row in rows]
+        rows = rows[titles.index(after) + 1:] if after in titles else []
+    start = offset or 0
+    end = None if limit is None else start + limit
+    return rows[start:end]
+
+
+def sqlite_order(value):
+    """ Sort key ordering values like SQLite: NULL, numbers, text """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+class StringColumn():
+    """ Dictionary-encoded column, codes follow SQLite value order """
+    def __init__(self, values):
+        self.categories = sorted(set(values), key=sqlite_order)
+        index = dict(
+            (value, code) for (code, value) in enumerate(self.categories))
+        self.codes = np.fromiter(
+            (index[value] for value in values), dtype=np.int32,
+            count=len(values))
+
+    def __getitem__(self, row):
+        return self.categories[self.codes[row]]
+
+
+class ColumnStore():
+    """ movies table loaded once into NumPy arrays """
+    def __init__(self, db):
+        self.load(db)
+
+    def load(self, db):
+        columns = NUMERIC_COLUMNS + tuple(
+            column for column in MOVIE_COLUMNS
+            if column not in NUMERIC_COLUMNS)
+        rows = db.get_columns(columns).fetchall()
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        self.columns = {}
+        for (column, data) in zip(columns, values):
+            if column in NUMERIC_COLUMNS:
+                self.columns[column] = np.array(
+                    [np.nan if value is None else value for value in data],
+                    dtype=np.float64)
+            else:
+                self.columns[column] = StringColumn(data)
+        self.size = len(rows)
+        self.titles = dict(
+            (str(title).lower(), row)
+            for (row, title) in enumerate(values[columns.index('title')]))
+
+    def value(self, column, row):
+        """ Gets stored value of column in given row """
+        data = self.columns[column]
+        if isinstance(data, StringColumn):
+            return data[row]
+        value = data[row]
+        if np.isnan(value):
+            return None
+        return int(value) if column in INTEGER_COLUMNS else float(value)
+
+    def rows(self, indexes, *columns):
+        """ Gets tuples of given columns for row indexes """
+        return [
+            tuple(self.value(column, row) for column in columns)
+            for row in indexes
+        ]
+
+    def sort_key(self, column):
+        """ Gets float array ordering rows like column in SQLite """
+        data = self.columns[column]
+        if isinstance(data, StringColumn):
+            return data.codes.astype(np.float64)
+        return data
+
+    def descending(self, column):
+        """ Gets row indexes sorted by column desc, NULLs last, ties by
+        id desc like the SQLite engine """
+        return np.lexsort((-self.columns['id'], -self.sort_key(column)))
+
+    def first(self, column, n, descending=True):
+        """ Gets indexes of first n rows ordered by column, NULLs last,
+        ties by id in the same direction, partitioning instead of
+        sorting all rows """
+        key = self.sort_key(column).astype(np.float64)
+        data = self.columns[column]
+        if isinstance(data, StringColumn) and data.categories \
+                and data.categories[0] is None:
+            key[data.codes == 0] = np.nan
+        ids = self.columns['id']
+        if descending:
+            (key, ids) = (-key, -ids)
+        nulls = np.isnan(key)
+        rows = np.flatnonzero(~nulls)
+        if 0 < n < len(rows):
+            cutoff = np.partition(key[rows], n - 1)[n - 1]
+            rows = rows[key[rows] <= cutoff]
+        rows = rows[np.lexsort((ids[rows], key[rows]))][:n]
+        if len(rows) < n:
+            missing = np.flatnonzero(nulls)
+            missing = missing[np.argsort(ids[missing])][:n - len(rows)]
+            rows = np.concatenate((rows, missing))
+        return rows
+
+    def top(self, column, n):
+        """ Gets indexes of n rows with highest positive column value,
+        ties going to the lower id """
+        key = self.columns[column]
+        candidates = np.flatnonzero(key > 0)
+        if len(candidates) > n:
+            cutoff = np.partition(key[candidates], -n)[-n]
+            candidates = candidates[key[candidates] >= cutoff]
+        order = np.lexsort(
+            (self.columns['id'][candidates], -key[candidates]))
+        return candidates[order][:n]
+
+    def find(self, titles):
+        """ Gets row indexes of given titles, case-insensitive """
+        rows = (self.titles.get(str(title).lower()) for title in titles)
+        return sorted(set(row for row in rows if row is not None))
+
+
+class ColumnarRepository(Repository):
+    """ Repository answering sort, filter, highscore and compare queries
+    from a NumPy column store; other calls go to SQLite """
+    def __init__(self, db, parser, **kwargs):
+        super().__init__(db, parser, **kwargs)
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """ Loads a new column store, replacing the current one """
+        with self.lock:
+            self.version = self.db.data_version()
+            self.current = ColumnStore(self.db)
+
+    @property
+    def store(self):
+        """ Gets column store, reloaded once the database changed, by
+        this process or another one, see DB.data_version """
+        version = self.db.data_version()
+        if version is not None and version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.current = ColumnStore(self.db)
+                    self.version = version
+        return self.current
+
+    @memoized
+    def get_sorted_by(self, sorter, **page):
+        column = 'cast' if sorter == 'movies.cast' else sorter
+        store = self.store
+        order = store.descending(SORT_KEYS.get(column, column))
+        return paginate(store.rows(order, 'title', column), **page)
+
+    @memoized
+    def get_top(self, sorter, n, descending=True):
+        column = 'cast' if sorter == 'movies.cast' else sorter
+        if column not in MOVIE_COLUMNS:
+            raise ValueError(f"Unknown sort column: {column}")
+        store = self.store
+        rows = store.first(
+            SORT_KEYS.get(column, column), max(int(n), 0), descending)
+        return store.rows(rows, 'title', column)
+
+    def get_sorted_by_runtime(self, **page):
+        return self.get_sorted_by('runtime', **page)
+
+    @memoized
+    def get_earned(self, **page):
+        store = self.store
+        rows = np.flatnonzero(store.columns['box_office_usd'] > 1e8)
+        return paginate(store.rows(rows, 'title', 'box_office'), **page)
+
+    @memoized
+    def get_awarded(self, **page):
+        store = self.store
+        rows = np.flatnonzero(store.columns['win_ratio'] > 0.8)
+        return paginate(store.rows(rows, 'title', 'awards'), **page)
+
+    @memoized
+    def get_nominated(self, **page):
+        store = self.store
+        columns = store.columns
+        rows = np.flatnonzero(
+            (columns['oscar_nominations'] > 0) & (columns['oscars'] == 0))
+        return paginate(store.rows(rows, 'title', 'awards'), **page)
+
+    @memoized
+    def get_highscores(self, metrics=HIGHSCORES, top=1):
+        store = self.store
+        highscores = []
+        for metric in metrics:
+            (shown, key) = METRICS[metric]
+            for row in store.top(key, top):
+                (title, value) = store.rows([row], 'title', shown)[0]
+                highscores.append((metric, title, value))
+        return highscores
+
+    @memoized
+    def get_compared(self, comparator, movies):
+        if comparator not in COMPARE_COLUMNS:
+            raise ValueError(f"Unknown comparator: {comparator}")
+        (shown, key) = COMPARE_COLUMNS[comparator]
+        store = self.store
+        rows = store.rows(store.find(movies), 'title', shown, key)
+        # stable over id order, NULLs last like the SQLite engine
+        return sorted(rows, key=lambda row: (row[2] is None, -(row[2] or 0)))
@@ -1,4 +1,109 @@
+import contextlib
+import functools
+import json
 import sqlite3 as sql
+import threading
+from classes.Movie import Movie
+from classes.HelperClasses import Parser, HighscoreAggregator
+from classes.Pool import ReaderPool
+
+# columns derived from the OMDb strings when a Movie is created
+DERIVED_COLUMNS = (
+    ('year_int', 'integer'),
+    ('runtime_minutes', 'integer'),
+    ('box_office_usd', 'integer'),
+    ('imdb_votes_int', 'integer'),
+    ('imdb_rating_real', 'real'),
+    ('wins', 'integer'),
+    ('nominations', 'integer'),
+    ('oscars', 'integer'),
+    ('oscar_nominations', 'integer'),
+    ('win_ratio', 'real'),
+)
+
+MOVIE_COLUMNS = (
+    'title', 'year', 'runtime', 'genre', 'director', 'cast', 'writer',
+    'language', 'country', 'awards', 'imdb_rating', 'imdb_votes',
+    'box_office'
+) + tuple(column for (column, _) in DERIVED_COLUMNS)
+
+# per-row state of the last OMDb fetch, written by Repository.populate
+FETCH_COLUMNS = (
+    ('fetched_at', 'real'),
+    ('fetch_status', 'text'),
+    ('payload_hash', 'text'),
+)
+FETCH_STATUSES = ('ok', 'not_found', 'error')
+
+# columns sorted by their typed counterpart
+SORT_KEYS = {
+    'year': 'year_int',
+    'runtime': 'runtime_minutes',
+    'box_office': 'box_office_usd',
+    'imdb_votes': 'imdb_votes_int',
+    'imdb_rating': 'imdb_rating_real',
+}
+
+# highscore metric: (shown column, ranking column)
+METRICS = {
+    'runtime': ('runtime', 'runtime_minutes'),
+    'box_office': ('box_office', 'box_office_usd'),
+    'awards': ('wins', 'wins'),
+    'nominations': ('nominations', 'nominations'),
+    'oscars': ('oscars', 'oscars'),
+    'imdb_rating': ('imdb_rating', 'imdb_rating_real'),
+    'imdb_votes': ('imdb_votes', 'imdb_votes_int'),
+    'year': ('year', 'year_int'),
+    'oscar_nominations': ('oscar_nominations', 'oscar_nominations'),
+    'win_ratio': ('win_ratio', 'win_ratio'),
+}
+HIGHSCORES = (
+    'runtime', 'box_office', 'awards', 'nominations', 'oscars', 'imdb_rating'
+)
+
+# compare option: (shown column, ranking column)
+COMPARE_COLUMNS = {
+    'imdb_rating': ('imdb_rating', 'imdb_rating_real'),
+    'box_office': ('box_office', 'box_office_usd'),
+    'runtime': ('runtime', 'runtime_minutes'),
+    'awards': ('awards', 'wins'),
+}
+
+# filter name: (lookup table, movie column, person role)
+FACETS = {
+    'actor': ('person', 'cast', 'actor'),
+    'director': ('person', 'director', 'director'),
+    'writer': ('person', 'writer', 'writer'),
+    'genre': ('genre', 'genre', None),
+    'language': ('language', 'language', None),
+    'country': ('country', 'country', None),
+}
+# filters without value: (condition on movies, shown column)
+FILTER_FLAGS = {
+    'awarded': ('win_ratio > :ratio', 'awards'),
+    'nominated': ('oscar_nominations > 0 and oscars = 0', 'awards'),
+    'earned': ('box_office_usd > 100000000', 'box_office'),
+}
+LOOKUP_TABLES = ('person', 'genre', 'language', 'country')
+MATCHES = ('exact', 'prefix', 'substring')
+
+# columns indexed by the movies_fts full-text table
+SEARCH_COLUMNS = ('title', 'cast', 'director', 'writer', 'genre', 'awards')
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS = ('off', 'normal', 'full', 'extra')
+
+UPSERT = "insert into movies ({}) values ({}) \
+    on conflict(title) do update set {}".format(
+        ', '.join(f'"{column}"' for column in MOVIE_COLUMNS),
+        ', '.join(':' + column for column in MOVIE_COLUMNS),
+        ', '.join(f'"{column}"=excluded."{column}"'
+                  for column in MOVIE_COLUMNS[1:])
+    )
+
+UPDATE = "update movies set {} where title=:title".format(
+    ', '.join(f'"{column}"=:{column}' for column in MOVIE_COLUMNS[1:])
+)
 
 
 def dict_from_class(cls):
@@ -6,16 +111,512 @@ def dict_from_class(cls):
     return dict((key, value) for (key, value) in cls.__dict__.items())
 
 
+def chunked(items, size):
+    """ Yields lists of at most size items """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def filter_column(name):
+    """ Gets movies column for a filter name, rejecting unknown names """
+    if name in FILTER_FLAGS:
+        return FILTER_FLAGS[name][1]
+    column = FACETS[name][1] if name in FACETS else name
+    if column not in MOVIE_COLUMNS:
+        raise ValueError(f"Unknown filter: {name}")
+    return column
+
+
+def sort_column(name):
+    """ Gets movies column for a sort name, rejecting unknown names """
+    column = 'cast' if name == 'movies.cast' else name
+    if column not in MOVIE_COLUMNS:
+        raise ValueError(f"Unknown sort column: {name}")
+    return column
+
+
+def keyset(order, descending):
+    """ Builds condition selecting rows after the movie titled :after
+    for (key, descending) order, ties by id; NULLs come last """
+    def anchor(key):
+        return f'(select {key} from movies where title=:after)'
+    condition = f"id {'<' if descending else '>'} {anchor('id')}"
+    for (key, desc) in reversed(order):
+        later = f"({key} {'<' if desc else '>'} {anchor(key)} \
+            or ({key} is null and {anchor(key)} is not null))"
+        condition = f"({later} or ({key} is {anchor(key)} and {condition}))"
+    return condition
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(columns, filters, sort, match, paged, after):
+    """ Builds SQL selecting columns of movies matching every filter,
+    ordered by (column, descending) sort keys, ties by id
+
+    Values are bound by filter position (:value0, :role0, ...), page
+    and keyset as :limit, :offset and :after. Cached, so calls with
+    the same shape reuse one SQL text and its prepared statement.
+    """
+    if match not in MATCHES:
+        raise ValueError(f"Unknown match: {match}")
+    conditions = []
+    for (number, name) in enumerate(filters):
+        column = filter_column(name)
+        if name in FILTER_FLAGS:
+            conditions.append(FILTER_FLAGS[name][0])
+        elif name not in FACETS or match == 'substring':
+            conditions.append(f'movies."{column}" like :value{number}')
+        else:
+            (table, _, _) = FACETS[name]
+            operator = f"like :value{number} escape '\\'" \
+                if match == 'prefix' else f"= :value{number}"
+            conditions.append(
+                f"id in (select movie_id from movie_{table} \
+                join {table} on {table}.id = movie_{table}.{table}_id \
+                where name {operator} and role = :role{number})"
+            )
+    order = [(f'"{SORT_KEYS.get(sort_column(column), sort_column(column))}"',
+              descending) for (column, descending) in sort]
+    descending = order[0][1] if order else False
+    if after:
+        conditions.append(keyset(order, descending))
+    clause = ', '.join(
+        f"{key} desc" if desc else f"{key} asc nulls last"
+        for (key, desc) in order)
+    clause += (', ' if order else '') + \
+        f"id {'desc' if descending else 'asc'}"
+    names = ', '.join(f'movies."{sort_column(column)}"' for column in columns)
+    query = f"select {names} from movies \
+        where {' and '.join(conditions) or '1'} order by {clause}"
+    if paged:
+        query += " limit :limit offset :offset"
+    return query
+
+
+def build_query(filters=(), sort=(), match='exact', limit=None, offset=None,
+                after=None, columns=None, ratio=0.8):
+    """ Builds (columns, sql, params) of one statement combining filters
+    with a multi-key sort
+
+    filters are (name, value) pairs: a FACETS name, a FILTER_FLAGS name
+    (value ignored, awarded uses ratio) or any movies column matched as
+    substring. sort are column names, highest first, or (column,
+    descending) pairs. Shown columns default to title, filtered and
+    sorted columns. Only whitelisted names reach the SQL text.
+    """
+    names = tuple(
+        'actor' if name == 'movies.cast' else name for (name, _) in filters)
+    keys = tuple(
+        (key, True) if isinstance(key, str) else tuple(key) for key in sort)
+    if columns is None:
+        columns = dict.fromkeys(
+            ['title'] + [filter_column(name) for name in names] +
+            [sort_column(column) for (column, _) in keys])
+    columns = tuple(sort_column(column) for column in columns)
+    paged = limit is not None or bool(offset)
+    query = compile_query(
+        columns, names, keys, match, paged, after is not None)
+    params = {}
+    for (number, (name, (_, value))) in enumerate(zip(names, filters)):
+        if name in FILTER_FLAGS:
+            continue
+        if name not in FACETS or match == 'substring':
+            params[f'value{number}'] = f'%{value}%'
+            continue
+        if match == 'prefix':
+            value = value.replace('\\', '\\\\').replace('%', '\\%') \
+                .replace('_', '\\_') + '%'
+        params[f'value{number}'] = value
+        params[f'role{number}'] = FACETS[name][2] or ''
+    if 'awarded' in names:
+        params['ratio'] = ratio
+    if after is not None:
+        params['after'] = after
+    if paged:
+        params['limit'] = -1 if limit is None else limit
+        params['offset'] = offset or 0
+    return columns, query, params
+
+
 class DB:
-    """ Database class """
-    def __init__(self):
-        self.conn = sql.connect('movies.sqlite')
-        self.cursor = self.conn.cursor()
+    """ Database class
+
+    Writes go through one connection, owned by the thread opening the
+    database. Reads of a database file run on a pool of read-only
+    connections in WAL mode, so queries from other threads and processes
+    go on while a populate or refresh writes; only reads by the owner
+    thread while it has uncommitted writes use the writer, so they see
+    them. Every statement gets a fresh cursor.
+    """
+    def __init__(self, path='movies.sqlite', journal_mode='wal',
+                 synchronous=None, check_same_thread=True, readers=4):
+        self.conn = sql.connect(path, check_same_thread=check_same_thread)
+        self.owner = threading.get_ident()
+        self.pool = None
+        self.set_pragmas(journal_mode, synchronous)
+        self.setup()
+        if readers and path not in ('', ':memory:'):
+            self.pool = ReaderPool(path, readers)
+
+    @property
+    def cursor(self):
+        """ Gets a fresh cursor of the writer connection """
+        return self.conn.cursor()
+
+    def read(self, query, params=()):
+        """ Runs read-only query, returns a cursor over its rows """
+        if self.pool is None or (self.conn.in_transaction
+                                 and threading.get_ident() == self.owner):
+            return self.conn.execute(query, params)
+        return self.pool.execute(query, params)
+
+    def data_version(self):
+        """ Gets token changing whenever stored data may have changed:
+        rows written by the writer plus the pool's PRAGMA data_version,
+        which moves on commits of other connections and processes. None
+        while the writer has uncommitted writes, which may be rolled back
+        """
+        if self.conn.in_transaction:
+            return None
+        return (self.conn.total_changes,
+                None if self.pool is None else self.pool.data_version())
+
+    def close(self):
+        """ Closes pooled readers and the writer, rolling back
+        uncommitted writes """
+        if self.pool is not None:
+            self.pool.close()
+        self.conn.close()
+
+    def instrument(self, instrumentation):
+        """ Records every later statement with given Instrumentation
+        from classes.Timings, returns it """
+        self.conn = instrumentation.connect(self.conn)
+        if self.pool is not None:
+            self.pool.wrap = instrumentation.connect
+        return instrumentation
+
+    def setup(self):
+        """ Creates movies table and unique title index """
+        self.conn.execute(
+            "create table if not exists movies \
+            ([ID] INTEGER PRIMARY KEY, [TITLE] text, [YEAR] integer, \
+            [RUNTIME] text, [GENRE] text, [DIRECTOR] text, [CAST] text, \
+            [WRITER] text, [LANGUAGE] text, [COUNTRY] text, [AWARDS] text, \
+            [IMDb_Rating] float, [IMDb_votes] integer, [BOX_OFFICE] integer)"
+        )
+        if not self.has_index('idx_movies_title'):
+            # duplicates can only predate the unique index, so the
+            # full-table dedup runs once instead of on every startup
+            self.conn.execute(
+                "delete from movies where id not in \
+                (select min(id) from movies group by title)"
+            )
+            self.conn.execute(
+                "create unique index idx_movies_title on movies (title)")
+        # compare looks titles up ignoring case
+        self.conn.execute(
+            "create index if not exists idx_movies_title_nocase \
+            on movies (title collate nocase)"
+        )
+        if self.add_columns(DERIVED_COLUMNS):
+            self.backfill_derived_columns()
+        for (column, _) in DERIVED_COLUMNS:
+            self.conn.execute(
+                f"create index if not exists idx_movies_{column} \
+                on movies ({column})"
+            )
+        if self.add_columns(FETCH_COLUMNS):
+            # rows populated before fetch state was recorded count as
+            # fetched long ago, so only a staleness refresh refetches them
+            self.conn.execute(
+                "update movies set fetch_status='ok', fetched_at=0 \
+                where year is not null"
+            )
+        if self.create_lookup_tables():
+            self.index_all()
+        self.fts = self.create_search_index()
+        if self.create_highscores_table():
+            self.set_highscores(self.compute_highscores())
+        self.conn.commit()
+
+    def create_highscores_table(self):
+        """ Creates highscores table kept current by triggers
+
+        Holds the top movie per metric. Inserts and updates that beat
+        the holder replace it; updating or deleting the holder itself
+        recomputes the metric with an indexed lookup. Triggers avoid
+        OR REPLACE, which an outer upsert would override. Returns True
+        if the table or any trigger was missing, e.g. after an
+        interrupted bulk_load, so stored highscores may be stale.
+        """
+        (existing, ) = self.conn.execute(
+            "select count(*) from sqlite_master where name in \
+            ('highscores', 'highscores_insert', 'highscores_update', \
+            'highscores_delete')"
+        ).fetchone()
+        self.conn.execute(
+            "create table if not exists highscores \
+            (metric text primary key, movie_id integer, title text, \
+            value, score)"
+        )
+        challenge, recompute = [], []
+        for (metric, (shown, key)) in METRICS.items():
+            challenge.append(
+                f"delete from highscores where metric='{metric}' \
+                and (new.{key} > score \
+                or (new.{key} = score and new.id < movie_id)); \
+                insert into highscores \
+                select '{metric}', new.id, new.title, new.{shown}, new.{key} \
+                where new.{key} > 0 and not exists \
+                (select 1 from highscores where metric='{metric}');"
+            )
+            recompute.append(
+                f"delete from highscores \
+                where metric='{metric}' and movie_id=old.id; \
+                insert into highscores \
+                select '{metric}', id, title, {shown}, {key} from movies \
+                where {key} > 0 and not exists \
+                (select 1 from highscores where metric='{metric}') \
+                order by {key} desc, id limit 1;"
+            )
+        self.conn.execute(
+            f"create trigger if not exists highscores_insert \
+            after insert on movies begin {' '.join(challenge)} end"
+        )
+        self.conn.execute(
+            f"create trigger if not exists highscores_update \
+            after update on movies begin \
+            {' '.join(recompute)} {' '.join(challenge)} end"
+        )
+        self.conn.execute(
+            f"create trigger if not exists highscores_delete \
+            after delete on movies begin {' '.join(recompute)} end"
+        )
+        return existing < 4
+
+    def compute_highscores(self, metrics=tuple(METRICS), indexed=False):
+        """ Recomputes highscores with a full scan of movies, or from
+        the top candidate of each metric index """
+        cursor = self.get_metrics(metrics, top=1 if indexed else None)
+        return HighscoreAggregator(metrics).consume(cursor).rows()
+
+    def drop_highscores_triggers(self):
+        """ Drops per-row highscores triggers, e.g. for a bulk load """
+        for event in ('insert', 'update', 'delete'):
+            self.conn.execute(f"drop trigger if exists highscores_{event}")
+
+    def set_highscores(self, rows):
+        """ Replaces highscores with (metric, id, title, value, score) """
+        self.conn.execute("delete from highscores")
+        self.conn.executemany(
+            "insert into highscores values (?, ?, ?, ?, ?)", rows)
+
+    def has_fts5(self):
+        """ Checks whether this SQLite build has the FTS5 module """
+        (used, ) = self.conn.execute(
+            "select sqlite_compileoption_used('ENABLE_FTS5')").fetchone()
+        return bool(used)
+
+    def create_search_index(self):
+        """ Creates FTS5 table kept in sync with movies by triggers
+
+        Returns False if this SQLite build has no FTS5. The triggers of
+        an index built with FTS5 are then dropped, since they would fail
+        every write; the next open with FTS5 recreates them and rebuilds
+        the index.
+        """
+        columns = ', '.join(f'"{column}"' for column in SEARCH_COLUMNS)
+        new = ', '.join(f'new."{column}"' for column in SEARCH_COLUMNS)
+        old = ', '.join(f'old."{column}"' for column in SEARCH_COLUMNS)
+        (existing, ) = self.conn.execute(
+            "select count(*) from sqlite_master where name in \
+            ('movies_fts', 'movies_fts_insert', 'movies_fts_delete', \
+            'movies_fts_update')"
+        ).fetchone()
+        fts = self.has_fts5()
+        if existing == 4 and fts:
+            return True
+        try:
+            if fts:
+                self.conn.execute(
+                    f"create virtual table if not exists movies_fts \
+                    using fts5({columns}, content='movies', \
+                    content_rowid='id', \
+                    tokenize='unicode61 remove_diacritics 2')"
+                )
+        except sql.OperationalError:
+            fts = False
+        if not fts:
+            for event in ('insert', 'delete', 'update'):
+                self.conn.execute(f"drop trigger if exists movies_fts_{event}")
+            return False
+        self.conn.execute(
+            f"create trigger if not exists movies_fts_insert \
+            after insert on movies begin \
+            insert into movies_fts (rowid, {columns}) \
+            values (new.id, {new}); end"
+        )
+        self.conn.execute(
+            f"create trigger if not exists movies_fts_delete \
+            after delete on movies begin \
+            insert into movies_fts (movies_fts, rowid, {columns}) \
+            values ('delete', old.id, {old}); end"
+        )
+        self.conn.execute(
+            f"create trigger if not exists movies_fts_update \
+            after update of {columns} on movies begin \
+            insert into movies_fts (movies_fts, rowid, {columns}) \
+            values ('delete', old.id, {old}); \
+            insert into movies_fts (rowid, {columns}) \
+            values (new.id, {new}); end"
+        )
+        self.conn.execute(
+            "insert into movies_fts (movies_fts) values ('rebuild')")
+        return True
+
+    def create_lookup_tables(self):
+        """ Creates name and link tables, returns True if newly created """
+        (existing, ) = self.conn.execute(
+            "select count(*) from sqlite_master \
+            where type='table' and name='movie_person'"
+        ).fetchone()
+        for table in LOOKUP_TABLES:
+            self.conn.execute(
+                f"create table if not exists {table} \
+                (id integer primary key, name text collate nocase unique)"
+            )
+            self.conn.execute(
+                f"create table if not exists movie_{table} \
+                (movie_id integer not null, {table}_id integer not null, \
+                role text not null default '', \
+                primary key ({table}_id, role, movie_id)) without rowid"
+            )
+            self.conn.execute(
+                f"create index if not exists idx_movie_{table}_movie \
+                on movie_{table} (movie_id)"
+            )
+        return not existing
+
+    def index_movie(self, movie):
+        """ Fills lookup tables for movie from its comma lists """
+        self.index_movies([movie])
+
+    def index_movies(self, movies):
+        """ Fills lookup tables for stored movies from their comma lists,
+        with one executemany per table """
+        parser = Parser()
+        latest = dict((movie.title, movie) for movie in movies)
+        ids = {}
+        for chunk in chunked(list(latest), 500):
+            placeholders = ', '.join('?' for _ in chunk)
+            ids.update(self.conn.execute(
+                f"select title, id from movies \
+                where title in ({placeholders})", chunk
+            ).fetchall())
+        names = dict((table, set()) for table in LOOKUP_TABLES)
+        links = dict((table, []) for table in LOOKUP_TABLES)
+        for movie in latest.values():
+            movie_id = ids.get(movie.title)
+            if movie_id is None:
+                continue
+            for (table, column, role) in FACETS.values():
+                for name in parser.split_list(getattr(movie, column)):
+                    names[table].add(name)
+                    links[table].append((movie_id, role or '', name))
+        movie_ids = [(movie_id, ) for movie_id in ids.values()]
+        for table in LOOKUP_TABLES:
+            self.conn.executemany(
+                f"delete from movie_{table} where movie_id=?", movie_ids)
+            self.conn.executemany(
+                f"insert or ignore into {table} (name) values (?)",
+                [(name, ) for name in names[table]]
+            )
+            self.conn.executemany(
+                f"insert or ignore into movie_{table} \
+                (movie_id, {table}_id, role) \
+                select ?, id, ? from {table} where name=?",
+                links[table]
+            )
+
+    def index_all(self):
+        """ Fills lookup tables for all stored movies """
+        rows = self.conn.execute(
+            'select title, director, "cast", writer, genre, language, \
+            country from movies'
+        ).fetchall()
+        self.index_movies([
+            Movie(
+                title=title, director=director, cast=cast, writer=writer,
+                genre=genre, language=language, country=country
+            )
+            for (title, director, cast, writer, genre, language, country)
+            in rows
+        ])
+
+    def has_index(self, name):
+        """ Checks whether index with given name exists """
+        return self.conn.execute(
+            "select 1 from sqlite_master where type='index' and name=?",
+            (name, )
+        ).fetchone() is not None
+
+    def add_columns(self, columns):
+        """ Adds missing columns to movies table, returns added names """
+        existing = set(
+            row[1].lower() for row in
+            self.conn.execute("pragma table_info(movies)").fetchall()
+        )
+        added = []
+        for (column, kind) in columns:
+            if column not in existing:
+                self.conn.execute(
+                    f"alter table movies add column {column} {kind}")
+                added.append(column)
+        return added
+
+    def backfill_derived_columns(self):
+        """ Derives columns for rows stored before they existed """
+        rows = self.conn.execute(
+            "select id, year, runtime, box_office, imdb_votes, imdb_rating, \
+            awards from movies"
+        ).fetchall()
+        params = []
+        for (id, year, runtime, box_office, votes, rating, awards) in rows:
+            movie = Movie(
+                year=year, runtime=runtime, box_office=box_office,
+                imdb_votes=votes, imdb_rating=rating, awards=awards
+            )
+            values = dict_from_class(movie)
+            values['id'] = id
+            params.append(values)
+        self.conn.executemany(
+            "update movies set {} where id=:id".format(', '.join(
+                f'{column}=:{column}' for (column, _) in DERIVED_COLUMNS)),
+            params
+        )
+
+    def set_pragmas(self, journal_mode=None, synchronous=None):
+        """ Tunes journal and synchronous settings, e.g. for bulk loads """
+        if journal_mode is not None:
+            if journal_mode.lower() not in JOURNAL_MODES:
+                raise ValueError(f"Unknown journal mode: {journal_mode}")
+            self.conn.execute(f"pragma journal_mode={journal_mode}")
+        if synchronous is not None:
+            if synchronous.lower() not in SYNCHRONOUS:
+                raise ValueError(f"Unknown synchronous mode: {synchronous}")
+            self.conn.execute(f"pragma synchronous={synchronous}")
 
     def insert(self, movie):
         """ Inserts movie title to database"""
         params = (movie, )
-        return self.cursor.execute(
+        return self.conn.execute(
             "insert into movies ('title') \
             select :title where not exists \
             (select 1 from movies where title=:title)", params
@@ -24,164 +625,254 @@ class DB:
     def update(self, movie):
         """ Updates movie data in database"""
         params = dict_from_class(movie)
-        return self.cursor.execute(
-            "update movies set year=:year, runtime=:runtime, \
-            genre=:genre, director=:director, cast=:cast, \
-            writer=:writer, language=:language, country=:country, \
-            awards=:awards, imdb_rating=:imdb_rating, imdb_votes=:imdb_votes, \
-            box_office=:box_office where title=:title", params
-            )
+        cursor = self.conn.execute(UPDATE, params)
+        self.index_movie(movie)
+        return cursor
+
+    def upsert(self, movie):
+        """ Inserts movie or updates it if title already exists """
+        cursor = self.conn.execute(UPSERT, dict_from_class(movie))
+        self.index_movie(movie)
+        return cursor
+
+    def upsert_many(self, movies, chunk_size=500):
+        """ Upserts movies in chunks, committing once per chunk """
+        count = 0
+        for chunk in chunked(movies, chunk_size):
+            if not self.conn.in_transaction:
+                self.conn.execute("begin")
+            self.conn.executemany(UPSERT, map(dict_from_class, chunk))
+            self.index_movies(chunk)
+            self.conn.commit()
+            count += len(chunk)
+        return count
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """ Runs the block without per-row highscores triggers, which
+        cost more than one recompute from the metric indexes at the end
+
+        The triggers are dropped and recreated once per load, so the
+        schema of pooled readers changes only twice. If the process dies
+        in between, setup recomputes highscores on the next open.
+        """
+        self.drop_highscores_triggers()
+        self.conn.commit()
+        try:
+            yield self
+        finally:
+            self.set_highscores(self.compute_highscores(indexed=True))
+            self.create_highscores_table()
+            self.conn.commit()
 
     def get_all_titles(self):
         """ Gets all movie titles from database """
-        return self.cursor.execute(
+        return self.read(
             "select title from movies"
         )
 
+    def get_titles_to_fetch(self, stale_before=None):
+        """ Gets (title, payload_hash) of movies never fetched, failed
+        or last fetched before stale_before timestamp """
+        return self.read(
+            "select title, payload_hash from movies \
+            where fetched_at is null or fetch_status is not 'ok' \
+            or fetched_at < :stale_before order by id",
+            dict(stale_before=stale_before)
+        )
+
+    def set_fetch_state(self, states):
+        """ Records (title, status, fetched_at, payload_hash) of fetches,
+        keeping the previous hash when a fetch brought no payload """
+        self.conn.executemany(
+            "update movies set fetch_status=?2, fetched_at=?3, \
+            payload_hash=coalesce(?4, payload_hash) where title=?1",
+            states
+        )
+
+    def get_columns(self, columns):
+        """ Gets given columns of all movies in id order """
+        names = ', '.join(f'"{column}"' for column in columns)
+        return self.read(
+            f"select {names} from movies order by id")
+
     def get_all(self):
         """ Gets all records from database """
-        return self.cursor.execute(
+        return self.read(
             "select * from movies"
         )
 
     def get_by_title(self, movie):
         """ Gets movie by title """
         params = dict_from_class(movie)
-        return self.cursor.execute(
+        return self.read(
             "select * from movies where title=:title", params
         )
 
-    def get_sorted_by(self, column):
+    def get_sorted_by(self, column, limit=None, offset=None, after=None):
         """ Gets movies sorted by given column """
-        query = ""f"select title, {column} \
-            from movies order by {column} desc"""
-        return self.cursor.execute(query)
+        return self.find(sort=(column, ), columns=('title', column),
+                         limit=limit, offset=offset, after=after)
 
-    def get_sorted_by_runtime(self):
-        """ Gets movies sorted by given column """
-        def str_to_int(item):
-            """ Regex helper function"""
-            s = ''
-            try:
-                i = (s.join(filter(lambda x: x.isdigit(), item)))
-            except TypeError:
-                i = 0
-            return int(i) if i else 0
-        self.conn.create_function("STR_TO_INT", 1, str_to_int)
-        return self.cursor.execute(
-            "select title, runtime \
-            from movies order by cast(str_to_int(runtime) as int) desc"
-        )
-
-    def get_filtered_by_director(self, director):
-        """ Gets movies filtered by director """
-        param = ('%'+director+'%',)
-        return self.cursor.execute(
-            "select title, director \
-            from movies where director like ?", param
+    def find(self, filters=(), sort=(), match='exact', limit=None,
+             offset=None, after=None, columns=None):
+        """ Gets movies matching all filters, sorted by given columns,
+        with one statement, see build_query """
+        (_, query, params) = build_query(
+            filters, sort, match, limit, offset, after, columns)
+        return self.read(query, params)
+
+    def get_top(self, column, n, descending=True):
+        """ Gets first n movies ordered by given column, NULLs last
+
+        Order and limit run in SQLite: typed and title columns walk their
+        index and stop after n rows, other columns are scanned keeping
+        only the best n rows in SQLite's sorter. Ties go to the higher
+        id descending and the lower id ascending.
+        """
+        if column.replace('movies.', '') not in MOVIE_COLUMNS:
+            raise ValueError(f"Unknown sort column: {column}")
+        key = SORT_KEYS.get(column, column)
+        params = dict(n=max(int(n), 0))
+        if descending:
+            return self.read(
+                f"select title, {column} from movies \
+                order by {key} desc, id desc limit :n", params
+            )
+        # NULLs sort first ascending, so they are read after the others
+        return self.read(
+            f"select * from (select title, {column} from movies \
+            where {key} is not null order by {key}, id limit :n) \
+            union all select * from (select title, {column} from movies \
+            where {key} is null order by id limit :n) limit :n", params
         )
 
-    def get_filtered_by_actor(self, actor):
+    def get_sorted_by_runtime(self, limit=None, offset=None, after=None):
+        """ Gets movies sorted by runtime """
+        return self.get_sorted_by('runtime', limit, offset, after)
+
+    def get_filtered_by_director(self, director, match='exact', **page):
+        """ Gets movies filtered by director """
+        return self.get_filtered_by('director', director, match, **page)
+
+    def get_filtered_by_actor(self, actor, match='exact', **page):
         """ Gets movies filtered by actor """
-        param = ('%'+actor+'%', )
-        return self.cursor.execute(
-            "select title, movies.cast \
-            from movies where movies.cast like ?", param
-        )
+        return self.get_filtered_by('actor', actor, match, **page)
 
-    def get_filtered_by(self, filter, value):
-        """ Gets movies filtered by given value """
-        params = ('%'+value+'%', )
-        return self.cursor.execute(
-            f"select title, {filter} \
-            from movies where {filter} like ?", params
-        )
+    def get_filtered_by(self, filter, value, match='exact', limit=None,
+                        offset=None, after=None):
+        """ Gets movies filtered by given value
 
-    def get_oscar_nominated(self):
-        """ Gets movies nominated to Oscar """
-        return self.cursor.execute(
-            "select title, awards \
-            from movies where awards like 'nominated%'"
-        )
+        exact and prefix matches are indexed lookups of whole names in
+        the person/genre/language/country tables, substring is a LIKE
+        scan over the comma-joined movies column.
+        """
+        if filter == 'movies.cast':
+            filter = 'actor'
+        return self.find(((filter, value), ), match=match,
+                         columns=('title', filter_column(filter)),
+                         limit=limit, offset=offset, after=after)
 
-    def get_awarded(self):
-        """ Gets movies titles with awards """
-        return self.cursor.execute(
-            "select title, awards from movies"
+    def search(self, terms, limit=20):
+        """ Full-text search over title, cast, crew, genre and awards
+
+        Every term has to match, results are ranked by bm25.
+        """
+        if not self.fts:
+            raise sql.OperationalError("FTS5 is not available")
+        query = ' '.join(
+            '"' + term.replace('"', '""') + '"' for term in terms.split())
+        params = (query, limit)
+        return self.read(
+            "select title, snippet(movies_fts, -1, '[', ']', '...', 8) \
+            from movies_fts where movies_fts match ? \
+            order by rank limit ?", params
         )
 
-    def get_boxoffice_over_hundred_million(self):
+    def get_oscar_nominated(self, **page):
+        """ Gets movies nominated to Oscar that did not win any """
+        return self.find((('nominated', None), ), **page)
+
+    def get_awarded(self, ratio=0.8, limit=None, offset=None, after=None):
+        """ Gets movies that won more than ratio of their nominations """
+        (_, query, params) = build_query(
+            (('awarded', None), ), limit=limit, offset=offset, after=after,
+            ratio=ratio)
+        return self.read(query, params)
+
+    def get_boxoffice_over_hundred_million(self, **page):
         """ Gets movies with income over $100 mln """
-        def str_to_int(item):
-            """ Regex helper function"""
-            s = ''
-            try:
-                i = (s.join(filter(lambda x: x.isdigit(), item)))
-            except TypeError:
-                i = 0
-            return int(i) if i else 0
-        self.conn.create_function("STR_TO_INT", 1, str_to_int)
-        return self.cursor.execute(
-            "select title, box_office \
-            from movies \
-            where cast(str_to_int(box_office) as int) > '100000000'"
-        )
-
-    def get_by_language(self, language):
+        return self.find((('earned', None), ), **page)
+
+    def get_by_language(self, language, match='exact', **page):
         """ Gets movies filtered by language """
-        param = ('%'+language+'%', )
-        return self.cursor.execute(
-            "select title, language \
-            from movies where language like ?", param
-        )
+        return self.get_filtered_by('language', language, match, **page)
 
     def get_imdb_rating(self, movie1, movie2):
         """ Gets two given movies with rating """
-        params = (movie1, movie2, )
-        return self.cursor.execute(
-            "select title, imdb_rating \
-            from \
-            (select title, imdb_rating \
-            from movies where title like ? \
-            union select title, imdb_rating \
-            from movies where title like ?)", params
-        )
+        return self.get_compared('imdb_rating', (movie1, movie2))
 
     def get_box_office(self, movie1, movie2):
         """ Gets two given movies with box office """
-        params = (movie1, movie2, )
-        return self.cursor.execute(
-            "select title, box_office \
-            from \
-            (select title, box_office \
-            from movies where title like ? \
-            union select title, box_office \
-            from movies where title like ?)", params
-        )
+        return self.get_compared('box_office', (movie1, movie2))
 
     def get_runtime(self, movie1, movie2):
         """ Gets two given movies with box runtime """
-        params = (movie1, movie2, )
-        return self.cursor.execute(
-            "select title, runtime \
-            from movies where title like ? \
-            union select title, runtime \
-            from movies where title like ?", params
+        return self.get_compared('runtime', (movie1, movie2))
+
+    def get_metrics(self, metrics, top=None):
+        """ Gets id, title and (shown, key) columns for metrics
+
+        With top, only candidates ranked in the top of any metric are
+        read, using the index on each ranking column.
+        """
+        columns = ', '.join(
+            f'{METRICS[metric][0]}, {METRICS[metric][1]}'
+            for metric in metrics)
+        if top is None:
+            return self.read(
+                f"select id, title, {columns} from movies")
+        candidates = ' union '.join(
+            f"select id from (select id from movies \
+            where {METRICS[metric][1]} > 0 \
+            order by {METRICS[metric][1]} desc, id limit {int(top)})"
+            for metric in metrics)
+        return self.read(
+            f"select id, title, {columns} from movies \
+            where id in ({candidates})"
+        )
+
+    def get_highscores(self, metrics):
+        """ Gets stored top movie for given metrics """
+        placeholders = ', '.join('?' for _ in metrics)
+        return self.read(
+            f"select metric, title, value from highscores \
+            where metric in ({placeholders})", tuple(metrics)
         )
 
-    def get_for_highscores(self):
-        """ Gets movies with columns for highscores """
-        return self.cursor.execute(
-            "select title, runtime, box_office, awards, imdb_rating \
-            from movies"
+    def get_highscores_table(self):
+        """ Gets all highscores rows as stored """
+        return self.read(
+            "select metric, movie_id, title, value, score \
+            from highscores order by metric"
         )
 
     def get_awards(self, movie1, movie2):
         """ Gets two given movies with awards """
-        params = (movie1, movie2, )
-        return self.cursor.execute(
-            "select title, awards \
-            from movies where title like ? \
-            union select title, awards \
-            from movies where title like ?", params
+        return self.get_compared('awards', (movie1, movie2))
+
+    def get_compared(self, comparator, titles):
+        """ Gets (title, shown value, ranking value) of movies with given
+        titles, ignoring case, best first
+
+        The titles are bound as one JSON array, so any number of them is
+        resolved by a single statement probing the nocase title index.
+        """
+        if comparator not in COMPARE_COLUMNS:
+            raise ValueError(f"Unknown comparator: {comparator}")
+        (shown, key) = COMPARE_COLUMNS[comparator]
+        return self.read(
+            f"select title, {shown}, {key} from movies \
+            where title collate nocase in (select value from json_each(?)) \
+            order by {key} desc, id", (json.dumps(list(titles)), )
         )
@@ -0,0 +1,94 @@
+"""Streaming export of query results to CSV, JSON lines or Parquet"""
+import csv
+import gzip
+import json
+
+from classes.DB import DERIVED_COLUMNS, chunked
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+BUFFER_SIZE = 1024 * 1024
+COLUMN_TYPES = dict(DERIVED_COLUMNS, id='integer')
+
+
+def get_format(path):
+    """ Gets export format from file extension """
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = name.rsplit('.', 1)[-1].lower()
+    if extension not in FORMATS:
+        raise ValueError(
+            f"Unknown export format for {path}, use one of {FORMATS}")
+    if extension == 'parquet' and name != path:
+        # row groups are compressed already, .gz would not be gzip
+        raise ValueError(f"Parquet files are zstd-compressed, drop .gz "
+                         f"from {path}")
+    return extension
+
+
+def open_text(path):
+    """ Opens buffered text file, gzipped if path ends with .gz """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='',
+                buffering=BUFFER_SIZE)
+
+
+def write_csv(rows, columns, path, chunk_size):
+    with open_text(path) as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for chunk in chunked(rows, chunk_size):
+            writer.writerows(chunk)
+
+
+def write_jsonl(rows, columns, path, chunk_size):
+    with open_text(path) as f:
+        for chunk in chunked(rows, chunk_size):
+            f.writelines(
+                json.dumps(dict(zip(columns, row))) + '\n' for row in chunk)
+
+
+def write_parquet(rows, columns, path, chunk_size):
+    """ Writes one zstd-compressed row group per chunk (needs pyarrow)
+
+    Typed columns keep their numeric type, everything else is stored
+    as text since OMDb columns mix numbers and strings like 'N/A'.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {'integer': pa.int64(), 'real': pa.float64()}
+    schema = pa.schema(
+        (column, types.get(COLUMN_TYPES.get(column), pa.string()))
+        for column in columns)
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for chunk in chunked(rows, chunk_size):
+            arrays = [
+                pa.array(
+                    values if field.type != pa.string() else
+                    [None if value is None else str(value)
+                     for value in values],
+                    type=field.type)
+                for (field, values) in zip(schema, zip(*chunk))
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'parquet': write_parquet,
+}
+
+
+def export(rows, columns, path, format=None, chunk_size=1000):
+    """ Streams rows to file in fixed-size chunks, returns row count """
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    format = format or get_format(path)
+    WRITERS[format](counted(rows), list(columns), path, chunk_size)
+    return count
@@ -1,4 +1,7 @@
+import heapq
+import math
 import re
+import time
 
 
 class Parser:
@@ -23,6 +26,13 @@ class Parser:
         oscars = int(m.group(2)) if m is not None else 0
         return oscars
 
+    def get_oscar_nominations(self, data):
+        """ Gets oscar nominations, at least the oscars won """
+        p = r'\bNominated for (\d+) Oscars?\b'
+        m = re.search(p, data)
+        nominations = int(m.group(1)) if m is not None else 0
+        return max(nominations, self.get_oscars(data))
+
     def str_to_int(self, string):
         """ Parse string to int """
         s = ''
@@ -32,91 +42,110 @@ class Parser:
             i = 0
         return int(i) if i else 0
 
+    def parse_int(self, value):
+        """ Parse string like '$1,234' or '117 min' to int, None if N/A """
+        if isinstance(value, (int, float)):
+            return int(value)
+        digits = ''.join(filter(str.isdigit, str(value or '')))
+        return int(digits) if digits else None
 
-class Highscore():
+    def parse_float(self, value):
+        """ Parse string to float, None if N/A """
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def split_list(self, value):
+        """ Splits OMDb comma list, dropping notes like '(screenplay)' """
+        names = []
+        for part in str(value or '').split(','):
+            name = part.split('(')[0].strip()
+            if name and name != 'N/A' and name not in names:
+                names.append(name)
+        return names
+
+    def parse_year(self, value):
+        """ Parse first year from string like '2010–2015' """
+        m = re.search(r'\d{4}', str(value or ''))
+        return int(m.group(0)) if m is not None else None
+
+
+class HighscoreAggregator():
+    """ Single pass top-N per metric over streamed rows
+
+    Rows are (id, title, shown_1, key_1, ..., shown_n, key_n) for the
+    given metrics. Ties on key go to the lower id, i.e. the movie that
+    was stored first, so results are deterministic.
+    """
+    def __init__(self, metrics, top=1):
+        self.metrics = list(metrics)
+        self.top = top
+        self.heaps = dict((metric, []) for metric in self.metrics)
+
+    def add(self, row):
+        (id, title) = row[:2]
+        for (i, metric) in enumerate(self.metrics):
+            shown, key = row[2 + 2 * i], row[3 + 2 * i]
+            if not key:
+                continue
+            entry = (key, -id, title, shown)
+            heap = self.heaps[metric]
+            if len(heap) < self.top:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    def consume(self, cursor, chunk_size=1000):
+        """ Reads cursor in chunks, keeping only top rows in memory """
+        rows = cursor.fetchmany(chunk_size)
+        while rows:
+            for row in rows:
+                self.add(row)
+            rows = cursor.fetchmany(chunk_size)
+        return self
+
+    def rows(self):
+        """ Gets (metric, id, title, value, key) rows, best first """
+        return [
+            (metric, -id, title, shown, key)
+            for metric in self.metrics
+            for (key, id, title, shown) in sorted(
+                self.heaps[metric], reverse=True)
+        ]
+
+    def results(self):
+        """ Gets (metric, title, value) rows, best first per metric """
+        return [
+            (metric, title, shown)
+            for (metric, _, title, shown, _) in self.rows()
+        ]
+
+
+def percentile(values, p):
+    """ Gets p-th percentile of given values (nearest rank) """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+class Throughput():
+    """ Collects fetch latencies and reports throughput summary """
     def __init__(self):
-        self.highest_runtime = ('', '')
-        self.highest_box_office = ('', '')
-        self.oscar_highscore = ('', 0)
-        self.nominations_highscore = ('', 0)
-        self.awards_highscore = ('', 0)
-        self.highest_rating = ('', 0.0)
-        self.parser = Parser()
-
-    def get_highest_runtime(self, movies):
-        highest_runtime = self.highest_runtime
-        for movie in movies:
-            if movie[1] is not None and \
-                    int(self.parser.str_to_int(movie[1])) > \
-                    int(self.parser.str_to_int(highest_runtime[1])):
-                highest_runtime = (movie[0], movie[1])
-        return highest_runtime
-
-    def get_highest_box_office(self, movies):
-        highest_box_office = self.highest_box_office
-        for movie in movies:
-            if movie[2] is not None and \
-                    int(self.parser.str_to_int(movie[2])) > \
-                    int(self.parser.str_to_int(highest_box_office[1])):
-                highest_box_office = (movie[0], movie[2])
-        return highest_box_office
-
-    def get_highest_imdb_rating(self, movies):
-        highest_rating = self.highest_rating
-        for movie in movies:
-            rating = movie[4] if movie[4] is not None else 0
-            if rating > int(highest_rating[1]):
-                highest_rating = (movie[0], rating)
-        return highest_rating
-
-    def get_oscars_highscore(self, movies):
-        """ Helper function getting highest oscar wins """
-        oscar_highscore = self.oscar_highscore
-        for movie in movies:
-            oscars = self.parser.get_oscars(movie[3]) \
-                if movie[3] is not None else 0
-            if oscars > int(oscar_highscore[1]):
-                oscar_highscore = (movie[0], oscars)
-        return oscar_highscore
-
-    def get_nominations_highscore(self, movies):
-        """ Helper function getting nominations highscore """
-        nominations_highscore = self.nominations_highscore
-        for movie in movies:
-            nominations = self.parser.get_nominations(movie[3]) \
-                if movie[3] is not None else 0
-            if nominations > int(nominations_highscore[1]):
-                nominations_highscore = (movie[0], nominations)
-        return nominations_highscore
-
-    def get_awards_highscore(self, movies):
-        """ Helper function getting awards highscore """
-        awards_highscore = self.awards_highscore
-        for movie in movies:
-            awards = self.parser.get_awards(movie[3]) \
-                if movie[3] is not None else 0
-            if awards > int(awards_highscore[1]):
-                awards_highscore = (movie[0], awards)
-        return awards_highscore
-
-
-class Compare():
-    def __init__(self, movies):
-        self.parser = Parser()
-        self.movie1 = movies[0]
-        self.movie2 = movies[1]
-
-    def compare(self):
-        pass
-
-
-class CompareNumeric(Compare):
-    def compare(self):
-        return self.movie1[0] if self.parser.str_to_int(self.movie1[1]) > \
-            self.parser.str_to_int(self.movie2[1]) else self.movie2[0]
-
-
-class CompareAwards(Compare):
-    def compare(self):
-        return self.movie1[0] if self.parser.get_awards(self.movie1[1]) > \
-            self.parser.get_awards(self.movie2[1]) else self.movie2[0]
+        self.latencies = []
+        self.start = time.perf_counter()
+
+    def add(self, latency):
+        self.latencies.append(latency)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        count = len(self.latencies)
+        rate = count / elapsed if elapsed > 0 else 0.0
+        p50 = percentile(self.latencies, 50) * 1000
+        p99 = percentile(self.latencies, 99) * 1000
+        return f"Fetched {count} titles in {elapsed:.2f}s " \
+            f"({rate:.1f} titles/sec), " \
+            f"latency p50 {p50:.0f} ms, p99 {p99:.0f} ms"
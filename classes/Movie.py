@@ -1,3 +1,6 @@
+from classes.HelperClasses import Parser
+
+
 class Movie:
     """ Movie class """
 
@@ -20,13 +23,28 @@ class Movie:
         self.imdb_rating = imdb_rating
         self.imdb_votes = imdb_votes
         self.box_office = box_office
+        parser = Parser()
+        self.year_int = parser.parse_year(year)
+        self.runtime_minutes = parser.parse_int(runtime)
+        self.box_office_usd = parser.parse_int(box_office)
+        self.imdb_votes_int = parser.parse_int(imdb_votes)
+        self.imdb_rating_real = parser.parse_float(imdb_rating)
+        text = awards if isinstance(awards, str) else ''
+        self.wins = parser.get_awards(text)
+        self.nominations = parser.get_nominations(text)
+        self.oscars = parser.get_oscars(text)
+        self.oscar_nominations = parser.get_oscar_nominations(text)
+        self.win_ratio = self.wins / self.nominations \
+            if self.nominations else None
 
     def __str__(self):
         return self.title
 
     @staticmethod
     def json_to_movie(data):
-        """ Parse JSON data to Movie object """
+        """ Parse JSON data to Movie object, ValueError on OMDb errors """
+        if data.get('Response') == 'False':
+            raise ValueError(data.get('Error', 'OMDb error response'))
         return Movie(
             title=data['Title'],
             year=data['Year'],
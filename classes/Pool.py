@@ -0,0 +1,119 @@
+"""Pool of read-only SQLite connections shared by reader threads"""
+import os
+import sqlite3 as sql
+import threading
+from urllib.parse import quote
+
+
+class PooledCursor():
+    """ Cursor giving its connection back to the pool once its rows are
+    read, it is closed or it is garbage collected """
+    def __init__(self, cursor, release):
+        self.cursor = cursor
+        self.release = release
+
+    def close(self):
+        if self.release is not None:
+            (release, self.release) = (self.release, None)
+            self.cursor.close()
+            release()
+
+    def fetchone(self):
+        if self.release is None:
+            return None
+        row = self.cursor.fetchone()
+        if row is None:
+            self.close()
+        return row
+
+    def fetchmany(self, size=None):
+        if self.release is None:
+            return []
+        size = self.cursor.arraysize if size is None else size
+        rows = self.cursor.fetchmany(size)
+        if len(rows) < size:
+            self.close()
+        return rows
+
+    def fetchall(self):
+        if self.release is None:
+            return []
+        rows = self.cursor.fetchall()
+        self.close()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __del__(self):
+        self.close()
+
+
+class ReaderPool():
+    """ Read-only connections to the database file at path
+
+    Every query takes an idle connection, or opens one if all are busy,
+    so nested and concurrent reads never wait for each other; at most
+    size idle connections are kept. wrap, e.g. Instrumentation.connect,
+    is applied to each connection handed out.
+    """
+    def __init__(self, path, size=4, wrap=None):
+        self.uri = 'file:' + quote(os.path.abspath(path)) + '?mode=ro'
+        self.size = size
+        self.wrap = wrap
+        self.idle = []
+        self.opened = 0
+        self.watcher = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+        return sql.connect(self.uri, uri=True, check_same_thread=False)
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def execute(self, query, params=()):
+        """ Runs query on a pooled connection, returns its cursor """
+        conn = self.acquire()
+        try:
+            wrapped = self.wrap(conn) if self.wrap is not None else conn
+            cursor = wrapped.execute(query, params)
+        except BaseException:
+            self.release(conn)
+            raise
+        return PooledCursor(cursor, lambda: self.release(conn))
+
+    def data_version(self):
+        """ Gets PRAGMA data_version of a connection kept for it, which
+        changes whenever another connection or process commits """
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = sql.connect(
+                    self.uri, uri=True, check_same_thread=False)
+            return self.watcher.execute("pragma data_version").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            (idle, self.idle) = (self.idle, [])
+            if self.watcher is not None:
+                idle.append(self.watcher)
+                self.watcher = None
+        for conn in idle:
+            conn.close()
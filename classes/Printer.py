@@ -1,15 +1,33 @@
+from itertools import chain, islice
+
+
 class PrettyPrinter():
-    def __init__(self, data):
-        def get_width(data):
-            """ Helper function getting table width """
-            width = 2
-            max_length = 5
-            for item in data:
-                if len(str((item[0]))) > max_length:
-                    max_length = len(item[0])
-            return width+max_length
+    """ Table printer, column width comes from a bounded sample of rows
+    or is fixed, so rows can be printed as they arrive """
+    sample = 100
+
+    def __init__(self, data=None, width=None):
+        self.width = width
+        if width is None and isinstance(data, (list, tuple)):
+            self.width = self.get_width(data[:self.sample])
 
-        self.width = get_width(data)
+    def get_width(self, data):
+        """ Helper function getting table width """
+        width = 2
+        max_length = 5
+        for item in data:
+            if len(str((item[0]))) > max_length:
+                max_length = len(str(item[0]))
+        return width+max_length
+
+    def rows(self, data):
+        """ Gets rows iterator, fixing width from first rows if needed """
+        rows = iter(data)
+        if self.width is None:
+            head = list(islice(rows, self.sample))
+            self.width = self.get_width(head)
+            rows = chain(head, rows)
+        return rows
 
     def print(self, columns, data):
         pass
@@ -17,22 +35,35 @@ class PrettyPrinter():
 
 class PrintFiltered(PrettyPrinter):
     def print(self, columns, data):
-        col1 = columns[0].title()
-        col2 = columns[1].title()
-        print(col1.ljust(self.width), col2.ljust(self.width))
-        for (title, value) in data:
-            print(str(title).ljust(self.width), str(value))
+        rows = self.rows(data)
+        print(*(column.title().ljust(self.width) for column in columns))
+        for row in rows:
+            print(*(str(value).ljust(self.width) for value in row[:-1]),
+                  str(row[-1]))
 
 
 class PrintHighscores(PrettyPrinter):
+    labels = {
+        'runtime': 'Runtime',
+        'box_office': 'Box Office',
+        'awards': 'Awards',
+        'nominations': 'Nominations',
+        'oscars': 'Oscars',
+        'imdb_rating': 'IMDb Rating',
+        'imdb_votes': 'IMDb Votes',
+        'oscar_nominations': 'Oscar Noms',
+        'win_ratio': 'Win Ratio',
+    }
+
+    def __init__(self, data):
+        super().__init__([(title, value) for (_, title, value) in data])
+
     def print(self, data):
-        rows = [
-            'Runtime', 'Box Office', 'Awards',
-            'Nominations', 'Oscars', 'IMDb Rating'
-        ]
         rows_width = 13
-        highscores = zip(rows, data)
-        for column, (title, value) in highscores:
+        for (metric, title, value) in data:
+            column = self.labels.get(metric, metric.title())
+            if isinstance(value, float) and metric == 'win_ratio':
+                value = f'{value:.2f}'
             print(
                 str(column).ljust(rows_width),
                 str(title).ljust(self.width),
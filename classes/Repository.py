@@ -1,8 +1,12 @@
+import functools
 import json
-import requests
+import time
 from classes.Movie import Movie
+from classes.HelperClasses import Throughput, HighscoreAggregator
+from classes.DB import HIGHSCORES, MOVIE_COLUMNS, chunked
 
 URL = 'http://omdbapi.com/'
+NOT_CACHED = {"Response": "False", "Error": "Movie not found in cache."}
 
 
 def get_apikey():
@@ -12,97 +16,388 @@ def get_apikey():
     return apikey
 
 
-def get_movie(url, params):
-    """ Gets movie data from API"""
-    res = requests.get(url, params)
-    return res.json()
+def get_session(pool_size=1):
+    """ Creates HTTP session with keep-alive connection pool """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_movie(url, params, session=None, cache=None, offline=False):
+    """ Gets movie data from API, or from cache when one is given"""
+    if cache is not None:
+        cached = cache.get(params)
+        if cached is not None:
+            return cached
+    if offline:
+        return dict(NOT_CACHED)
+    if session is None:
+        import requests
+        session = requests
+    res = session.get(url, params)
+    data = res.json()
+    if cache is not None and data.get('Response') != 'False':
+        cache.put(params, data)
+    return data
+
+
+def payload_hash(response):
+    """ Gets stable hash of OMDb response to detect unchanged payloads """
+    import hashlib
+    payload = json.dumps(response, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def fetch_state(title, response, movie, fetched_at=None):
+    """ Gets (title, status, fetched_at, payload_hash) of a fetch """
+    fetched_at = time.time() if fetched_at is None else fetched_at
+    if movie is not None:
+        return (title, 'ok', fetched_at, payload_hash(response))
+    if response is None or response == NOT_CACHED:
+        return (title, 'error', fetched_at, None)
+    return (title, 'not_found', fetched_at, None)
+
+
+def read_movies(lines, skipped):
+    """ Parses OMDb JSON lines to movies, appending (line number,
+    reason) of malformed records to skipped """
+    for (number, line) in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield Movie.json_to_movie(json.loads(line))
+        except KeyError as e:
+            skipped.append((number, f'missing field {e}'))
+        except (ValueError, AttributeError) as e:
+            skipped.append((number, str(e) or type(e).__name__))
+
+
+def read_pairs(lines, skipped):
+    """ Parses lines of two tab-separated titles to pairs, appending
+    (line number, reason) of malformed lines to skipped """
+    for (number, line) in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        titles = [title.strip() for title in line.split('\t')]
+        if len(titles) != 2 or not all(titles):
+            skipped.append((number, 'expected two tab-separated titles'))
+            continue
+        yield tuple(titles)
+
+
+def iter_rows(cursor, size=500):
+    """ Yields cursor rows, fetching size rows at a time """
+    rows = cursor.fetchmany(size)
+    while rows:
+        yield from rows
+        rows = cursor.fetchmany(size)
+
+
+def freeze(value):
+    """ Gets hashable form of query arguments, lists become tuples """
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item))
+                            for (key, item) in value.items()))
+    return value
+
+
+def memoized(method):
+    """ Serves repeated calls of a query method from the repository's
+    results cache, keyed on method and arguments, until the database
+    changes, see classes.Cache.ResultCache """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.results is None:
+            return method(self, *args, **kwargs)
+        key = (method.__name__, freeze(args), freeze(kwargs))
+        try:
+            hash(key)
+        except TypeError:
+            return method(self, *args, **kwargs)
+        return self.results.get(
+            key, self.db.data_version(),
+            lambda: method(self, *args, **kwargs))
+    return wrapper
 
 
 class Repository():
-    def __init__(self, db, parser, highscore):
+    def __init__(self, db, parser, cache=None, offline=False,
+                 client=None, url=None, apikey=None, results=None):
         self.db = db
         self.parser = parser
-        self.highscore = highscore
+        self.cache = cache
+        self.offline = offline
+        self.client = client
+        self.url = url or URL
+        self.apikey = apikey
+        self.results = results
 
-    def populate(self):
-        """ Populates database with data from API"""
+    def fetch(self, session, key, title):
+        """ Fetches single title from API, runs in worker thread """
+        import requests
+        params = dict(apikey=key, t=title, type='movie')
+        start = time.perf_counter()
+        try:
+            response = get_movie(self.url, params=params, session=session,
+                                 cache=self.cache, offline=self.offline)
+        except (requests.RequestException, ValueError):
+            response = None
+        return title, response, time.perf_counter() - start
+
+    def populate(self, workers=1, session=None, batch_size=500, max_age=0):
+        """ Populates database with data from API
+
+        Titles are fetched by a pool of `workers` threads sharing one
+        keep-alive session, while all database writes stay on the
+        calling thread and are committed with their fetch state every
+        `batch_size` titles, so an interrupted run resumes from the last
+        checkpoint. Only titles never fetched, failed or fetched more
+        than `max_age` seconds ago are requested; with max_age None
+        successfully fetched titles are never refetched. On a partial
+        refresh responses whose payload hash did not change only update
+        the fetch state, while max_age 0 refetches and rewrites all rows.
+        Returns the Throughput of the run.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, \
+            FIRST_COMPLETED
         print("Downloading data from OMDb...")
-        cursor = self.db.get_all_titles()
-        movie_list = cursor.fetchall()
-        key = get_apikey()['apikey']
-        for (title, ) in movie_list:
-            params = dict(apikey=key, t=title, type='movie')
-            response = get_movie(URL, params=params)
-            movie = Movie.json_to_movie(response)
-            self.db.update(movie)
-            print(f"Succesfully retrieved data from OMDb for {title}\n")
+        stale_before = None if max_age is None else time.time() - max_age
+        hashes = dict(self.db.get_titles_to_fetch(stale_before).fetchall())
+        if max_age == 0:
+            hashes = dict.fromkeys(hashes)
+        print(f"{len(hashes)} titles to fetch")
+        titles = iter(list(hashes))
+        key = self.apikey or get_apikey()['apikey']
+        if session is None:
+            session = self.client or get_session(workers)
+        stats = Throughput()
+        batch, states = [], []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                while True:
+                    for title in titles:
+                        pending.add(
+                            executor.submit(self.fetch, session, key, title))
+                        if len(pending) >= workers * 2:
+                            break
+                    if not pending:
+                        break
+                    done, pending = wait(
+                        pending, return_when=FIRST_COMPLETED)
+                    error = None
+                    for future in done:
+                        # store every finished fetch before re-raising
+                        try:
+                            title, response, latency = future.result()
+                        except BaseException as exc:
+                            error = error or exc
+                            continue
+                        stats.add(latency)
+                        movie = self.parse(title, response)
+                        state = fetch_state(title, response, movie)
+                        states.append(state)
+                        if movie is not None and \
+                                state[3] != hashes.get(title):
+                            # keep the catalogue title as the row key
+                            movie.title = title
+                            batch.append(movie)
+                    if error is not None:
+                        raise error
+                    if len(states) >= batch_size:
+                        self.checkpoint(batch, states, batch_size)
+                        batch, states = [], []
+        finally:
+            self.checkpoint(batch, states, batch_size)
+        print(stats.summary())
+        if self.client is not None:
+            print(self.client.summary())
+        if self.cache is not None:
+            self.cache.flush()
+            print(self.cache.summary())
+        return stats
+
+    def checkpoint(self, movies, states, batch_size=500):
+        """ Commits fetched movies together with their fetch state """
+        self.db.set_fetch_state(states)
+        self.db.upsert_many(movies, batch_size)
         self.db.conn.commit()
 
-    def add(self, title):
-        print(f'Succesfully added {title} to database')
-        key = get_apikey()['apikey']
+    def parse(self, title, response):
+        """ Parses fetched response to Movie, None if OMDb had no data """
+        try:
+            movie = Movie.json_to_movie(response)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            print(f"Couldn't find data in OMDb for {title}\n")
+            return None
+        print(f"Succesfully retrieved data from OMDb for {title}\n")
+        return movie
+
+    def import_file(self, path, batch_size=500):
+        """ Imports OMDb JSON lines file (optionally gzipped) without
+        network, upserting in batches of batch_size """
+        import gzip
+        print(f"Importing movies from {path}...")
+        skipped = []
+        start = time.perf_counter()
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f, \
+                self.db.bulk_load():
+            count = self.db.upsert_many(read_movies(f, skipped), batch_size)
+        elapsed = time.perf_counter() - start
+        rate = count / elapsed if elapsed > 0 else 0.0
+        for (number, reason) in skipped[:20]:
+            print(f"Skipped line {number}: {reason}")
+        print(f"Imported {count} movies in {elapsed:.2f}s "
+              f"({rate:.0f} rows/sec), skipped {len(skipped)} records")
+        return count, skipped
+
+    def add(self, title, session=None):
+        key = self.apikey or get_apikey()['apikey']
         params = dict(apikey=key, t=title, type='movie')
+        session = session if session is not None else self.client
         try:
-            response = get_movie(URL, params=params)
+            response = get_movie(self.url, params=params, session=session,
+                                 cache=self.cache, offline=self.offline)
             movie = Movie.json_to_movie(response)
-            self.db.update(movie)
+            self.db.upsert(movie)
+            self.db.set_fetch_state(
+                [fetch_state(movie.title, response, movie)])
             self.db.conn.commit()
-            print(f"Succesfully retrieved data from OMDb for {title}\n")
+            print(f'Succesfully added {movie.title} to database')
         except Exception:
             self.db.conn.rollback()
             print(f"Couldn't find data in OMDb - rolling back {title}\n")
 
-    def get_awards(self, movies):
-        cursor = self.db.get_awards(movies[0], movies[1])
+    def get_all(self, columns=('id', ) + MOVIE_COLUMNS):
+        cursor = self.db.get_columns(columns)
+        return iter_rows(cursor)
+
+    @memoized
+    def get_compared(self, comparator, movies):
+        """ Gets (title, value, ranking value) of given movies, best
+        first """
+        cursor = self.db.get_compared(comparator, movies)
         return cursor.fetchall()
 
+    def compare_pairs(self, comparator, pairs, batch_size=10000):
+        """ Yields (movie1, movie2, winner) for pairs of titles
+
+        The titles of every batch_size pairs are resolved with a single
+        lookup. As with --compare the movie ranked first by get_compared
+        wins, so ties go to the movie added first; winner is None if
+        either movie is unknown.
+        """
+        for batch in chunked(pairs, batch_size):
+            titles = set(title for pair in batch for title in pair)
+            rows = self.get_compared(comparator, titles)
+            found = dict(
+                (title.lower(), (title, rank))
+                for (rank, (title, _, _)) in enumerate(rows))
+            for (movie1, movie2) in batch:
+                first = found.get(movie1.lower())
+                second = found.get(movie2.lower())
+                if first is None or second is None:
+                    yield (movie1, movie2, None)
+                    continue
+                winner = first[0] if first[1] < second[1] else second[0]
+                yield (first[0], second[0], winner)
+
+    def compare_file(self, comparator, path, skipped, batch_size=10000):
+        """ Yields compare_pairs rows for the tab-separated title pairs in
+        file (optionally gzipped), appending malformed lines to skipped """
+        import gzip
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            yield from self.compare_pairs(
+                comparator, read_pairs(f, skipped), batch_size)
+
+    def get_awards(self, movies):
+        return self.get_compared('awards', movies)
+
     def get_box_office(self, movies):
-        cursor = self.db.get_box_office(movies[0], movies[1])
-        return cursor.fetchall()
+        return self.get_compared('box_office', movies)
 
     def get_runtime(self, movies):
-        cursor = self.db.get_runtime(movies[0], movies[1])
-        return cursor.fetchall()
+        return self.get_compared('runtime', movies)
 
     def get_imdb_rating(self, movies):
-        cursor = self.db.get_imdb_rating(movies[0], movies[1])
-        return cursor.fetchall()
+        return self.get_compared('imdb_rating', movies)
 
-    def get_filtered_by(self, filter, value):
-        cursor = self.db.get_filtered_by(filter, value)
-        return cursor.fetchall()
+    @memoized
+    def get_filtered_by(self, filter, value, match='exact', **page):
+        cursor = self.db.get_filtered_by(filter, value, match, **page)
+        return iter_rows(cursor)
 
-    def get_awarded(self):
-        cursor = self.db.get_awarded()
+    @memoized
+    def search(self, terms, limit=20):
+        cursor = self.db.search(terms, limit)
         return cursor.fetchall()
 
-    def get_earned(self):
-        cursor = self.db.get_boxoffice_over_hundred_million()
-        return cursor.fetchall()
+    @memoized
+    def get_awarded(self, **page):
+        cursor = self.db.get_awarded(**page)
+        return iter_rows(cursor)
 
-    def get_nominated(self):
-        cursor = self.db.get_oscar_nominated()
-        return cursor.fetchall()
+    @memoized
+    def get_earned(self, **page):
+        cursor = self.db.get_boxoffice_over_hundred_million(**page)
+        return iter_rows(cursor)
 
-    def get_highscores(self):
-        cursor = self.db.get_for_highscores()
-        data = cursor.fetchall()
-        runtime = self.highscore.get_highest_runtime(data)
-        box_office = self.highscore.get_highest_box_office(data)
-        awards = self.highscore.get_awards_highscore(data)
-        nominations = self.highscore.get_nominations_highscore(data)
-        oscars = self.highscore.get_oscars_highscore(data)
-        rating = self.highscore.get_highest_imdb_rating(data)
-        return [runtime, box_office, awards, nominations, oscars, rating]
-
-    def get_sorted_by_runtime(self):
-        cursor = self.db.get_sorted_by_runtime()
-        return cursor.fetchall()
+    @memoized
+    def get_nominated(self, **page):
+        cursor = self.db.get_oscar_nominated(**page)
+        return iter_rows(cursor)
 
-    def get_sorted_by(self, sorter):
-        cursor = self.db.get_sorted_by(sorter)
-        try:
-            data = cursor.fetchall()
-        except TypeError:
-            pass
-        return data
+    @memoized
+    def get_highscores(self, metrics=HIGHSCORES, top=1):
+        """ Gets top movies for each metric
+
+        The single top movie is read from the highscores table, larger
+        top-N lists come from one pass over the indexed candidates.
+        """
+        if top == 1:
+            stored = dict(
+                (metric, (metric, title, value)) for (metric, title, value)
+                in self.db.get_highscores(metrics).fetchall())
+            return [stored[metric] for metric in metrics if metric in stored]
+        cursor = self.db.get_metrics(metrics, top)
+        return HighscoreAggregator(metrics, top).consume(cursor).results()
+
+    def rebuild_highscores(self):
+        """ Recomputes highscores table, returns rows that differed """
+        stored = set(self.db.get_highscores_table().fetchall())
+        computed = self.db.compute_highscores()
+        self.db.set_highscores(computed)
+        self.db.conn.commit()
+        return sorted(stored.symmetric_difference(computed))
+
+    @memoized
+    def get_sorted_by_runtime(self, **page):
+        cursor = self.db.get_sorted_by_runtime(**page)
+        return iter_rows(cursor)
+
+    @memoized
+    def get_sorted_by(self, sorter, **page):
+        cursor = self.db.get_sorted_by(sorter, **page)
+        return iter_rows(cursor)
+
+    def find(self, filters=(), sort=(), match='exact', **page):
+        """ Gets (columns, rows) of movies matching all filters, sorted
+        by given columns, see classes.DB.build_query """
+        cursor = self.db.find(filters, sort, match, **page)
+        columns = [column[0].lower() for column in cursor.description]
+        return columns, iter_rows(cursor)
+
+    @memoized
+    def get_top(self, sorter, n, descending=True):
+        cursor = self.db.get_top(sorter, n, descending)
+        return cursor.fetchall()
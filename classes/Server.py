@@ -0,0 +1,241 @@
+"""JSON query server keeping DB and Repository warm between requests"""
+import contextlib
+import http.client
+import json
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from classes.DB import COMPARE_COLUMNS, FACETS, HIGHSCORES, MATCHES, \
+    METRICS, MOVIE_COLUMNS
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+# filters without value: repository getter
+FLAGS = {
+    'awarded': 'get_awarded',
+    'nominated': 'get_nominated',
+    'earned': 'get_earned',
+}
+
+
+def is_unix(address):
+    """ Checks whether address is a Unix socket path, not host:port """
+    return '/' in address or ':' not in address
+
+
+def split_address(address):
+    """ Gets (host, port) from host:port, [IPv6]:port or IPv6:port """
+    (host, port) = address.rsplit(':', 1)
+    return (host.strip('[]'), int(port))
+
+
+def join_address(host, port):
+    """ Gets host:port, bracketing IPv6 hosts as URLs need """
+    return f'[{host}]:{port}' if ':' in host else f'{host}:{port}'
+
+
+def get_one(params, name, default=None, kind=str):
+    """ Gets single query parameter converted to kind """
+    values = params.get(name)
+    return kind(values[0]) if values else default
+
+
+def get_page(params):
+    """ Gets limit/offset/after pagination from query parameters """
+    return dict(
+        limit=get_one(params, 'limit', kind=int),
+        offset=get_one(params, 'offset', kind=int),
+        after=get_one(params, 'after'),
+    )
+
+
+class QueryService():
+    """ Answers queries from one warm Repository
+
+    Queries on a database file run concurrently on the DB's pool of
+    read-only connections; an in-memory database has only its writer
+    connection, so they run one at a time.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.lock = threading.Lock() if repo.db.pool is None \
+            else contextlib.nullcontext()
+
+    def handle(self, path, params):
+        """ Runs query for endpoint path, returns JSON-ready dict """
+        endpoint = path.strip('/')
+        handler = getattr(self, f'query_{endpoint}', None)
+        if handler is None:
+            raise LookupError(f"Unknown endpoint: /{endpoint}")
+        with self.lock:
+            return handler(params)
+
+    def query_sort(self, params):
+        column = get_one(params, 'by')
+        if column not in MOVIE_COLUMNS:
+            raise ValueError(f"Unknown sort column: {column}")
+        sorter = 'movies.cast' if column == 'cast' else column
+        top = get_one(params, 'top', kind=int)
+        if top is not None:
+            order = get_one(params, 'order', 'desc')
+            if order not in ('asc', 'desc'):
+                raise ValueError(f"Unknown order: {order}")
+            rows = self.repo.get_top(sorter, top, order == 'desc')
+        else:
+            rows = self.repo.get_sorted_by(sorter, **get_page(params))
+        return dict(columns=['title', column], rows=list(rows))
+
+    def query_filter(self, params):
+        filter = get_one(params, 'by')
+        page = get_page(params)
+        if filter in FLAGS:
+            rows = getattr(self.repo, FLAGS[filter])(**page)
+        elif filter in FACETS:
+            match = get_one(params, 'match', 'exact')
+            if match not in MATCHES:
+                raise ValueError(f"Unknown match: {match}")
+            rows = self.repo.get_filtered_by(
+                filter, get_one(params, 'value', ''), match, **page)
+        else:
+            raise ValueError(f"Unknown filter: {filter}")
+        return dict(columns=['title', filter], rows=list(rows))
+
+    def query_search(self, params):
+        terms = get_one(params, 'q', '')
+        rows = self.repo.search(terms, get_one(params, 'limit', 20, int))
+        return dict(columns=['title', 'match'], rows=list(rows))
+
+    def query_compare(self, params):
+        comparator = get_one(params, 'by')
+        if comparator not in COMPARE_COLUMNS:
+            raise ValueError(f"Unknown comparator: {comparator}")
+        movies = params.get('movie', [])
+        rows = self.repo.get_compared(comparator, movies)
+        if len(rows) < 2:
+            raise LookupError(f"Movies not found: {movies}")
+        # rows are ranked best first
+        return dict(columns=['title', comparator, 'value'], rows=list(rows),
+                    winner=rows[0][0])
+
+    def query_highscores(self, params):
+        metrics = params.get('metric') or list(HIGHSCORES)
+        unknown = [metric for metric in metrics if metric not in METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metrics: {unknown}")
+        rows = self.repo.get_highscores(
+            metrics, max(get_one(params, 'top', 1, int), 1))
+        return dict(columns=['metric', 'title', 'value'], rows=list(rows))
+
+    def query_stats(self, params):
+        results = self.repo.results
+        return dict(results=None if results is None else results.stats())
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """ Serves GET /<endpoint>?<params> as JSON """
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            data = self.server.service.handle(url.path, parse_qs(url.query))
+            status = 200
+        except LookupError as e:
+            data, status = dict(error=str(e)), 404
+        except ValueError as e:
+            data, status = dict(error=str(e)), 400
+        except Exception as e:
+            data, status = dict(error=str(e)), 500
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address or 'unix')
+
+    def log_message(self, *args):
+        pass
+
+
+class QueryHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QueryHTTPServer6(QueryHTTPServer):
+    address_family = socket.AF_INET6
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTP connection over a Unix socket """
+    def __init__(self, socket_path, timeout=10):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def make_server(address, repo):
+    """ Creates threaded HTTP server on host:port or Unix socket path """
+    if is_unix(address):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixHTTPServer(address, QueryHandler)
+    else:
+        (host, port) = split_address(address)
+        kind = QueryHTTPServer6 if ':' in host else QueryHTTPServer
+        server = kind((host, port), QueryHandler)
+    server.service = QueryService(repo)
+    return server
+
+
+def serve(address, repo):
+    """ Serves queries until interrupted """
+    server = make_server(address, repo)
+    where = address if is_unix(address) \
+        else join_address(server.server_address[0], server.server_port)
+    print(f"Serving movies queries on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if repo.results is not None:
+            print(repo.results.summary())
+        if is_unix(address) and os.path.exists(address):
+            os.remove(address)
+
+
+def query(address, endpoint, timeout=10, **params):
+    """ Sends query to a running server, returns decoded JSON response
+
+    Raises ValueError with the server's message on errors.
+    """
+    if is_unix(address):
+        conn = UnixHTTPConnection(address, timeout=timeout)
+    else:
+        (host, port) = split_address(address)
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', f"/{endpoint}?{urlencode(params, doseq=True)}")
+        response = conn.getresponse()
+        data = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise ValueError(data.get('error', f"HTTP {response.status}"))
+    return data
@@ -0,0 +1,43 @@
+"""Import-time breakdown of a movies.py run, see --startup-profile"""
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                      'movies.py')
+
+
+def parse_importtime(lines):
+    """ Parses `python -X importtime` output to (module, depth, self us,
+    cumulative us) rows """
+    rows = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        (own, cumulative, name) = line[len('import time:'):].split('|')
+        if not own.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), depth, int(own), int(cumulative)))
+    return rows
+
+
+def profile_startup(argv, top=15, script=SCRIPT):
+    """ Runs movies.py with argv under -X importtime, prints total import
+    and wall time and the slowest top-level imports; returns parsed rows """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', script] + list(argv),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    rows = parse_importtime(result.stderr.splitlines())
+    roots = sorted((row for row in rows if row[1] == 0),
+                   key=lambda row: row[3], reverse=True)
+    total = sum(row[3] for row in roots)
+    print(f"Run took {wall * 1000:.1f} ms, imports {total / 1000:.1f} ms "
+          f"in {len(rows)} modules")
+    print(f"{'cumulative':>11} {'self':>11}  module")
+    for (name, _, own, cumulative) in roots[:top]:
+        print(f"{cumulative / 1000:8.1f} ms {own / 1000:8.1f} ms  {name}")
+    return rows
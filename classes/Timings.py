@@ -0,0 +1,330 @@
+"""SQL statement instrumentation and per-phase timings, see --timings"""
+import contextlib
+import sys
+import threading
+import time
+from collections import deque
+
+# statements EXPLAIN QUERY PLAN can describe
+EXPLAINED = ('select', 'with', 'insert', 'update', 'delete', 'replace')
+PHASES = ('parse', 'connect', 'query', 'fetch', 'python', 'print')
+
+
+def normalize(sql):
+    """ Collapses whitespace of backslash-continued SQL """
+    return ' '.join(sql.split())
+
+
+def format_plan(rows):
+    """ Formats EXPLAIN QUERY PLAN (id, parent, notused, detail) rows as
+    the tree the sqlite3 shell prints """
+    children = {}
+    for (id, parent, _, detail) in rows:
+        children.setdefault(parent, []).append((id, detail))
+    lines = ['QUERY PLAN']
+
+    def add(parent, indent):
+        nodes = children.get(parent, [])
+        for (number, (id, detail)) in enumerate(nodes):
+            last = number == len(nodes) - 1
+            lines.append(indent + ('`--' if last else '|--') + detail)
+            add(id, indent + ('   ' if last else '|  '))
+    add(0, '')
+    return '\n'.join(lines)
+
+
+class Statement():
+    """ One executed statement: SQL, bind params, execute and fetch
+    seconds and rows returned, or changed for writes """
+    def __init__(self, sql, params, many=False):
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.execute_s = 0.0
+        self.fetch_s = 0.0
+        self.rows = 0
+
+    def __repr__(self):
+        return f"Statement({normalize(self.sql)[:60]!r}, " \
+            f"rows={self.rows}, execute_s={self.execute_s:.6f}, " \
+            f"fetch_s={self.fetch_s:.6f})"
+
+
+class Instrumentation():
+    """ Collects a Statement for every SQL statement run through
+    connections it wraps
+
+    Totals are kept per normalized SQL text and overall; the most recent
+    keep statements are kept as they are. Every hook is called with a
+    Statement once its rows are fetched, the cursor runs another
+    statement or flush() is called, e.g. by a metrics exporter. With
+    explain the query plan of each distinct statement is written to out.
+    """
+    def __init__(self, explain=False, hooks=(), out=None, keep=1000):
+        self.explain = explain
+        self.hooks = list(hooks)
+        self.out = out
+        self.statements = deque(maxlen=keep)
+        self.totals = {}
+        self.pending = set()
+        self.explained = set()
+        self.count = 0
+        self.execute_s = 0.0
+        self.fetch_s = 0.0
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def connect(self, conn):
+        """ Wraps sqlite3 connection so its statements are recorded """
+        return InstrumentedConnection(conn, self)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def begin(self, conn, sql, params, many=False):
+        """ Starts recording statement, explaining it first if asked """
+        if self.explain:
+            self.explain_plan(conn, sql, params, many)
+        statement = Statement(sql, None if many else params, many)
+        with self.lock:
+            self.count += 1
+            self.pending.add(statement)
+        return statement
+
+    def explain_plan(self, conn, sql, params, many):
+        key = normalize(sql)
+        if key in self.explained \
+                or key.split(' ', 1)[0].lower() not in EXPLAINED:
+            return
+        self.explained.add(key)
+        if many:
+            params = params[0] if params else ()
+        try:
+            rows = conn.execute('explain query plan ' + sql, params)
+            plan = format_plan(rows.fetchall())
+        except Exception as e:
+            plan = f"QUERY PLAN unavailable: {e}"
+        print(f"-- {key}", file=self.out or sys.stderr)
+        if params:
+            print(f"-- params: {params!r}", file=self.out or sys.stderr)
+        print(plan, file=self.out or sys.stderr)
+
+    def record(self, statement, execute_s=0.0, fetch_s=0.0, rows=0):
+        with self.lock:
+            statement.execute_s += execute_s
+            statement.fetch_s += fetch_s
+            statement.rows += rows
+            self.execute_s += execute_s
+            self.fetch_s += fetch_s
+            self.rows += rows
+
+    def finish(self, statement):
+        """ Adds statement to totals and passes it to the hooks """
+        with self.lock:
+            if statement not in self.pending:
+                return
+            self.pending.discard(statement)
+            self.statements.append(statement)
+            total = self.totals.setdefault(
+                normalize(statement.sql), [0, 0.0, 0.0, 0])
+            total[0] += 1
+            total[1] += statement.execute_s
+            total[2] += statement.fetch_s
+            total[3] += statement.rows
+        for hook in self.hooks:
+            hook(statement)
+
+    def flush(self):
+        """ Finishes statements whose rows were not fully fetched """
+        for statement in list(self.pending):
+            self.finish(statement)
+
+    def report(self, out=None, top=20):
+        """ Prints the top statements by execute plus fetch time """
+        self.flush()
+        out = out or sys.stderr
+        print(f"{'calls':>6} {'rows':>8} {'query ms':>10} {'fetch ms':>10}"
+              "  statement", file=out)
+        rows = sorted(self.totals.items(),
+                      key=lambda item: item[1][1] + item[1][2], reverse=True)
+        for (sql, (calls, execute_s, fetch_s, count)) in rows[:top]:
+            print(f"{calls:>6} {count:>8} {execute_s * 1000:>10.2f} "
+                  f"{fetch_s * 1000:>10.2f}  {sql[:80]}", file=out)
+
+
+class InstrumentedCursor():
+    """ sqlite3 cursor recording execute and fetch time and rows of each
+    statement, other attributes are the wrapped cursor's """
+    def __init__(self, cursor, instrumentation):
+        self.cursor = cursor
+        self.instrumentation = instrumentation
+        self.statement = None
+
+    def execute(self, sql, params=()):
+        return self.run(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, params):
+        if self.instrumentation.explain:
+            params = list(params)
+        return self.run(self.cursor.executemany, sql, params, many=True)
+
+    def run(self, method, sql, params, many=False):
+        if self.statement is not None:
+            self.instrumentation.finish(self.statement)
+        statement = self.statement = self.instrumentation.begin(
+            self.cursor.connection, sql, params, many)
+        start = time.perf_counter()
+        try:
+            method(sql, params)
+        finally:
+            self.instrumentation.record(
+                statement, execute_s=time.perf_counter() - start)
+        if self.cursor.description is None:
+            self.instrumentation.record(
+                statement, rows=max(self.cursor.rowcount, 0))
+            self.done()
+        return self
+
+    def fetched(self, start, rows, done):
+        if self.statement is None:
+            return
+        self.instrumentation.record(
+            self.statement, fetch_s=time.perf_counter() - start, rows=rows)
+        if done:
+            self.done()
+
+    def done(self):
+        self.instrumentation.finish(self.statement)
+        self.statement = None
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self.fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.cursor.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = self.cursor.fetchmany(size)
+        self.fetched(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self.fetched(start, len(rows), True)
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self.cursor)
+        except StopIteration:
+            self.fetched(start, 0, True)
+            raise
+        self.fetched(start, 1, False)
+        return row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class InstrumentedConnection():
+    """ sqlite3 connection handing out InstrumentedCursors, other
+    attributes are the wrapped connection's """
+    def __init__(self, conn, instrumentation):
+        self.conn = conn
+        self.instrumentation = instrumentation
+
+    def cursor(self):
+        return InstrumentedCursor(self.conn.cursor(), self.instrumentation)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class Timings():
+    """ Wall time of named phases of a run
+
+    Phases do not overlap: time spent in a phase entered within another
+    one is only counted for the inner phase.
+    """
+    def __init__(self, start=None, clock=time.perf_counter):
+        self.clock = clock
+        self.start = clock() if start is None else start
+        self.phases = {}
+        self.stack = []
+        self.resumed = None
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Times the block as phase name """
+        now = self.clock()
+        if self.stack:
+            self.add(self.stack[-1], now - self.resumed)
+        self.stack.append(name)
+        self.resumed = now
+        try:
+            yield
+        finally:
+            now = self.clock()
+            self.add(self.stack.pop(), now - self.resumed)
+            self.resumed = now
+
+    def iterate(self, rows, name):
+        """ Yields rows, timing the work producing each as phase name """
+        rows = iter(rows)
+        while True:
+            with self.phase(name):
+                row = next(rows, self)
+            if row is self:
+                return
+            yield row
+
+    def breakdown(self, instrumentation=None):
+        """ Gets seconds per phase and total
+
+        query and fetch are the SQLite time recorded by instrumentation,
+        python is the rest of the run outside parse, connect and print,
+        e.g. parsing awards or comparing.
+        """
+        total = self.clock() - self.start
+        result = dict((name, 0.0) for name in PHASES)
+        result.update(
+            (name, seconds) for (name, seconds) in self.phases.items()
+            if name in result)
+        if instrumentation is not None:
+            result['query'] = instrumentation.execute_s
+            result['fetch'] = instrumentation.fetch_s
+        result['python'] = max(total - sum(
+            seconds for (name, seconds) in result.items()
+            if name != 'python'), 0.0)
+        result['total'] = total
+        return result
+
+    def report(self, instrumentation=None, out=None):
+        """ Prints phase breakdown followed by statement totals """
+        out = out or sys.stderr
+        result = self.breakdown(instrumentation)
+        total = result['total'] or 1
+        print(f"{'phase':10} {'ms':>10} {'%':>6}", file=out)
+        for (name, seconds) in result.items():
+            print(f"{name:10} {seconds * 1000:>10.2f} "
+                  f"{seconds / total * 100:>6.1f}", file=out)
+        if instrumentation is not None:
+            print(f"{instrumentation.count} statements, "
+                  f"{instrumentation.rows} rows", file=out)
+            instrumentation.report(out)
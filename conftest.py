@@ -1,8 +1,12 @@
+import json
+import threading
 import pytest
 import requests
-import sqlite3
 from classes.Movie import Movie
 from classes.DB import DB
+from classes.Repository import Repository
+from classes.Server import make_server
+from benchmarks.omdb_server import FakeOMDb, load_fixtures
 
 
 class MockResponse_OK:
@@ -20,30 +24,14 @@ class MockResponse_NO_PARAMS:
         return {"Response": "False", "Error": "Something went wrong."}
 
 
-class MockDB:
-    def __init__(self):
-        self.conn = sqlite3.connect('test.db')
-        self.cursor = self.conn.cursor()
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS movies (ID INTEGER PRIMARY KEY, \
-            TITLE TEXT, YEAR INTEGER,  RUNTIME TEXT, GENRE TEXT, \
-            DIRECTOR TEXT, CAST TEXT, WRITER TEXT, LANGUAGE TEXT, \
-            COUNTRY TEXT, AWARDS TEXT, IMDb_Rating FLOAT, \
-            IMDb_votes INTEGER, BOX_OFFICE INTEGER)"
-        )
-
-
-class MockDBPopulated:
-    def __init__(self):
-        self.conn = sqlite3.connect('populated.db')
-        self.cursor = self.conn.cursor()
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS movies (ID INTEGER PRIMARY KEY, \
-            TITLE TEXT, YEAR INTEGER,  RUNTIME TEXT, GENRE TEXT, \
-            DIRECTOR TEXT, CAST TEXT, WRITER TEXT, LANGUAGE TEXT, \
-            COUNTRY TEXT, AWARDS TEXT, IMDb_Rating FLOAT, \
-            IMDb_votes INTEGER, BOX_OFFICE INTEGER)"
-        )
+class MockDB(DB):
+    def __init__(self, path):
+        super().__init__(path)
+
+
+class MockDBPopulated(DB):
+    def __init__(self, path):
+        super().__init__(path)
         alien = Movie.json_to_movie(
             MockResponse_OK().json()
             )
@@ -88,9 +76,59 @@ def auth():
     return auth
 
 
+class MockSession:
+    """ Stand-in for requests.Session serving fixtures by title """
+    fixtures = {
+        'Alien': 'fixtures/alien.json',
+        'Boyhood': 'fixtures/boyhood.json',
+        'Forrest Gump': 'fixtures/forrest.json',
+        'Memento': 'fixtures/memento.json',
+        'The Shawshank Redemption': 'fixtures/shawshank.json',
+    }
+
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, params):
+        self.calls.append(params)
+        file = self.fixtures.get(params.get('t'))
+        if file is None:
+            return MockResponse_NO_PARAMS()
+        return MockResponseFile(file)
+
+
+class MockResponseFile:
+    def __init__(self, file):
+        self.file = file
+
+    def json(self):
+        return MockResponse_OK.json(self.file)
+
+
 @pytest.fixture()
-def mock_db():
-    return MockDB()
+def omdb_server():
+    server = FakeOMDb(load_fixtures()).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture()
+def mock_session():
+    return MockSession()
+
+
+@pytest.fixture()
+def memory_db():
+    db = DB(':memory:')
+    yield db
+    db.close()
+
+
+@pytest.fixture()
+def mock_db(tmp_path):
+    db = MockDB(str(tmp_path / 'test.db'))
+    yield db
+    db.close()
 
 
 @pytest.fixture()
@@ -99,5 +137,23 @@ def mock_db_ok():
 
 
 @pytest.fixture()
-def mock_db_populated():
-    return MockDBPopulated()
+def mock_db_populated(tmp_path):
+    db = MockDBPopulated(str(tmp_path / 'populated.db'))
+    yield db
+    db.close()
+
+
+@pytest.fixture()
+def query_server():
+    db = DB(':memory:', check_same_thread=False)
+    for file in MockSession.fixtures.values():
+        db.upsert(Movie.json_to_movie(MockResponse_OK.json(file)))
+    db.conn.commit()
+    server = make_server('127.0.0.1:0', Repository(db, None))
+    server.address = f'127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    db.close()
@@ -1,44 +1,209 @@
 """CLI app fetching data from OMDb API and storing in local sqlite database"""
 import argparse
+import contextlib
+import sys
+import time
 
-from classes.HelperClasses import Parser, \
-    Highscore, CompareAwards, CompareNumeric
-from classes.DB import DB
+from classes.HelperClasses import Parser
+from classes.DB import DB, JOURNAL_MODES, SYNCHRONOUS, FACETS, MATCHES, \
+    METRICS, HIGHSCORES, MOVIE_COLUMNS, COMPARE_COLUMNS, FILTER_FLAGS
 from classes.Repository import Repository
 from classes.Printer import PrintFiltered, PrintHighscores
 
+# the HTTP stack, NumPy, pyarrow and the server are imported only by the
+# commands that need them, see --startup-profile
+
 
 class Main():
     def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = None
+        self.instrumentation = None
         self.award_parser = Parser()
-        self.db = DB()
-        self.highscore = Highscore()
-        self.repo = Repository(db=self.db, parser=self.award_parser,
-                               highscore=self.highscore)
+        self.db = None
+        self._repo = None
         self.parser = argparse.ArgumentParser()
+        self.parser.add_argument(
+            "--engine",
+            help="Query engine: sqlite (default) or columnar, which loads \
+                the catalog into NumPy arrays for batch analytics",
+            action='store', choices=['sqlite', 'columnar'],
+            default='sqlite')
         self.parser.add_argument(
             "-p", "--populate",
             help="Use this option to download data from OMDb \
                   and populate your database",
             action="store_true")
+        self.parser.add_argument(
+            "--import", dest='import_file', metavar='FILE',
+            help="Import OMDb responses from JSON lines file (.jsonl or \
+                .jsonl.gz) without network",
+            action='store', type=str)
+        self.parser.add_argument(
+            "-w", "--workers",
+            help="Number of concurrent OMDb requests used by --populate",
+            action='store', type=int, default=1)
+        self.parser.add_argument(
+            "--batch-size",
+            help="Number of movies written per transaction",
+            action='store', type=int, default=500)
+        self.parser.add_argument(
+            "--omdb-url",
+            help="OMDb API endpoint, e.g. a local stand-in for testing",
+            action='store')
+        self.parser.add_argument(
+            "--rate",
+            help="Maximum OMDb requests per second, e.g. to fit API quota",
+            action='store', type=float)
+        self.parser.add_argument(
+            "--timeout",
+            help="Seconds to wait for a single OMDb response",
+            action='store', type=float, default=10)
+        self.parser.add_argument(
+            "--retries",
+            help="Retries of OMDb requests failing with timeouts, \
+                429 or 5xx responses",
+            action='store', type=int, default=3)
+        self.parser.add_argument(
+            "--incremental",
+            help="With --populate only fetch movies never fetched or \
+                whose last fetch failed",
+            action='store_true')
+        self.parser.add_argument(
+            "--max-age",
+            help="With --populate also refetch movies fetched more than \
+                given number of days ago, implies --incremental",
+            action='store', type=float)
+        self.parser.add_argument(
+            "--journal-mode",
+            help="SQLite journal mode, wal by default so queries can run "
+            "while --populate writes", default='wal',
+            action='store', choices=JOURNAL_MODES)
+        self.parser.add_argument(
+            "--synchronous",
+            help="SQLite synchronous setting used for this run",
+            action='store', choices=SYNCHRONOUS)
+        self.parser.add_argument(
+            "--cache",
+            help="Cache OMDb responses in given SQLite file",
+            action='store', nargs='?', const='omdb_cache.sqlite')
+        self.parser.add_argument(
+            "--cache-ttl",
+            help="Days after which cached OMDb responses expire",
+            action='store', type=float, default=30)
+        self.parser.add_argument(
+            "--cache-size",
+            help="Maximum number of cached OMDb responses",
+            action='store', type=int, default=100000)
+        self.parser.add_argument(
+            "--offline",
+            help="Serve OMDb responses only from cache, no network",
+            action='store_true')
         self.parser.add_argument(
             "-f", "--filter_by",
-            help="Filtering by column. Options: awarded, nominated, \
-                earned, director [name], actor [name], language [lang]",
-            action='store', nargs='*', type=str)
+            help="Filtering by column, repeat to combine filters. \
+                Options: awarded, nominated, earned, director [name], \
+                actor [name], writer [name], genre [genre], \
+                language [lang], country [country]",
+            action='append', nargs='+', type=str)
+        self.parser.add_argument(
+            "--match",
+            help="How --filter_by matches names: exact (default) and \
+                prefix use indexed lookups, substring scans the text",
+            action='store', choices=MATCHES, default='exact')
+        self.parser.add_argument(
+            "--search",
+            help="Full-text search in title, cast, director, writer, \
+                genre and awards, best matches first",
+            action='store', nargs='+', type=str)
+        self.parser.add_argument(
+            "--limit",
+            help="Maximum number of rows shown (search shows 20 by default)",
+            action='store', type=int)
+        self.parser.add_argument(
+            "--top",
+            help="Show only the first N movies of --sort_by, read from the \
+                column index where there is one",
+            action='store', type=int, metavar='N')
+        self.parser.add_argument(
+            "--ascending",
+            help="Sort --sort_by lowest values first",
+            action='store_true')
+        self.parser.add_argument(
+            "--offset", help="Number of rows skipped before showing",
+            action='store', type=int)
+        self.parser.add_argument(
+            "--after",
+            help="Show rows after the movie with given title, e.g. the \
+                last title of the previous page of --sort_by or --filter_by",
+            action='store', type=str)
+        self.parser.add_argument(
+            "--export", metavar='FILE',
+            help="Write the movies table, or the --sort_by/--filter_by \
+                result, to FILE instead of printing. Format follows the \
+                extension: .csv, .jsonl (optionally .gz) or .parquet",
+            action='store', type=str)
+        self.parser.add_argument(
+            "--serve", metavar='ADDRESS',
+            help="Serve sort, filter, search, compare and highscores \
+                queries as JSON on host:port, [IPv6]:port or a Unix \
+                socket path (default 127.0.0.1:8765)",
+            action='store', nargs='?', const='')
+        self.parser.add_argument(
+            "--result-cache", metavar='SIZE',
+            help="Keep up to SIZE query results in memory until the \
+                database changes, 256 with --serve, 0 disables",
+            action='store', type=int)
+        self.parser.add_argument(
+            "--startup-profile",
+            help="Run the given command with import timing and report the \
+                slowest imports",
+            action='store_true')
+        self.parser.add_argument(
+            "--timings",
+            help="Print time spent parsing arguments, connecting, running \
+                and fetching SQL, in Python and printing, and the slowest \
+                statements, to stderr",
+            action='store_true')
         self.parser.add_argument(
-            "--highscores", help="Show Highscores", action='store_true')
+            "--explain",
+            help="Print the SQLite query plan of every statement run",
+            action='store_true')
+        self.parser.add_argument(
+            "--width", help="Fixed width of the title column",
+            action='store', type=int)
+        self.parser.add_argument(
+            "--highscores",
+            help=f"Show Highscores, optionally for given metrics. \
+                Options: {', '.join(METRICS)}",
+            action='store', nargs='*', choices=list(METRICS))
+        self.parser.add_argument(
+            "--rebuild-highscores",
+            help="Recompute stored highscores and report differences",
+            action='store_true')
+        self.parser.add_argument(
+            "--highscores-top",
+            help="Number of movies shown per highscore metric",
+            action='store', type=int, default=1)
         self.parser.add_argument(
             "-c", "--compare",
-            help="Compare two movie titles by given column. \
+            help="Compare movie titles by given column: with two titles \
+            shows the winner, with more ranks them. \
             Options: imdb_rating, box_office, awards, runtime.",
             action='store', nargs='*', type=str)
+        self.parser.add_argument(
+            "--compare-pairs", metavar='FILE',
+            help="With --compare COLUMN compare every pair of \
+                tab-separated titles in FILE (optionally .gz), showing \
+                both titles and the winner",
+            action='store', type=str)
         self.parser.add_argument(
             "-a", "--add", help="Add movie to database",
             action='store', nargs='*', type=str)
         self.parser.add_argument(
             "-s", "--sort_by",
-            help="Sort output data by one or multiple columns",
+            help="Sort output data by one or multiple columns, combined \
+                with --filter_by in one query",
             action='store', nargs='+',
             choices=[
                 'title', 'year', 'runtime', 'genre', 'director',
@@ -47,99 +212,238 @@ class Main():
                 ]
             )
 
-    def main(self):
-        """ Main function"""
-        args = self.parser.parse_args()
-        repo = self.repo
+    @property
+    def repo(self):
+        """ Opens database and repository on first use """
+        if self._repo is None:
+            args = self.args
+            # --serve handler threads read on pooled connections
+            with self.phase('connect'):
+                self.db = DB(journal_mode=args.journal_mode,
+                             synchronous=args.synchronous,
+                             check_same_thread=args.serve is None)
+            if args.timings or args.explain:
+                from classes.Timings import Instrumentation
+                self.instrumentation = self.db.instrument(
+                    Instrumentation(explain=args.explain))
+            if args.engine == 'columnar':
+                from classes.Columnar import ColumnarRepository as Repo
+            else:
+                Repo = Repository
+            self._repo = Repo(db=self.db, parser=self.award_parser,
+                              url=args.omdb_url)
+            size = args.result_cache if args.result_cache is not None \
+                else 256 if args.serve is not None else 0
+            if size > 0:
+                from classes.Cache import ResultCache
+                self._repo.results = ResultCache(size)
+            if args.cache or args.offline:
+                from classes.Cache import ResponseCache, DAY
+                self._repo.cache = ResponseCache(
+                    args.cache or 'omdb_cache.sqlite',
+                    ttl=args.cache_ttl * DAY, max_entries=args.cache_size)
+                self._repo.offline = args.offline
+        return self._repo
 
-        if args.populate:
-            print(repo.populate())
+    def get_filters(self, groups):
+        """ Gets (name, value) filters from --filter_by arguments, None
+        after printing usage if one is invalid """
+        choices = list(FACETS) + list(FILTER_FLAGS)
+        filters = []
+        for group in groups:
+            name = group[0]
+            arity = 2 if name in FACETS else 1
+            if name not in choices or len(group) != arity:
+                print(f"usage: movies.py [-f] filter - choose from: "
+                      f"{choices}")
+                return None
+            filters.append((name, group[1] if name in FACETS else None))
+        return filters
+
+    def phase(self, name):
+        """ Times block as --timings phase, does nothing without it """
+        if self.timings is None:
+            return contextlib.nullcontext()
+        return self.timings.phase(name)
+
+    def show(self, columns, data):
+        """ Prints rows, or exports them when --export is given """
+        if self.timings is not None:
+            # producing rows is query, fetch and Python time, not printing
+            data = self.timings.iterate(data, 'rows')
+        with self.phase('print'):
+            if self.args.export:
+                from classes.Exporter import export
+                columns = [column.lower() for column in columns]
+                count = export(data, columns, self.args.export)
+                print(f"Exported {count} rows to {self.args.export}")
+            else:
+                PrintFiltered(data, self.args.width).print(columns, data)
 
-        if args.highscores:
-            data = repo.get_highscores()
-            PrintHighscores(data).print(data)
+    def query(self, page):
+        """ Shows --sort_by and --filter_by results, combined into one
+        query when several are given """
+        args = self.args
+        filters = self.get_filters(args.filter_by or [])
+        if filters is None:
+            return
+        sort = args.sort_by or []
+        if len(filters) + len(sort) > 1 or args.ascending and \
+                args.top is None and sort:
+            keys = [(column, not args.ascending) for column in sort]
+            if args.top is not None:
+                page['limit'] = args.top
+            (columns, data) = self.repo.find(filters, keys, args.match, **page)
+            self.show(columns, data)
 
-        if args.sort_by:
-            sorter = args.sort_by[0]
+        elif sort:
+            sorter = sort[0]
             columns = ('Title', sorter)
             if sorter == 'cast':
                 sorter = 'movies.cast'
-            if sorter == 'runtime':
-                data = repo.get_sorted_by_runtime()
+            if args.top is not None:
+                data = self.repo.get_top(
+                    sorter, args.top, descending=not args.ascending)
             else:
-                data = repo.get_sorted_by(sorter)
-            PrintFiltered(data).print(columns, data)
+                data = self.repo.get_sorted_by(sorter, **page)
+            self.show(columns, data)
 
-        if args.filter_by:
-            choices = [
-                'director', 'actor', 'language',
-                'awarded', 'nominated', 'earned'
-                ]
-            if list(args.filter_by) == [] or args.filter_by[0] not in choices:
-                print(f"usage: movies.py [-f] filter - choose from: {choices}")
+        elif filters:
+            (filter, value) = filters[0]
+            columns = ('Title', filter)
+
+            if filter in FACETS:
+                data = self.repo.get_filtered_by(
+                    filter, value, args.match, **page)
+                self.show(columns, data)
+
+            if filter == 'nominated':
+                data = self.repo.get_nominated(**page)
+                self.show(columns, data)
+
+            if filter == 'awarded':
+                data = self.repo.get_awarded(**page)
+                self.show(columns, data)
+
+            if filter == 'earned':
+                data = self.repo.get_earned(**page)
+                self.show(columns, data)
+
+    def main(self):
+        """ Main function"""
+        args = self.args = self.parser.parse_args()
+        if args.top is not None and not args.sort_by:
+            self.parser.error("--top needs --sort_by")
+        if args.export:
+            # fail on the file name before any query runs
+            from classes.Exporter import get_format
+            try:
+                get_format(args.export)
+            except ValueError as e:
+                self.parser.error(str(e))
+        if args.timings:
+            from classes.Timings import Timings
+            self.timings = Timings(self.started)
+            self.timings.add('parse', time.perf_counter() - self.started)
+        if args.startup_profile:
+            from classes.Startup import profile_startup
+            profile_startup([
+                arg for arg in sys.argv[1:] if arg != '--startup-profile'])
+            return
+        page = dict(limit=args.limit, offset=args.offset, after=args.after)
+        if args.serve is not None:
+            from classes.Server import serve, DEFAULT_ADDRESS
+            serve(args.serve or DEFAULT_ADDRESS, self.repo)
+            return
+        if args.populate or args.add:
+            from classes.Repository import get_session
+            from classes.Client import OMDbClient, AdaptiveLimit
+            workers = max(args.workers, 1)
+            self.repo.client = OMDbClient(
+                get_session(workers), rate=args.rate, timeout=args.timeout,
+                retries=max(args.retries, 0),
+                limit=AdaptiveLimit(workers) if workers > 1 else None)
 
-            filter = args.filter_by[0]
-            if args.filter_by[0] not in ['nominated', 'awarded', 'earned']:
-                value = args.filter_by[1]
+        if args.import_file:
+            self.repo.import_file(args.import_file,
+                                  batch_size=max(args.batch_size, 1))
+
+        if args.populate:
+            from classes.Cache import DAY
+            if args.max_age is not None:
+                max_age = args.max_age * DAY
             else:
-                value = ''
+                max_age = None if args.incremental else 0
+            self.repo.populate(workers=workers,
+                               batch_size=max(args.batch_size, 1),
+                               max_age=max_age)
 
-            if filter == 'director':
-                columns = ('Title', filter)
-                data = repo.get_filtered_by(filter, value)
-                PrintFiltered(data).print(columns, data)
+        if args.rebuild_highscores:
+            diff = self.repo.rebuild_highscores()
+            for row in diff:
+                print(*row)
+            print(f"Highscores rebuilt, {len(diff)} rows differed")
 
-            if filter == 'actor':
-                columns = ('Title', filter)
-                filter = 'movies.cast'
-                data = repo.get_filtered_by(filter, value)
-                PrintFiltered(data).print(columns, data)
+        if args.highscores is not None:
+            metrics = args.highscores or HIGHSCORES
+            data = self.repo.get_highscores(
+                metrics, max(args.highscores_top, 1))
+            if args.export:
+                self.show(('Metric', 'Title', 'Value'), data)
+            else:
+                with self.phase('print'):
+                    PrintHighscores(data).print(data)
 
-            if filter == 'language':
-                columns = ('Title', filter)
-                data = repo.get_filtered_by(filter, value)
-                PrintFiltered(data).print(columns, data)
+        if args.search and not self.repo.db.fts:
+            print("--search needs SQLite built with FTS5, which this "
+                  "Python's sqlite3 lacks")
 
-            if filter == 'nominated':
-                columns = ('Title', filter)
-                data = repo.get_nominated()
-                PrintFiltered(data).print(columns, data)
+        elif args.search:
+            columns = ('Title', 'Match')
+            data = self.repo.search(' '.join(args.search), args.limit or 20)
+            self.show(columns, data)
 
-            if filter == 'awarded':
-                columns = ('Title', filter)
-                data = repo.get_awarded()
-                awarded = []
-                for movie in data:
-                    wins = self.award_parser.get_awards(str(movie))
-                    nominations = self.award_parser.get_nominations(str(movie))
-                    if nominations != 0 and wins/nominations > 0.8:
-                        awarded.append(movie)
-                PrintFiltered(awarded).print(columns, awarded)
+        # the whole table is exported only if no query produced rows
+        if args.export and not (
+                args.sort_by or args.filter_by or args.search
+                or args.compare or args.highscores is not None):
+            self.show(('id', ) + MOVIE_COLUMNS, self.repo.get_all())
 
-            if filter == 'earned':
-                columns = ('Title', filter)
-                data = repo.get_earned()
-                PrintFiltered(data).print(columns, data)
+        self.query(page)
 
         if args.add:
             title = args.add[0]
-            repo.add(title)
+            self.repo.add(title)
 
         if args.compare:
             comparator = args.compare[0]
-            movies = (args.compare[1], args.compare[2])
+            movies = args.compare[1:]
+            if comparator not in COMPARE_COLUMNS:
+                print(f"usage: movies.py -c column title [title ...] - "
+                      f"choose from: {list(COMPARE_COLUMNS)}")
 
-            if comparator == 'imdb_rating':
-                print(CompareNumeric(repo.get_imdb_rating(movies)).compare())
+            elif args.compare_pairs:
+                skipped = []
+                columns = ('Movie1', 'Movie2', 'Winner')
+                data = self.repo.compare_file(
+                    comparator, args.compare_pairs, skipped)
+                self.show(columns, data)
+                for (number, reason) in skipped[:20]:
+                    print(f"Skipped line {number}: {reason}")
 
-            if comparator == 'runtime':
-                print(CompareNumeric(repo.get_runtime(movies)).compare())
+            elif len(movies) == 2:
+                ranking = self.repo.get_compared(comparator, movies)
+                # like compare_pairs and the server, both have to exist
+                print(ranking[0][0] if len(ranking) == 2
+                      else "Movies not found")
 
-            if comparator == 'box_office':
-                print(CompareNumeric(repo.get_box_office(movies)).compare())
+            else:
+                columns = ('Title', comparator)
+                ranking = self.repo.get_compared(comparator, movies)
+                self.show(columns, [row[:2] for row in ranking])
 
-            if comparator == 'awards':
-                print(CompareAwards(repo.get_awards(movies)).compare())
+        if self.timings is not None:
+            self.timings.report(self.instrumentation, sys.stderr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,38 @@
+"""Thin client querying a running `movies.py --serve` server"""
+import argparse
+import json
+import sys
+
+from classes.Server import DEFAULT_ADDRESS, query
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Query a running movies.py --serve server, e.g. \
+            sort by=year limit=10 or compare by=runtime movie=Alien \
+            movie=Memento")
+    parser.add_argument(
+        "--address", help="Server host:port, [IPv6]:port or Unix socket path",
+        default=DEFAULT_ADDRESS)
+    parser.add_argument(
+        "endpoint", choices=['sort', 'filter', 'search', 'compare',
+                             'highscores', 'stats'])
+    parser.add_argument(
+        "params", nargs='*', metavar='NAME=VALUE',
+        help="Query parameters, repeat a name for several values")
+    args = parser.parse_args(argv)
+    params = {}
+    for param in args.params:
+        (name, _, value) = param.partition('=')
+        params.setdefault(name, []).append(value)
+    try:
+        data = query(args.address, args.endpoint, **params)
+    except (OSError, ValueError) as e:
+        print(f"Query failed: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(data))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
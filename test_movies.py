@@ -1,7 +1,26 @@
+import csv
+import gzip
+import json
+import pytest
+import requests
+import sqlite3
 from classes.Movie import Movie
-from classes.HelperClasses import Highscore
-from classes.DB import DB
+from classes.HelperClasses import HighscoreAggregator, percentile
+from classes.DB import DB, METRICS, MOVIE_COLUMNS, build_query, compile_query
+from classes.Exporter import export
+from classes.Printer import PrintFiltered
+from classes.Repository import Repository, read_pairs
 import classes.Repository
+from classes.Client import OMDbClient, TokenBucket, CircuitBreaker, \
+    CircuitOpenError, AdaptiveLimit
+from classes.Server import make_server, query, split_address, join_address
+from classes.Startup import parse_importtime
+from classes.Timings import Instrumentation, Timings
+from benchmarks.catalog import Catalog
+from benchmarks.queries import benchmark, compare
+from benchmarks.omdb_server import FakeOMDb, load_fixtures
+import benchmarks.ingest
+from classes.Cache import ResponseCache, ResultCache, cache_key
 
 FAKE_URL = 'http://fake_url'
 
@@ -160,60 +179,1185 @@ def test_get_runtime(mock_db_populated):
     assert 'Boyhood' in str(result)
 
 
-def test_get_for_highscores(mock_db_populated):
-    db = DB.get_for_highscores(mock_db_populated)
-    result = db.fetchall()
-    assert len(result) == 5
-    assert 'Alien' in str(result)
-    assert '165 min' in str(result)
-    assert '$23,844,220' in str(result)
-    assert 'Won 6 Oscars. Another 40 wins & 67 nominations.' in str(result)
-    assert '9.3' in str(result)
+def test_get_movie_with_session(mock_session, auth):
+    """Test that function uses given session instead of module requests"""
+    params = {"t": "Boyhood", "apikey": auth}
+    result = classes.Repository.get_movie(
+        FAKE_URL, params=params, session=mock_session)
+    assert result['Title'] == 'Boyhood'
+    assert mock_session.calls == [params]
 
 
-def test_get_highest_runtime(mock_db_populated):
-    db = DB.get_for_highscores(mock_db_populated)
-    result = db.fetchall()
-    winner = Highscore().get_highest_runtime(result)
-    assert 'Boyhood' in str(winner)
-    assert '165 min' in str(winner)
+def test_percentile():
+    values = [0.5, 0.1, 0.4, 0.3, 0.2]
+    assert percentile(values, 50) == 0.3
+    assert percentile(values, 99) == 0.5
+    assert percentile([], 50) == 0.0
 
 
-def test_get_highest_box_office(mock_db_populated):
-    db = DB.get_for_highscores(mock_db_populated)
-    result = db.fetchall()
-    winner = Highscore().get_highest_box_office(result)
-    assert 'Forrest Gump' in str(winner)
-    assert '$330,000,000' in str(winner)
+def test_populate_concurrent(memory_db, mock_session):
+    titles = list(mock_session.fixtures) + ['Unknown Title']
+    for title in titles:
+        DB.insert(memory_db, title)
+    repo = Repository(memory_db, parser=None)
+    repo.populate(workers=4, session=mock_session)
+    assert len(mock_session.calls) == len(titles)
+    result = DB.get_awards(memory_db, 'Alien', 'Forrest Gump').fetchall()
+    assert ('Alien', 'Won 1 Oscar. Another 16 wins & 19 nominations.', 16) \
+        in result
+    assert ('Forrest Gump', 'Won 6 Oscars. Another 40 wins & 67 nominations.',
+            40) in result
 
 
-def test_get_most_oscars(mock_db_populated):
-    db = DB.get_for_highscores(mock_db_populated)
-    result = db.fetchall()
-    winner = Highscore().get_oscars_highscore(result)
-    assert 'Forrest Gump' in str(winner)
-    assert '6' in str(winner)
+def test_populate_incremental_retries_failed(memory_db, mock_session):
+    for title in ('Alien', 'Memento', 'Unknown Title'):
+        DB.insert(memory_db, title)
+    repo = Repository(memory_db, parser=None)
+    repo.populate(session=mock_session, max_age=None)
+    states = dict(memory_db.cursor.execute(
+        "select title, fetch_status from movies").fetchall())
+    assert states == {
+        'Alien': 'ok', 'Memento': 'ok', 'Unknown Title': 'not_found'}
+    calls = len(mock_session.calls)
+    repo.populate(session=mock_session, max_age=None)
+    assert [params['t'] for params in mock_session.calls[calls:]] == \
+        ['Unknown Title']
 
 
-def test_get_most_nominations(mock_db_populated):
-    db = DB.get_for_highscores(mock_db_populated)
-    result = db.fetchall()
-    winner = Highscore().get_nominations_highscore(result)
-    assert 'Boyhood' in str(winner)
-    assert '209' in str(winner)
+def test_populate_stale_skips_unchanged_payload(memory_db, mock_session):
+    DB.insert(memory_db, 'Alien')
+    DB.insert(memory_db, 'Memento')
+    repo = Repository(memory_db, parser=None)
+    repo.populate(session=mock_session)
+    memory_db.cursor.execute(
+        "update movies set director='Edited', fetched_at=0 \
+        where title='Alien'")
+    calls = len(mock_session.calls)
+    repo.populate(session=mock_session, max_age=60)
+    assert [params['t'] for params in mock_session.calls[calls:]] == \
+        ['Alien']
+    (director, fetched_at) = memory_db.cursor.execute(
+        "select director, fetched_at from movies where title='Alien'"
+    ).fetchone()
+    assert director == 'Edited'
+    assert fetched_at > 0
 
 
-def test_get_most_awards(mock_db_populated):
-    db = DB.get_for_highscores(mock_db_populated)
-    result = db.fetchall()
-    winner = Highscore().get_awards_highscore(result)
-    assert 'Boyhood' in str(winner)
-    assert '171' in str(winner)
+def test_populate_checkpoints_before_interrupt(memory_db, mock_session,
+                                               monkeypatch):
+    import concurrent.futures
 
+    class InterruptedSession(type(mock_session)):
+        def get(self, url, params):
+            if params['t'] == 'Boyhood':
+                raise KeyboardInterrupt
+            return super().get(url, params)
 
-def test_get_highest_imdb_rating(mock_db_populated):
-    db = DB.get_for_highscores(mock_db_populated)
-    result = db.fetchall()
-    winner = Highscore().get_highest_imdb_rating(result)
-    assert 'The Shawshank Redemption' in str(winner)
-    assert '9.3' in str(winner)
+    # hand over all fetches in one done set, so the interrupted fetch
+    # finishes together with the others whatever the set order
+    wait = concurrent.futures.wait
+    monkeypatch.setattr(
+        concurrent.futures, 'wait',
+        lambda futures, return_when: wait(futures))
+    for title in ('Alien', 'Boyhood', 'Memento'):
+        DB.insert(memory_db, title)
+    repo = Repository(memory_db, parser=None)
+    with pytest.raises(KeyboardInterrupt):
+        repo.populate(session=InterruptedSession(), workers=2, batch_size=1)
+    memory_db.conn.rollback()
+    result = DB.get_titles_to_fetch(memory_db).fetchall()
+    assert result == [('Boyhood', None)]
+
+
+def test_upsert_many_inserts_and_updates(memory_db):
+    DB.insert(memory_db, 'Alien')
+    movies = [
+        Movie(title='Alien', director='Ridley Scott'),
+        Movie(title='Memento', director='Christopher Nolan'),
+    ]
+    assert DB.upsert_many(memory_db, movies, chunk_size=1) == 2
+    result = DB.get_filtered_by(
+        memory_db, 'director', '', match='substring').fetchall()
+    assert sorted(result) == [
+        ('Alien', 'Ridley Scott'), ('Memento', 'Christopher Nolan')]
+
+
+def test_add_inserts_movie(memory_db, mock_session):
+    repo = Repository(memory_db, parser=None)
+    repo.add('Memento', session=mock_session)
+    repo.add('Unknown Title', session=mock_session)
+    result = DB.get_all_titles(memory_db).fetchall()
+    assert result == [('Memento', )]
+
+
+def test_set_pragmas_rejects_unknown_mode(memory_db):
+    with pytest.raises(ValueError):
+        memory_db.set_pragmas(journal_mode='fast')
+
+
+def test_cache_key_ignores_apikey_and_case():
+    assert cache_key({'t': 'Alien ', 'apikey': 'a'}) == \
+        cache_key({'apikey': 'b', 't': 'alien'})
+
+
+def test_cache_hit_and_miss(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    assert cache.get({'t': 'Alien'}) is None
+    cache.put({'t': 'Alien'}, {'Title': 'Alien'})
+    assert cache.get({'t': 'alien'}) == {'Title': 'Alien'}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_ttl_expired(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    cache.put({'t': 'Alien'}, {'Title': 'Alien'}, ttl=-1)
+    assert cache.get({'t': 'Alien'}) is None
+    assert len(cache) == 0
+
+
+def test_cache_lru_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_entries=2)
+    cache.put({'t': 'Alien'}, {'Title': 'Alien'})
+    cache.put({'t': 'Memento'}, {'Title': 'Memento'})
+    cache.get({'t': 'Alien'})
+    cache.put({'t': 'Boyhood'}, {'Title': 'Boyhood'})
+    assert cache.get({'t': 'Memento'}) is None
+    assert cache.get({'t': 'Alien'}) == {'Title': 'Alien'}
+    assert cache.evictions == 1
+
+
+def test_cache_batches_hit_touches(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = ResponseCache(path, max_entries=10, touch_batch=3)
+    titles = ('Alien', 'Boyhood', 'Memento')
+    for title in titles:
+        cache.put({'t': title}, {'Title': title})
+    changes = cache.conn.total_changes
+    for title in titles[:2] * 2:
+        cache.get({'t': title})
+    assert cache.conn.total_changes == changes
+    cache.get({'t': 'Memento'})
+    assert cache.conn.total_changes == changes + 3
+    cache.put({'t': 'Alien'}, {'Title': 'Alien'})
+    assert len(cache) == 3
+    assert len(ResponseCache(path)) == 3
+
+
+def test_result_cache_lru_and_versions():
+    cache = ResultCache(max_entries=2, max_rows=2)
+    assert list(cache.get('a', 1, lambda: iter([1, 2]))) == [1, 2]
+    assert list(cache.get('a', 1, lambda: iter([]))) == [1, 2]
+    cache.get('b', 1, lambda: [3])
+    cache.get('a', 1, lambda: [])
+    cache.get('c', 1, lambda: [4])
+    assert cache.get('b', 1, lambda: ['new']) == ['new']
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 4, 2)
+    assert list(cache.get('big', 1, lambda: iter([1, 2, 3]))) == [1, 2, 3]
+    assert 'big' not in cache.entries
+    assert cache.get('a', 2, lambda: ['changed']) == ['changed']
+    assert cache.invalidations == 1
+    assert cache.get('a', None, lambda: ['open']) == ['open']
+    assert cache.get('a', 2, lambda: []) == ['changed']
+
+
+def test_result_cache_streams_iterators():
+    def rows():
+        yield 1
+        raise AssertionError("read ahead")
+
+    cache = ResultCache(max_rows=10)
+    assert next(cache.get('a', 1, rows)) == 1
+    assert 'a' not in cache.entries
+    streamed = cache.get('b', 1, lambda: iter([1, 2]))
+    assert next(streamed) == 1
+    assert 'b' not in cache.entries
+    assert list(streamed) == [2]
+    assert list(cache.get('b', 1, lambda: iter([]))) == [1, 2]
+
+
+def test_repository_results_follow_writes(memory_db):
+    repo = Repository(memory_db, None, results=ResultCache())
+    DB.upsert(memory_db, Movie(title='Alien', director='Ridley Scott'))
+    memory_db.conn.commit()
+    for _ in range(3):
+        assert list(repo.get_filtered_by('director', 'Ridley Scott')) == \
+            [('Alien', 'Ridley Scott')]
+    assert (repo.results.hits, repo.results.misses) == (2, 1)
+    DB.upsert(memory_db, Movie(title='Gladiator', director='Ridley Scott'))
+    # uncommitted rows are read but not cached, they may be rolled back
+    assert len(list(repo.get_filtered_by('director', 'Ridley Scott'))) == 2
+    memory_db.conn.rollback()
+    assert list(repo.get_filtered_by('director', 'Ridley Scott')) == \
+        [('Alien', 'Ridley Scott')]
+    DB.upsert(memory_db, Movie(title='Gladiator', director='Ridley Scott'))
+    memory_db.conn.commit()
+    assert len(list(repo.get_filtered_by('director', 'Ridley Scott'))) == 2
+
+
+def test_repository_results_follow_other_connections(tmp_path):
+    path = str(tmp_path / 'movies.sqlite')
+    db = DB(path)
+    db.upsert(Movie(title='Alien', runtime='117 min'))
+    db.conn.commit()
+    repo = Repository(db, None, results=ResultCache())
+    assert repo.get_top('runtime', 5) == [('Alien', '117 min')]
+    assert repo.get_top('runtime', 5) == [('Alien', '117 min')]
+    other = DB(path)
+    other.upsert(Movie(title='Boyhood', runtime='165 min'))
+    other.conn.commit()
+    other.close()
+    assert repo.get_top('runtime', 5) == \
+        [('Boyhood', '165 min'), ('Alien', '117 min')]
+    assert (repo.results.hits, repo.results.invalidations) == (1, 1)
+    db.close()
+
+
+def test_populate_offline_from_cache(memory_db, mock_session, tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    DB.insert(memory_db, 'Alien')
+    DB.insert(memory_db, 'Memento')
+    Repository(memory_db, None, cache=cache).populate(
+        session=mock_session)
+    cache.put({'t': 'Memento'}, {}, ttl=-1)
+    DB.upsert(memory_db, Movie(title='Alien'))
+    calls = len(mock_session.calls)
+    Repository(memory_db, None, cache=cache, offline=True).populate(
+        session=mock_session)
+    assert len(mock_session.calls) == calls
+    result = DB.get_filtered_by(
+        memory_db, 'director', 'Ridley Scott').fetchall()
+    assert result == [('Alien', 'Ridley Scott')]
+
+
+def test_movie_typed_fields(mock_db_ok):
+    boyhood = Movie.json_to_movie(mock_db_ok.json('fixtures/boyhood.json'))
+    assert boyhood.year_int == 2014
+    assert boyhood.runtime_minutes == 165
+    assert boyhood.box_office_usd == 18859617
+    assert boyhood.imdb_votes_int == 319096
+    assert boyhood.imdb_rating_real == 7.9
+    alien = Movie.json_to_movie(mock_db_ok.json())
+    assert alien.box_office_usd is None
+
+
+def test_parse_year_range():
+    assert classes.HelperClasses.Parser.parse_year(None, '2010–2015') == 2010
+    assert classes.HelperClasses.Parser.parse_year(None, 'N/A') is None
+
+
+def test_sort_by_runtime_typed(mock_db_populated):
+    result = DB.get_sorted_by(mock_db_populated, 'runtime').fetchall()
+    assert result[0] == ('Boyhood', '165 min')
+    assert result[-1] == ('Memento', '113 min')
+
+
+def test_typed_columns_backfilled(tmp_path):
+    path = str(tmp_path / 'old.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "create table movies (ID INTEGER PRIMARY KEY, TITLE text, \
+        YEAR integer, RUNTIME text, GENRE text, DIRECTOR text, CAST text, \
+        WRITER text, LANGUAGE text, COUNTRY text, AWARDS text, \
+        IMDb_Rating float, IMDb_votes integer, BOX_OFFICE integer)")
+    conn.execute(
+        "insert into movies (title, runtime, box_office) \
+        values ('Alien', '117 min', '$1,000')")
+    conn.commit()
+    conn.close()
+    db = DB(path)
+    result = db.cursor.execute(
+        "select runtime_minutes, box_office_usd from movies").fetchall()
+    db.close()
+    assert result == [(117, 1000)]
+
+
+def test_get_oscar_nominations():
+    parser = classes.HelperClasses.Parser()
+    assert parser.get_oscar_nominations(
+        "Nominated for 7 Oscars. Another 19 wins & 32 nominations.") == 7
+    assert parser.get_oscar_nominations(
+        "Won 6 Oscars. Another 40 wins & 67 nominations.") == 6
+    assert parser.get_oscar_nominations("N/A") == 0
+
+
+def test_movie_award_counts(mock_db_ok):
+    memento = Movie.json_to_movie(mock_db_ok.json('fixtures/memento.json'))
+    assert (memento.wins, memento.nominations) == (56, 55)
+    assert (memento.oscars, memento.oscar_nominations) == (0, 2)
+    assert memento.win_ratio == 56 / 55
+    assert Movie(title='Alien').win_ratio is None
+
+
+def test_filter_awarded(mock_db_populated):
+    result = DB.get_awarded(mock_db_populated).fetchall()
+    titles = sorted(title for (title, _) in result)
+    assert titles == ['Alien', 'Boyhood', 'Memento']
+
+
+def test_get_highscores(mock_db_populated):
+    highscores = Repository(mock_db_populated, None).get_highscores()
+    assert highscores == [
+        ('runtime', 'Boyhood', '165 min'),
+        ('box_office', 'Forrest Gump', '$330,000,000'),
+        ('awards', 'Boyhood', 171),
+        ('nominations', 'Boyhood', 209),
+        ('oscars', 'Forrest Gump', 6),
+        ('imdb_rating', 'The Shawshank Redemption', 9.3),
+    ]
+
+
+def test_get_highscores_top_n_ties(mock_db_populated):
+    repo = Repository(mock_db_populated, None)
+    highscores = repo.get_highscores(['runtime', 'year'], top=3)
+    assert highscores == [
+        ('runtime', 'Boyhood', '165 min'),
+        ('runtime', 'Forrest Gump', '142 min'),
+        ('runtime', 'The Shawshank Redemption', '142 min'),
+        ('year', 'Boyhood', 2014),
+        ('year', 'Memento', 2000),
+        ('year', 'Forrest Gump', 1994),
+    ]
+
+
+def test_highscore_aggregator_matches_full_scan(mock_db_populated):
+    metrics = ['awards', 'imdb_votes', 'win_ratio']
+    scan = HighscoreAggregator(metrics, top=2).consume(
+        DB.get_metrics(mock_db_populated, metrics), chunk_size=2)
+    indexed = HighscoreAggregator(metrics, top=2).consume(
+        DB.get_metrics(mock_db_populated, metrics, top=2))
+    assert scan.results() == indexed.results()
+    assert len(scan.results()) == 6
+
+
+def test_split_list():
+    data = "Dan O'Bannon (screenplay by), Dan O'Bannon (story by), " \
+        "Ronald Shusett (story by)"
+    assert classes.HelperClasses.Parser.split_list(None, data) == \
+        ["Dan O'Bannon", 'Ronald Shusett']
+    assert classes.HelperClasses.Parser.split_list(None, 'N/A') == []
+
+
+def test_filter_exact_no_false_positives(memory_db):
+    DB.upsert(memory_db, Movie(title='Alien', cast='Ian Holm'))
+    DB.upsert(memory_db, Movie(title='Mars', cast='Brian Cox'))
+    result = DB.get_filtered_by(memory_db, 'actor', 'ian holm').fetchall()
+    assert result == [('Alien', 'Ian Holm')]
+    result = DB.get_filtered_by(
+        memory_db, 'actor', 'Ian', match='substring').fetchall()
+    assert len(result) == 2
+
+
+def test_filter_prefix(mock_db_populated):
+    result = DB.get_filtered_by(
+        mock_db_populated, 'writer', 'Dan O', match='prefix').fetchall()
+    assert [title for (title, _) in result] == ['Alien']
+    result = DB.get_filtered_by(
+        mock_db_populated, 'genre', 'Sci', match='prefix').fetchall()
+    assert [title for (title, _) in result] == ['Alien']
+
+
+def test_filter_reindexed_on_update(memory_db):
+    DB.upsert(memory_db, Movie(title='Alien', director='Ridley Scott'))
+    DB.upsert(memory_db, Movie(title='Alien', director='James Cameron'))
+    assert DB.get_filtered_by_director(
+        memory_db, 'Ridley Scott').fetchall() == []
+    assert len(DB.get_filtered_by_director(
+        memory_db, 'James Cameron').fetchall()) == 1
+
+
+def test_search_ranked(mock_db_populated):
+    result = DB.search(mock_db_populated, 'nolan').fetchall()
+    assert [title for (title, _) in result] == ['Memento']
+    result = DB.search(mock_db_populated, 'drama', limit=2).fetchall()
+    assert len(result) == 2
+
+
+def test_search_multi_column(mock_db_populated):
+    result = DB.search(mock_db_populated, 'weaver scott').fetchall()
+    assert [title for (title, _) in result] == ['Alien']
+    assert DB.search(mock_db_populated, 'weaver nolan').fetchall() == []
+
+
+def test_search_follows_updates(memory_db):
+    DB.upsert(memory_db, Movie(title='Alien', director='Ridley Scott'))
+    DB.upsert(memory_db, Movie(title='Alien', director='James Cameron'))
+    assert DB.search(memory_db, 'ridley').fetchall() == []
+    assert len(DB.search(memory_db, 'cameron').fetchall()) == 1
+
+
+def test_search_quotes_special_characters(memory_db):
+    DB.upsert(memory_db, Movie(title='Alien', director='Ridley Scott'))
+    assert DB.search(memory_db, 'ridley "AND (x*').fetchall() == []
+
+
+def test_highscores_table_follows_writes(memory_db):
+    repo = Repository(memory_db, None)
+    DB.upsert(memory_db, Movie(title='Alien', runtime='117 min'))
+    DB.upsert(memory_db, Movie(title='Boyhood', runtime='165 min'))
+    assert repo.get_highscores(['runtime']) == \
+        [('runtime', 'Boyhood', '165 min')]
+    DB.upsert(memory_db, Movie(title='Boyhood', runtime='90 min'))
+    assert repo.get_highscores(['runtime']) == \
+        [('runtime', 'Alien', '117 min')]
+    memory_db.cursor.execute("delete from movies where title='Alien'")
+    assert repo.get_highscores(['runtime']) == \
+        [('runtime', 'Boyhood', '90 min')]
+    memory_db.cursor.execute("delete from movies")
+    assert repo.get_highscores(['runtime']) == []
+
+
+def test_rebuild_highscores_matches(memory_db, mock_db_ok):
+    for file in ['alien', 'boyhood', 'forrest', 'memento']:
+        DB.upsert(memory_db, Movie.json_to_movie(
+            mock_db_ok.json(f'fixtures/{file}.json')))
+    repo = Repository(memory_db, None)
+    before = repo.get_highscores(list(METRICS))
+    assert repo.rebuild_highscores() == []
+    assert repo.get_highscores(list(METRICS)) == before
+    memory_db.cursor.execute("delete from highscores")
+    assert len(repo.rebuild_highscores()) == len(METRICS)
+
+
+def test_columnar_reloads_after_other_writes(tmp_path):
+    pytest.importorskip('numpy')
+    from classes.Columnar import ColumnarRepository
+    path = str(tmp_path / 'movies.sqlite')
+    db = DB(path)
+    db.upsert(Movie(title='Alien', runtime='117 min'))
+    db.conn.commit()
+    repo = ColumnarRepository(db, None)
+    assert repo.get_top('runtime', 5) == [('Alien', '117 min')]
+    other = DB(path)
+    other.upsert(Movie(title='Boyhood', runtime='165 min'))
+    other.conn.commit()
+    other.close()
+    assert repo.get_top('runtime', 5) == \
+        [('Boyhood', '165 min'), ('Alien', '117 min')]
+    db.close()
+
+
+def test_columnar_matches_sqlite(mock_db_populated):
+    pytest.importorskip('numpy')
+    from classes.Columnar import ColumnarRepository
+    sqlite = Repository(mock_db_populated, None)
+    columnar = ColumnarRepository(mock_db_populated, None)
+    assert sorted(columnar.get_earned()) == sorted(sqlite.get_earned())
+    assert sorted(columnar.get_awarded()) == sorted(sqlite.get_awarded())
+    assert sorted(columnar.get_nominated()) == sorted(sqlite.get_nominated())
+    metrics = list(METRICS)
+    assert columnar.get_highscores(metrics, top=2) == \
+        sqlite.get_highscores(metrics, top=2)
+    assert sorted(columnar.get_runtime(['alien', 'Boyhood'])) == \
+        sorted(sqlite.get_runtime(['alien', 'Boyhood']))
+    movies = ['Memento', 'alien', 'Boyhood', 'Joker']
+    assert columnar.get_compared('imdb_rating', movies) == \
+        sqlite.get_compared('imdb_rating', movies)
+
+
+def test_columnar_sorted_by(mock_db_populated):
+    pytest.importorskip('numpy')
+    from classes.Columnar import ColumnarRepository
+    columnar = ColumnarRepository(mock_db_populated, None)
+    result = columnar.get_sorted_by('box_office')
+    assert result[0] == ('Forrest Gump', '$330,000,000')
+    assert [value for (_, value) in result[-2:]] == ['N/A', 'N/A']
+    result = columnar.get_sorted_by('title')
+    assert [title for (title, _) in result] == sorted(
+        [title for (title, _) in result], reverse=True)
+
+
+def test_sorted_by_pagination(mock_db_populated):
+    repo = Repository(mock_db_populated, None)
+    everything = list(repo.get_sorted_by('runtime'))
+    first = list(repo.get_sorted_by('runtime', limit=2))
+    assert first == everything[:2]
+    second = list(repo.get_sorted_by(
+        'runtime', limit=2, after=first[-1][0]))
+    assert second == everything[2:4]
+    assert list(repo.get_sorted_by('runtime', offset=4)) == everything[4:]
+
+
+def test_sorted_by_keyset_nulls(mock_db_populated):
+    repo = Repository(mock_db_populated, None)
+    everything = list(repo.get_sorted_by('box_office'))
+    assert [value for (_, value) in everything[-2:]] == ['N/A', 'N/A']
+    after = list(repo.get_sorted_by('box_office', after=everything[3][0]))
+    assert after == everything[4:]
+
+
+def test_filter_pagination(mock_db_populated):
+    repo = Repository(mock_db_populated, None)
+    everything = list(repo.get_filtered_by('language', 'English'))
+    assert len(everything) == 5
+    page = list(repo.get_filtered_by(
+        'language', 'English', after=everything[1][0], limit=2))
+    assert page == everything[2:4]
+
+
+def test_columnar_pagination_matches_sqlite(mock_db_populated):
+    pytest.importorskip('numpy')
+    from classes.Columnar import ColumnarRepository
+    sqlite = Repository(mock_db_populated, None)
+    columnar = ColumnarRepository(mock_db_populated, None)
+    for column in ['runtime', 'box_office', 'title']:
+        assert columnar.get_sorted_by(column, limit=3, after='Alien') == \
+            list(sqlite.get_sorted_by(column, limit=3, after='Alien'))
+
+
+def test_print_filtered_streams_iterator(capsys):
+    rows = iter([('Alien', 1979), ('The Shawshank Redemption', 1994)])
+    PrintFiltered(rows).print(('Title', 'year'), rows)
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 3
+    assert lines[2].startswith('The Shawshank Redemption  ')
+
+
+def test_print_filtered_width_sample(capsys):
+    rows = [('Alien', 1)] * PrintFiltered.sample + [('A much longer title', 2)]
+    printer = PrintFiltered(rows)
+    assert printer.width == 7
+    assert PrintFiltered(rows, width=30).width == 30
+
+
+def test_import_file(memory_db, mock_db_ok, tmp_path):
+    path = tmp_path / 'movies.jsonl'
+    with open(path, 'w') as f:
+        for file in ['alien', 'boyhood', 'memento']:
+            data = mock_db_ok.json(f'fixtures/{file}.json')
+            f.write(json.dumps(data) + '\n')
+        f.write('{"Title": "Broken"\n')
+        f.write('\n')
+        f.write('{"Response": "False", "Error": "Movie not found!"}\n')
+        f.write('{"Title": "No Fields"}\n')
+    repo = Repository(memory_db, None)
+    count, skipped = repo.import_file(str(path), batch_size=2)
+    assert count == 3
+    assert [number for (number, _) in skipped] == [4, 6, 7]
+    assert skipped[1] == (6, 'Movie not found!')
+    assert len(DB.get_all_titles(memory_db).fetchall()) == 3
+    assert repo.get_highscores(['awards']) == [('awards', 'Boyhood', 171)]
+
+
+def test_upsert_many_keeps_schema(tmp_path, mock_db_ok):
+    path = str(tmp_path / 'movies.sqlite')
+    db = DB(path)
+    schema = db.conn.execute("pragma schema_version").fetchone()
+    movies = [Movie.json_to_movie(mock_db_ok.json(f'fixtures/{file}.json'))
+              for file in ['alien', 'boyhood', 'memento']]
+    assert db.upsert_many(movies, chunk_size=1) == 3
+    assert db.conn.execute("pragma schema_version").fetchone() == schema
+    repo = Repository(db, None)
+    assert repo.get_highscores(['awards']) == [('awards', 'Boyhood', 171)]
+    # a bulk load interrupted before its triggers were recreated
+    db.drop_highscores_triggers()
+    db.upsert(Movie(title='Long', runtime='999 min'))
+    db.conn.commit()
+    db.close()
+    db = DB(path)
+    assert Repository(db, None).get_highscores(['runtime']) == \
+        [('runtime', 'Long', '999 min')]
+    db.close()
+
+
+def test_import_file_gzip(memory_db, mock_db_ok, tmp_path):
+    path = tmp_path / 'movies.jsonl.gz'
+    with gzip.open(path, 'wt') as f:
+        f.write(json.dumps(mock_db_ok.json()) + '\n')
+    count, skipped = Repository(memory_db, None).import_file(str(path))
+    assert (count, skipped) == (1, [])
+
+
+def test_export_csv_and_jsonl(mock_db_populated, tmp_path):
+    repo = Repository(mock_db_populated, None)
+    columns = ('id', ) + MOVIE_COLUMNS
+    path = str(tmp_path / 'movies.csv')
+    assert export(repo.get_all(), columns, path, chunk_size=2) == 5
+    with open(path) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == list(columns)
+    assert rows[1][1] == 'Alien'
+    path = str(tmp_path / 'earned.jsonl.gz')
+    assert export(repo.get_earned(), ('title', 'box_office'), path) == 1
+    with gzip.open(path, 'rt') as f:
+        assert json.loads(f.readline()) == \
+            {'title': 'Forrest Gump', 'box_office': '$330,000,000'}
+
+
+def test_export_parquet(mock_db_populated, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    repo = Repository(mock_db_populated, None)
+    path = str(tmp_path / 'movies.parquet')
+    columns = ('id', ) + MOVIE_COLUMNS
+    assert export(repo.get_all(), columns, path, chunk_size=2) == 5
+    table = pq.read_table(path)
+    assert table.num_rows == 5
+    assert table.column('runtime_minutes').to_pylist()[0] == 117
+    assert table.column('year').to_pylist()[0] == '1979'
+
+
+def test_export_writes_only_the_query_result(tmp_path, monkeypatch):
+    import sys
+    import movies
+    monkeypatch.chdir(tmp_path)
+    db = DB('movies.sqlite')
+    for title in ('Alien', 'Memento', 'Boyhood'):
+        db.upsert(Movie(title=title, awards='Won 2 Oscars.'))
+    db.conn.commit()
+    db.close()
+    for (argv, count) in (
+            (['--search', 'Alien'], 1),
+            (['-c', 'runtime', 'Alien', 'Memento', 'Boyhood'], 3),
+            (['--highscores', 'oscars'], 1),
+            ([], 3)):
+        monkeypatch.setattr(
+            sys, 'argv', ['movies.py', *argv, '--export', 'out.jsonl'])
+        movies.Main().main()
+        with open('out.jsonl') as f:
+            assert len(f.readlines()) == count, argv
+
+
+def test_compare_two_needs_both_movies(tmp_path, monkeypatch, capsys):
+    import sys
+    import movies
+    monkeypatch.chdir(tmp_path)
+    db = DB('movies.sqlite')
+    db.upsert(Movie(title='Alien', runtime='117 min'))
+    db.upsert(Movie(title='Memento', runtime='113 min'))
+    db.conn.commit()
+    db.close()
+    for (titles, output) in ((['Alien', 'Memento'], 'Alien'),
+                             (['Alien', 'Missing'], 'Movies not found')):
+        monkeypatch.setattr(
+            sys, 'argv', ['movies.py', '-c', 'runtime', *titles])
+        movies.Main().main()
+        assert capsys.readouterr().out.strip() == output
+
+
+def test_export_format_checked_before_query(tmp_path, monkeypatch, capsys):
+    import sys
+    import movies
+    monkeypatch.chdir(tmp_path)
+    for name in ('out.xml', 'out.parquet.gz'):
+        monkeypatch.setattr(
+            sys, 'argv', ['movies.py', '-s', 'title', '--export', name])
+        with pytest.raises(SystemExit) as exc:
+            movies.Main().main()
+        assert exc.value.code == 2
+        assert 'usage:' in capsys.readouterr().err
+    assert not (tmp_path / 'movies.sqlite').exists()
+
+
+def test_top_needs_sort_by(tmp_path, monkeypatch, capsys):
+    import sys
+    import movies
+    monkeypatch.chdir(tmp_path)
+    for argv in (['--top', '2'],
+                 ['-f', 'director', 'Ridley Scott', '--top', '2']):
+        monkeypatch.setattr(sys, 'argv', ['movies.py', *argv])
+        with pytest.raises(SystemExit) as exc:
+            movies.Main().main()
+        assert exc.value.code == 2
+        assert '--top needs --sort_by' in capsys.readouterr().err
+
+
+def test_export_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        export([], ('title', ), str(tmp_path / 'movies.xml'))
+    with pytest.raises(ValueError, match='zstd'):
+        export([], ('title', ), str(tmp_path / 'movies.parquet.gz'))
+
+
+def test_json_to_movie_error_response():
+    with pytest.raises(ValueError, match='Movie not found!'):
+        Movie.json_to_movie({'Response': 'False', 'Error': 'Movie not found!'})
+
+
+def test_client_retries_rate_limited_and_server_errors(omdb_server):
+    omdb_server.script = [(429, 0), (503, 0)]
+    client = OMDbClient(retries=3, sleep=lambda delay: None)
+    response = client.get(omdb_server.url, {'t': 'Alien'})
+    assert response.json()['Title'] == 'Alien'
+    assert (omdb_server.counts['requests'], client.retried) == (3, 2)
+
+
+def test_client_gives_up_after_retries(omdb_server):
+    omdb_server.script = [(500, 0)] * 2
+    client = OMDbClient(retries=1, sleep=lambda delay: None)
+    with pytest.raises(requests.HTTPError):
+        client.get(omdb_server.url, {'t': 'Alien'})
+
+
+def test_client_timeout(omdb_server):
+    omdb_server.script = [(200, 0.5)]
+    client = OMDbClient(timeout=0.1, retries=0)
+    with pytest.raises(requests.Timeout):
+        client.get(omdb_server.url, {'t': 'Alien'})
+
+
+def test_circuit_breaker_opens_and_recovers(omdb_server):
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=2, reset_after=30,
+                             clock=lambda: now[0])
+    client = OMDbClient(retries=0, breaker=breaker)
+    omdb_server.script = [(500, 0)] * 2
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            client.get(omdb_server.url, {'t': 'Alien'})
+    with pytest.raises(CircuitOpenError):
+        client.get(omdb_server.url, {'t': 'Alien'})
+    assert omdb_server.counts['requests'] == 2
+    now[0] = 30.0
+    assert client.get(omdb_server.url, {'t': 'Alien'}).status_code == 200
+    assert breaker.allow()
+
+
+def test_circuit_breaker_ignores_throttling(omdb_server):
+    breaker = CircuitBreaker(threshold=2)
+    client = OMDbClient(retries=3, breaker=breaker, sleep=lambda delay: None)
+    omdb_server.script = [(429, 0)] * 3
+    assert client.get(omdb_server.url, {'t': 'Alien'}).status_code == 200
+    assert breaker.opened == 0
+
+
+def test_token_bucket_limits_rate():
+    now = [0.0]
+
+    def sleep(delay):
+        now[0] += delay
+
+    bucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0], sleep=sleep)
+    for _ in range(6):
+        bucket.acquire()
+    assert now[0] == pytest.approx(2.0)
+
+
+def test_adaptive_limit_grows_and_backs_off():
+    limit = AdaptiveLimit(maximum=4, target_latency=1.0)
+    for _ in range(10):
+        limit.acquire()
+        limit.release(0.1, ok=True)
+    assert limit.limit == 4
+    limit.acquire()
+    limit.release(0.1, ok=False)
+    assert limit.limit == 2
+    limit.acquire()
+    limit.release(5.0, ok=True)
+    assert limit.limit == 1
+
+
+def test_populate_through_client(memory_db, omdb_server, monkeypatch):
+    monkeypatch.setattr(classes.Repository, 'URL', omdb_server.url)
+    for title in ('Alien', 'Memento'):
+        DB.insert(memory_db, title)
+    omdb_server.script = [(503, 0)]
+    client = OMDbClient(sleep=lambda delay: None, limit=AdaptiveLimit(2))
+    repo = Repository(memory_db, parser=None, client=client)
+    repo.populate(workers=2)
+    result = memory_db.cursor.execute(
+        "select title, fetch_status from movies order by id").fetchall()
+    assert result == [('Alien', 'ok'), ('Memento', 'ok')]
+
+
+def test_server_queries(query_server):
+    address = query_server.address
+    data = query(address, 'sort', by='runtime', limit=2)
+    assert data['rows'] == [
+        ['Boyhood', '165 min'], ['The Shawshank Redemption', '142 min']]
+    data = query(address, 'compare', by='runtime', movie=['Alien', 'Memento'])
+    assert data['winner'] == 'Alien'
+    data = query(address, 'filter', by='director', value='Ridley Scott')
+    assert data['rows'] == [['Alien', 'Ridley Scott']]
+    with pytest.raises(ValueError, match='Unknown sort column'):
+        query(address, 'sort', by='title; drop table movies')
+
+
+def test_server_concurrent_queries(query_server):
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(
+            lambda _: query(query_server.address, 'highscores')['rows'],
+            range(32)))
+    assert all(rows == results[0] for rows in results)
+    assert len(results[0]) == 6
+    assert query(query_server.address, 'stats') == dict(results=None)
+
+
+def test_server_unix_socket(memory_db, tmp_path):
+    import threading
+    path = str(tmp_path / 'movies.sock')
+    server = make_server(path, Repository(memory_db, None))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with pytest.raises(ValueError, match='Unknown endpoint'):
+            query(path, 'missing')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_split_and_join_address():
+    assert split_address('127.0.0.1:8765') == ('127.0.0.1', 8765)
+    assert split_address('[::1]:8765') == ('::1', 8765)
+    assert split_address('::1:8765') == ('::1', 8765)
+    assert join_address('::1', 8765) == '[::1]:8765'
+    assert join_address('localhost', 8765) == 'localhost:8765'
+
+
+def test_server_ipv6(memory_db):
+    import threading
+    try:
+        server = make_server('[::1]:0', Repository(memory_db, None))
+    except OSError:
+        pytest.skip('IPv6 loopback unavailable')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        address = join_address('::1', server.server_port)
+        assert query(address, 'stats') == dict(results=None)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_setup_without_fts5(tmp_path, monkeypatch):
+    path = str(tmp_path / 'movies.sqlite')
+    DB(path).close()
+    monkeypatch.setattr(DB, 'has_fts5', lambda self: False)
+    db = DB(path)
+    assert not db.fts
+    db.upsert(Movie(title='Alien', director='Ridley Scott'))
+    db.conn.commit()
+    with pytest.raises(sqlite3.OperationalError, match='FTS5'):
+        db.search('ridley')
+    db.close()
+    monkeypatch.undo()
+    db = DB(path)
+    assert db.search('ridley').fetchall() == [('Alien', '[Ridley] Scott')]
+    db.close()
+
+
+def test_setup_dedups_legacy_table_once(tmp_path):
+    path = str(tmp_path / 'legacy.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "create table movies ([ID] INTEGER PRIMARY KEY, [TITLE] text, \
+        [YEAR] integer, [RUNTIME] text, [GENRE] text, [DIRECTOR] text, \
+        [CAST] text, [WRITER] text, [LANGUAGE] text, [COUNTRY] text, \
+        [AWARDS] text, [IMDb_Rating] float, [IMDb_votes] integer, \
+        [BOX_OFFICE] integer)")
+    conn.executemany(
+        "insert into movies (title) values (?)",
+        [('Alien', ), ('Alien', ), ('Memento', )])
+    conn.commit()
+    conn.close()
+    db = DB(path)
+    assert db.has_index('idx_movies_title')
+    assert DB.get_all_titles(db).fetchall() == [('Alien', ), ('Memento', )]
+    db.close()
+
+
+def test_reads_run_while_writer_holds_transaction(tmp_path):
+    import threading
+    db = DB(str(tmp_path / 'wal.sqlite'))
+    db.insert('Alien')
+    db.conn.commit()
+    db.insert('Memento')
+    # the owner thread reads its own uncommitted insert from the writer
+    assert len(DB.get_all_titles(db).fetchall()) == 2
+    seen = []
+    thread = threading.Thread(
+        target=lambda: seen.extend(DB.get_all_titles(db).fetchall()))
+    thread.start()
+    thread.join()
+    assert seen == [('Alien', )]
+    db.conn.commit()
+    assert DB.get_all_titles(db).fetchall() == [('Alien', ), ('Memento', )]
+    db.close()
+
+
+def test_reads_get_fresh_cursors(tmp_path):
+    db = DB(str(tmp_path / 'wal.sqlite'))
+    for title in ('Alien', 'Memento'):
+        db.insert(title)
+    db.conn.commit()
+    pairs = [(outer, inner) for (outer, ) in DB.get_all_titles(db)
+             for (inner, ) in DB.get_all_titles(db)]
+    assert len(pairs) == 4
+    assert db.pool.opened == 2
+    assert len(db.pool.idle) == 2
+    db.close()
+
+
+def test_pool_reads_in_parallel_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    db = DB(str(tmp_path / 'wal.sqlite'), readers=2)
+    db.insert('Alien')
+    db.conn.commit()
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(
+            lambda _: DB.get_all_titles(db).fetchall(), range(64)))
+    assert results == [[('Alien', )]] * 64
+    assert len(db.pool.idle) <= 2
+    assert db.conn.execute("pragma journal_mode").fetchone() == ('wal', )
+    db.close()
+
+
+def test_read_commands_skip_http_stack(tmp_path):
+    import os
+    import subprocess
+    import sys
+    db = DB(str(tmp_path / 'movies.sqlite'))
+    db.upsert(Movie(title='Alien', director='Ridley Scott'))
+    db.conn.commit()
+    db.close()
+    root = os.path.dirname(os.path.abspath(__file__))
+    code = "import runpy, sys; sys.argv[1:] = {!r}; " \
+        "runpy.run_path({!r}, run_name='__main__'); " \
+        "print('requests' in sys.modules)"
+    for argv in (['-s', 'title'], ['-f', 'director', 'Ridley Scott']):
+        result = subprocess.run(
+            [sys.executable, '-c',
+             code.format(argv, os.path.join(root, 'movies.py'))],
+            cwd=tmp_path, capture_output=True, text=True,
+            env=dict(os.environ, PYTHONPATH=root))
+        lines = result.stdout.splitlines()
+        assert 'Alien' in result.stdout, result.stderr
+        assert lines[-1] == 'False'
+
+
+def test_parse_importtime():
+    lines = [
+        'import time: self [us] | cumulative | imported package',
+        'import time:       443 |      92803 |   requests',
+        'import time:      3173 |     107187 | classes.Repository',
+    ]
+    assert parse_importtime(lines) == [
+        ('requests', 1, 443, 92803), ('classes.Repository', 0, 3173, 107187)]
+
+
+def test_catalog_is_deterministic_omdb_data():
+    movies = list(Catalog(500, seed=1))
+    assert movies == list(Catalog(500, seed=1))
+    assert len(set(movie['Title'] for movie in movies)) == 500
+    parsed = [Movie.json_to_movie(movie) for movie in movies]
+    assert any(movie.oscars for movie in parsed)
+    assert any(movie.box_office_usd for movie in parsed)
+
+
+def test_query_benchmark(tmp_path):
+    import io
+    results = benchmark(sizes=(300, ), repeat=1, log=io.StringIO(),
+                        data_dir=str(tmp_path))
+    assert len(set(row['query'] for row in results)) == len(results) > 15
+    assert all(row['rows'] >= 0 and row['wall_s'] >= 0 for row in results)
+    ratios = compare(results, dict(results=results))
+    assert [row[-1] for row in ratios] == [1.0] * len(results)
+
+
+def test_fake_omdb_throttles_and_serves_fixtures():
+    server = FakeOMDb(load_fixtures(), rate_limit=2).start()
+    try:
+        session = requests.Session()
+        statuses = [
+            session.get(server.url, params={'t': 'alien'}).status_code
+            for _ in range(5)]
+        assert statuses[0] == 200 and 429 in statuses
+        assert server.counts['requests'] == 5
+    finally:
+        server.stop()
+    server = FakeOMDb(load_fixtures()).start()
+    try:
+        data = requests.get(server.url, params={'t': 'Memento'}).json()
+        assert Movie.json_to_movie(data).title == 'Memento'
+        data = requests.get(server.url, params={'t': 'Unknown'}).json()
+        assert data == {"Response": "False", "Error": "Movie not found!"}
+    finally:
+        server.stop()
+
+
+def test_ingest_benchmark():
+    import io
+    results = benchmarks.ingest.benchmark(
+        sizes=(40, ), workers=(1, 4), adds=5, log=io.StringIO())
+    assert [(row['benchmark'], row['workers']) for row in results] == [
+        ('populate', 1), ('populate', 4), ('add', 1)]
+    assert all(row['failed'] == 0 for row in results)
+    assert results[0]['requests'] == 40
+
+
+def test_instrumentation_records_statements(mock_db_populated):
+    seen = []
+    instrumentation = DB.instrument(
+        mock_db_populated, Instrumentation(hooks=[seen.append]))
+    rows = list(DB.get_filtered_by_actor(mock_db_populated, 'Tom Hanks'))
+    assert [statement.rows for statement in seen] == [len(rows)]
+    assert seen[0].params['value0'] == 'Tom Hanks'
+    assert 'movie_person' in seen[0].sql
+    DB.insert(mock_db_populated, 'Solaris')
+    assert seen[1].rows == 1
+    DB.get_all_titles(mock_db_populated).fetchone()
+    assert len(seen) == 2
+    instrumentation.flush()
+    assert seen[2].rows == 1
+    assert instrumentation.count == 3
+    assert instrumentation.rows == len(rows) + 2
+
+
+def test_explain_prints_plan_once(mock_db_populated):
+    import io
+    out = io.StringIO()
+    DB.instrument(mock_db_populated, Instrumentation(explain=True, out=out))
+    for _ in range(2):
+        DB.get_filtered_by_actor(mock_db_populated, 'Tom Hanks').fetchall()
+    assert out.getvalue().count('QUERY PLAN') == 1
+    assert 'SEARCH person' in out.getvalue()
+
+
+def test_timings_nested_phases_exclusive():
+    ticks = iter([0, 1, 3, 4, 6, 10])
+    timings = Timings(clock=lambda: next(ticks))
+    with timings.phase('print'):
+        with timings.phase('rows'):
+            pass
+    timings.add('parse', 1)
+    assert timings.phases == {'print': 4, 'rows': 1, 'parse': 1}
+    result = timings.breakdown()
+    assert result['total'] == 10
+    assert result['python'] == 5
+
+
+def test_compare_ranks_any_number_of_movies(mock_db_populated):
+    repo = Repository(mock_db_populated, None)
+    ranking = repo.get_compared(
+        'runtime', ['memento', 'Alien', 'Boyhood', 'Unknown'])
+    assert [(title, minutes) for (title, _, minutes) in ranking] == [
+        ('Boyhood', 165), ('Alien', 117), ('Memento', 113)]
+    with pytest.raises(ValueError, match='Unknown comparator'):
+        repo.get_compared('title', ['Alien'])
+
+
+def test_compare_uses_nocase_title_index(mock_db_populated):
+    import io
+    out = io.StringIO()
+    DB.instrument(mock_db_populated, Instrumentation(explain=True, out=out))
+    DB.get_compared(mock_db_populated, 'awards', ['Alien', 'Memento'])
+    assert 'USING INDEX idx_movies_title_nocase' in out.getvalue()
+
+
+def test_compare_pairs_one_lookup_per_batch(mock_db_populated):
+    repo = Repository(mock_db_populated, None)
+    instrumentation = DB.instrument(mock_db_populated, Instrumentation())
+    pairs = [('Alien', 'Memento'), ('boyhood', 'Alien'), ('Alien', 'Nope')]
+    assert list(repo.compare_pairs('runtime', pairs, batch_size=2)) == [
+        ('Alien', 'Memento', 'Alien'), ('Boyhood', 'Alien', 'Boyhood'),
+        ('Alien', 'Nope', None)]
+    assert instrumentation.count == 2
+
+
+def test_compare_ties_go_to_first_added(memory_db):
+    for title in ('Ben Hur', 'Omen'):
+        memory_db.upsert(Movie(title=title, runtime='120 min'))
+    memory_db.conn.commit()
+    repo = Repository(memory_db, None)
+    ranking = repo.get_compared('runtime', ['Omen', 'Ben Hur'])
+    assert ranking[0][0] == 'Ben Hur'
+    pairs = [('Ben Hur', 'Omen'), ('Omen', 'Ben Hur')]
+    assert [row[2] for row in repo.compare_pairs('runtime', pairs)] == \
+        ['Ben Hur', 'Ben Hur']
+
+
+def test_read_pairs_skips_malformed():
+    skipped = []
+    lines = ['Alien\tMemento\n', '\n', 'Alien\n', 'Joker\t \n', 'A\tB\n']
+    assert list(read_pairs(lines, skipped)) == [
+        ('Alien', 'Memento'), ('A', 'B')]
+    assert [number for (number, _) in skipped] == [3, 4]
+
+
+def test_top_matches_sorted_and_columnar(mock_db_populated):
+    pytest.importorskip('numpy')
+    from classes.Columnar import ColumnarRepository
+    sqlite = Repository(mock_db_populated, None)
+    columnar = ColumnarRepository(mock_db_populated, None)
+    for column in ('title', 'year', 'runtime', 'box_office', 'movies.cast'):
+        assert sqlite.get_top(column, 4) == \
+            list(sqlite.get_sorted_by(column, limit=4))
+        for descending in (True, False):
+            assert columnar.get_top(column, 4, descending) == \
+                sqlite.get_top(column, 4, descending)
+
+
+def test_top_ascending_nulls_last(memory_db):
+    for title in ('Alien', 'Memento', 'Boyhood'):
+        DB.insert(memory_db, title)
+    memory_db.cursor.execute(
+        "update movies set box_office='$5', box_office_usd=5 \
+        where title='Memento'")
+    result = DB.get_top(memory_db, 'box_office', 2, descending=False)
+    assert result.fetchall() == [('Memento', '$5'), ('Alien', None)]
+    with pytest.raises(ValueError, match='Unknown sort column'):
+        DB.get_top(memory_db, 'title; drop table movies', 2)
+
+
+def test_top_reads_index_without_sorting(mock_db_populated):
+    import io
+    out = io.StringIO()
+    DB.instrument(mock_db_populated, Instrumentation(explain=True, out=out))
+    DB.get_top(mock_db_populated, 'imdb_rating', 3).fetchall()
+    DB.get_top(mock_db_populated, 'runtime', 3, descending=False).fetchall()
+    assert 'idx_movies_imdb_rating_real' in out.getvalue()
+    assert 'idx_movies_runtime_minutes' in out.getvalue()
+    assert 'TEMP B-TREE' not in out.getvalue()
+
+
+def test_find_combines_filters_and_sort(mock_db_populated):
+    repo = Repository(mock_db_populated, None)
+    (columns, rows) = repo.find(
+        [('language', 'English'), ('earned', None)], ['imdb_rating', 'year'])
+    rows = list(rows)
+    assert columns == ['title', 'language', 'box_office', 'imdb_rating',
+                       'year']
+    english = set(title for (title, _) in repo.get_filtered_by(
+        'language', 'English'))
+    earned = set(title for (title, _) in repo.get_earned())
+    assert [row[0] for row in rows] == [
+        title for (title, _) in repo.get_sorted_by('imdb_rating')
+        if title in english & earned]
+
+
+def test_build_query_whitelists_names():
+    with pytest.raises(ValueError, match='Unknown filter'):
+        build_query([('title; drop table movies', 'x')])
+    with pytest.raises(ValueError, match='Unknown sort column'):
+        build_query(sort=['year desc; drop table movies'])
+    with pytest.raises(ValueError, match='Unknown match'):
+        build_query([('actor', 'x')], match='regex')
+
+
+def test_build_query_reuses_sql_text():
+    compile_query.cache_clear()
+    (_, first, params) = build_query([('director', 'Ridley Scott')], ['year'])
+    (_, second, _) = build_query([('director', 'Sergio Leone')], ['year'])
+    assert first == second
+    assert 'Ridley Scott' not in first
+    assert params['value0'] == 'Ridley Scott'
+    assert compile_query.cache_info().hits == 1
+
+
+def test_find_multi_key_keyset_pagination(mock_db_populated):
+    sort = [('box_office_usd', False), ('year', True)]
+    (_, everything) = Repository(mock_db_populated, None).find(
+        sort=sort)
+    everything = list(everything)
+    pages, after = [], None
+    while True:
+        page = DB.find(mock_db_populated, sort=sort, limit=7,
+                       after=after).fetchall()
+        if not page:
+            break
+        pages.extend(page)
+        after = page[-1][0]
+    assert pages == everything
+    values = [row[1] for row in everything]
+    assert values.index(None) == len(values) - values.count(None)